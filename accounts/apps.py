@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "accounts"
+
+    def ready(self):
+        # フォローグラフとおすすめユーザーを更新するシグナルを登録する
+        from . import graph, suggestions  # noqa: F401
@@ -0,0 +1,69 @@
+"""
+フォロワー/フォロー一覧のページング。
+
+FriendShipには作成日時がないので、一覧に出す相手のユーザーidの降順に並べて、
+(following, follower)と(follower, following)のインデックスをそのまま範囲スキャンする。
+「閲覧者がフォローしているか」「閲覧者をフォローしているか」は1ページ分の行に
+EXISTSを付けて同じクエリで取るので、行ごとにクエリを投げない
+"""
+
+from django.db.models import Exists, OuterRef
+
+from tweets.pagination import decode_keys, encode_keys
+
+from .models import FriendShip
+
+
+def _page(friendships, other, viewer, cursor, page_size):
+    """
+    friendshipsをotherのidの降順に1ページ分取り出す。
+    各行のotherがviewerにフォローされているかをis_followed_by_viewer、
+    viewerをフォローしているかをfollows_viewerとして付ける。
+    返り値は(FriendShipのリスト, 次のページのカーソル or None)
+    """
+    key = f"{other}_id"
+    friendships = friendships.select_related(other).order_by(f"-{key}")
+    if cursor:
+        (pk,) = decode_keys(cursor, int)
+        friendships = friendships.filter(**{f"{key}__lt": pk})
+    friendships = friendships.annotate(
+        is_followed_by_viewer=Exists(
+            FriendShip.objects.filter(follower=viewer, following=OuterRef(key))
+        ),
+        follows_viewer=Exists(
+            FriendShip.objects.filter(follower=OuterRef(key), following=viewer)
+        ),
+    )
+    # 1件多く取って次のページがあるか判定する(COUNTは投げない)
+    rows = list(friendships[: page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    # カーソルは「このユーザーidより小さい」ページを表す
+    return rows, encode_keys(getattr(rows[-1], key))
+
+
+def followers_page(user, viewer, cursor=None, page_size=20):
+    """userのフォロワーの1ページ分。相手はrow.follower"""
+    return _page(
+        FriendShip.objects.filter(following=user), "follower", viewer, cursor, page_size
+    )
+
+
+def following_page(user, viewer, cursor=None, page_size=20):
+    """userがフォローしている人の1ページ分。相手はrow.following"""
+    return _page(
+        FriendShip.objects.filter(follower=user), "following", viewer, cursor, page_size
+    )
+
+
+def serialise(rows, other):
+    return [
+        {
+            "id": getattr(row, f"{other}_id"),
+            "username": getattr(row, other).username,
+            "is_followed_by_viewer": row.is_followed_by_viewer,
+            "follows_viewer": row.follows_viewer,
+        }
+        for row in rows
+    ]
@@ -0,0 +1,298 @@
+"""
+フォローグラフのプロセス内インデックス。
+
+settings.FOLLOW_GRAPH_INDEXがTrueのとき、「AはBをフォローしているか」をDBに聞かずに
+メモリ上の隣接リストで答える。隣接リストはCSR形式(ユーザーidのソート済み配列、
+各ユーザーの行の開始位置、行ごとにソートした相手のidを全部つなげた配列)で、
+どれもarray('q')なので1辺あたり8バイトで済み、二分探索でO(log n)で引ける。
+フォロー一覧とフォロワー一覧の2つを持つ。
+
+最初に使うときにFriendShipから読み込み、そのあとはフォロー/フォロー解除のシグナルで
+コミット後に差分を足していく。差分がCOMPACT_AFTER件たまったらCSRを作り直す。
+更新はこのプロセスのシグナルでしか届かないので、複数プロセスで動かすときは
+他のプロセスのフォローが見えない。1プロセスで動かすときか、多少古くてもよいときに使う
+"""
+
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import FriendShip
+
+# この数だけ差分がたまったらCSRを作り直す
+COMPACT_AFTER = 10000
+
+
+class CSR:
+    """(元, 先)の組を元ごとにまとめた隣接リスト"""
+
+    def __init__(self, pairs):
+        """pairsは(元, 先)の昇順"""
+        self.ids = array("q")
+        self.offsets = array("q", [0])
+        self.targets = array("q")
+        last = None
+        for source, target in pairs:
+            if source != last:
+                if last is not None:
+                    self.offsets.append(len(self.targets))
+                self.ids.append(source)
+                last = source
+            self.targets.append(target)
+        if last is not None:
+            self.offsets.append(len(self.targets))
+
+    def _bounds(self, source):
+        i = bisect_left(self.ids, source)
+        if i < len(self.ids) and self.ids[i] == source:
+            return self.offsets[i], self.offsets[i + 1]
+        return 0, 0
+
+    def row(self, source):
+        lo, hi = self._bounds(source)
+        return self.targets[lo:hi]
+
+    def count(self, source):
+        lo, hi = self._bounds(source)
+        return hi - lo
+
+    def contains(self, source, target):
+        lo, hi = self._bounds(source)
+        i = bisect_left(self.targets, target, lo, hi)
+        return i < hi and self.targets[i] == target
+
+    def pairs(self):
+        for i, source in enumerate(self.ids):
+            for target in self.targets[self.offsets[i] : self.offsets[i + 1]]:
+                yield source, target
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.ids, self.offsets, self.targets))
+
+
+def intersect(a, b):
+    """ソート済みの2つの列の共通部分をソート済みのリストで返す"""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+class FollowGraph:
+    def __init__(self, following_pairs, follower_pairs=None):
+        """
+        following_pairsは(フォローする人, される人)の昇順。
+        follower_pairs((される人, フォローする人)の昇順)がなければfollowing_pairsから作る
+        """
+        self._lock = threading.Lock()
+        self._build(following_pairs, follower_pairs)
+
+    @classmethod
+    def load(cls):
+        """FriendShipを2本のインデックスの順に読むので、メモリ上で並べ替えない"""
+        friendships = FriendShip.objects.values_list("follower_id", "following_id")
+        return cls(
+            friendships.order_by("follower_id", "following_id").iterator(
+                chunk_size=10000
+            ),
+            (
+                (following, follower)
+                for follower, following in friendships.order_by(
+                    "following_id", "follower_id"
+                ).iterator(chunk_size=10000)
+            ),
+        )
+
+    def _build(self, following_pairs, follower_pairs=None):
+        self._following = CSR(following_pairs)
+        if follower_pairs is None:
+            follower_pairs = sorted(
+                (target, source) for source, target in self._following.pairs()
+            )
+        self._followers = CSR(follower_pairs)
+        # {ユーザーid: {相手のid: フォローしているか}}。CSRと違うものだけ入れる
+        self._following_changes = {}
+        self._follower_changes = {}
+        self._pending = 0
+
+    def follows(self, follower, following):
+        changes = self._following_changes.get(follower)
+        if changes and following in changes:
+            return changes[following]
+        return self._following.contains(follower, following)
+
+    def _adjusted(self, csr, changes, user):
+        row = csr.row(user)
+        user_changes = changes.get(user)
+        if not user_changes:
+            return list(row)
+        removed = {pk for pk, present in user_changes.items() if not present}
+        ids = {pk for pk in row if pk not in removed}
+        ids.update(pk for pk, present in user_changes.items() if present)
+        return sorted(ids)
+
+    def following(self, user):
+        """userがフォローしている人のid(昇順)"""
+        return self._adjusted(self._following, self._following_changes, user)
+
+    def followers(self, user):
+        """userをフォローしている人のid(昇順)"""
+        return self._adjusted(self._followers, self._follower_changes, user)
+
+    def _count(self, csr, changes, user):
+        # 差分にはCSRと違うものしか入っていない
+        delta = sum(1 if present else -1 for present in changes.get(user, {}).values())
+        return csr.count(user) + delta
+
+    def following_count(self, user):
+        return self._count(self._following, self._following_changes, user)
+
+    def follower_count(self, user):
+        return self._count(self._followers, self._follower_changes, user)
+
+    def mutual_follows(self, user):
+        """userとお互いにフォローしている人"""
+        return intersect(self.following(user), self.followers(user))
+
+    def common_following(self, a, b):
+        """aとbの両方がフォローしている人"""
+        return intersect(self.following(a), self.following(b))
+
+    def _set(self, follower, following, present):
+        with self._lock:
+            if self.follows(follower, following) == present:
+                return
+            for changes, user, other in (
+                (self._following_changes, follower, following),
+                (self._follower_changes, following, follower),
+            ):
+                user_changes = changes.setdefault(user, {})
+                if other in user_changes:
+                    # CSRの状態に戻ったので差分から消す
+                    del user_changes[other]
+                    if not user_changes:
+                        del changes[user]
+                else:
+                    user_changes[other] = present
+            self._pending += 1
+            if self._pending >= COMPACT_AFTER:
+                self._compact()
+
+    def add(self, follower, following):
+        self._set(follower, following, True)
+
+    def remove(self, follower, following):
+        self._set(follower, following, False)
+
+    def _compact(self):
+        changes = self._following_changes
+        pairs = [
+            (source, target)
+            for source, target in self._following.pairs()
+            if changes.get(source, {}).get(target, True)
+        ]
+        pairs += [
+            (source, target)
+            for source, targets in changes.items()
+            for target, present in targets.items()
+            if present
+        ]
+        self._build(sorted(pairs))
+
+    def memory_usage(self):
+        """CSRの配列のバイト数と、差分の辞書のおおよそのバイト数"""
+        changes = sum(
+            sys.getsizeof(d) + sum(sys.getsizeof(c) for c in d.values())
+            for d in (self._following_changes, self._follower_changes)
+        )
+        return {
+            "edges": len(self._following.targets),
+            "users": len(self._following.ids),
+            "csr_bytes": self._following.nbytes + self._followers.nbytes,
+            "pending_changes": self._pending,
+            "changes_bytes": changes,
+        }
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def is_enabled():
+    return bool(settings.FOLLOW_GRAPH_INDEX)
+
+
+def get_graph():
+    """読み込んだインデックス。まだなければFriendShipから読み込む"""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = FollowGraph.load()
+    return _graph
+
+
+def reset():
+    global _graph
+    _graph = None
+
+
+@receiver(setting_changed)
+def follow_graph_setting_changed(setting, **kwargs):
+    if setting == "FOLLOW_GRAPH_INDEX":
+        reset()
+
+
+def is_following(follower_id, following_id):
+    """インデックスが有効ならメモリから、そうでなければDBに聞く"""
+    if is_enabled():
+        return get_graph().follows(follower_id, following_id)
+    return FriendShip.objects.filter(
+        follower_id=follower_id, following_id=following_id
+    ).exists()
+
+
+def on_commit(follower_id, following_id, present, using=None):
+    """
+    コミットしたらインデックスに反映する。ロールバックされたフォローは入れない。
+    まだ読み込んでいなければ、読み込むときにDBから入るので何もしない
+    """
+    if _graph is None:
+        return
+
+    def apply():
+        if _graph is None:
+            return
+        if present:
+            _graph.add(follower_id, following_id)
+        else:
+            _graph.remove(follower_id, following_id)
+
+    transaction.on_commit(apply, using=using)
+
+
+@receiver(post_save, sender=FriendShip)
+def friendship_is_created(sender, instance, created, using, **kwargs):
+    if created:
+        on_commit(instance.follower_id, instance.following_id, True, using)
+
+
+@receiver(post_delete, sender=FriendShip)
+def friendship_is_deleted(sender, instance, using, **kwargs):
+    on_commit(instance.follower_id, instance.following_id, False, using)
@@ -0,0 +1,85 @@
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from tweets import archive, deletion
+from tweets.models import Tweet
+
+
+def database_usage(connection):
+    """SQLiteなら(ファイルのバイト数, 使っているバイト数)。それ以外はNone"""
+    if connection.vendor != "sqlite":
+        return None
+    with connection.cursor() as cursor:
+        values = []
+        for pragma in ("page_size", "page_count", "freelist_count"):
+            cursor.execute(f"PRAGMA {pragma}")
+            values.append(cursor.fetchone()[0])
+    page_size, page_count, freelist_count = values
+    return page_size * page_count, page_size * (page_count - freelist_count)
+
+
+class Command(BaseCommand):
+    help = "Move old tweets and their likes into gzip'd JSON Lines files by month"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.TWEET_RETENTION_DAYS,
+            help="archive tweets older than this many days",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="run VACUUM afterwards to give the freed space back to the OS",
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        before = database_usage(connection)
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        # 1バッチの読み込みと削除は全部defaultで行う(レプリカの遅れた行を書き出して消さない)
+        tweets = Tweet._base_manager.using(DEFAULT_DB_ALIAS).filter(
+            created_at__lt=cutoff
+        )
+
+        totals = Counter()
+        last_pk = 0
+        while True:
+            # ファイルに書いてから消すので、1バッチの間は消す行をロックしておく
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                rows = list(
+                    tweets.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .select_for_update()
+                    .values_list("pk", "user_id")[: options["batch_size"]]
+                )
+                if not rows:
+                    break
+                pks = [pk for pk, _ in rows]
+                totals.update(archive.archive_batch(pks))
+                deletion.delete_tweets(rows, DEFAULT_DB_ALIAS)
+            last_pk = pks[-1]
+            print(f"archived {totals['tweets']} tweets (up to pk {last_pk})")
+
+        print(
+            f"finish archive: {totals['tweets']} tweets, {totals['likes']} likes, "
+            f"{totals['raw_bytes']} bytes compressed to {totals['archived_bytes']} bytes"
+        )
+        if before is None:
+            print("run VACUUM on the database to reclaim the freed space")
+            return
+        if options["vacuum"]:
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+        after = database_usage(connection)
+        print(
+            f"database: {before[1] - after[1]} bytes freed, "
+            f"file {before[0]} -> {after[0]} bytes"
+        )
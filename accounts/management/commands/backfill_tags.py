@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tweets import tags
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "Extract hashtags and mentions from existing tweets, a batch at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # pkの順にbatch-size件ずつ読むので、ツイートが多くても全部をメモリに載せない
+        last_pk = 0
+        count = 0
+        while True:
+            batch = list(
+                Tweet.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .only("pk", "contents", "created_at")[: options["batch_size"]]
+            )
+            if not batch:
+                break
+            with transaction.atomic():
+                tags.save_tags(batch)
+            last_pk = batch[-1].pk
+            count += len(batch)
+        print(f"processed {count} tweets")
@@ -0,0 +1,70 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    override_settings,
+    setup_test_environment,
+    teardown_test_environment,
+)
+
+from mysite import benchmark
+
+# 本物のフラグメントキャッシュにロールバックしたデータのバージョンを残さない
+BENCHMARK_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "benchmark",
+    }
+}
+
+
+class Command(BaseCommand):
+    help = "Measure queries, time and peak memory of every view at several data sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[100, 1000], help="users per run"
+        )
+        parser.add_argument("--scenario", dest="names", action="append")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="write the JSON report to this file")
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="fail if a query count depends on the data size",
+        )
+
+    def handle(self, *args, **options):
+        # テストクライアントのホスト名(testserver)を許可する
+        setup_test_environment()
+        try:
+            with override_settings(CACHES=BENCHMARK_CACHES):
+                report = benchmark.run(
+                    options["sizes"],
+                    names=options["names"],
+                    repeat=options["repeat"],
+                    seed=options["seed"],
+                )
+        finally:
+            teardown_test_environment()
+
+        for size, results in report["sizes"].items():
+            print(f"size {size}")
+            for name, result in results.items():
+                print(
+                    f"  {name:<20} {result['status']} "
+                    f"queries={result['queries'][-1]:<3} "
+                    f"time={result['time_ms']:.1f}ms "
+                    f"peak={result['peak_kib']:.0f}KiB"
+                )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            print(f"wrote {options['output']}")
+
+        changes = benchmark.query_count_changes(report)
+        for name, counts in changes.items():
+            print(f"query count of {name} depends on the data size: {counts}")
+        if options["check"] and changes:
+            raise CommandError("query counts are not constant")
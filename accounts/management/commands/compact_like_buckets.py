@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from tweets import trending
+
+
+class Command(BaseCommand):
+    help = "Delete like buckets outside the trending window and refresh the cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the buckets in the window from the likes first",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            trending.rebuild_buckets()
+        deleted = trending.compact()
+        result = trending.refresh()
+        print(f"deleted {deleted} buckets")
+        print(
+            f"trending: {len(result['tweets'])} tweets, "
+            f"{len(result['hashtags'])} hashtags"
+        )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ... import suggestions
+from ...models import Profile, User
+
+
+class Command(BaseCommand):
+    help = "Recompute follow suggestions for users whose follow graph changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="recompute every user, e.g. to refresh the activity scores",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            Profile.objects.update(suggestions_stale=True)
+        count = 0
+        while True:
+            with transaction.atomic():
+                user_ids = list(
+                    Profile.objects.filter(suggestions_stale=True)
+                    .order_by("pk")
+                    .values_list("pk", flat=True)[: options["batch_size"]]
+                )
+                if not user_ids:
+                    break
+                # 計算中にフォローが変わったら、また立ててもらえるように先に下ろす
+                Profile.objects.filter(pk__in=user_ids).update(suggestions_stale=False)
+                for user_id in user_ids:
+                    suggestions.compute(User(pk=user_id))
+            count += len(user_ids)
+        print(f"computed suggestions for {count} users")
@@ -1,21 +1,203 @@
+import itertools
 import random
+import time
+from datetime import timedelta
 
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
 
-from tweets.models import Tweet
+from tweets import trending
+from tweets.models import Like, Tweet
 
-from ...models import User
+from ... import suggestions
+from ...models import FriendShip, Profile, User
+
+# 作ったユーザーのパスワード。ハッシュは重いので1回だけ計算して使い回す
+PASSWORD = "loadtest1234"
+
+
+def power_law(ids, alpha, rng):
+    """
+    idsをシャッフルして順位を付け、順位rのidが1/(r+1)^alphaに比例して選ばれるようにする。
+    random.choicesに渡す(ids, 累積重み)を返す
+    """
+    ids = list(ids)
+    rng.shuffle(ids)
+    cum_weights = list(
+        itertools.accumulate(1 / (rank + 1) ** alpha for rank in range(len(ids)))
+    )
+    return ids, cum_weights
+
+
+def batches(total, batch_size):
+    """(先頭の番号, 件数)をbatch_sizeずつ返す"""
+    for start in range(0, total, batch_size):
+        yield start, min(batch_size, total - start)
 
 
 class Command(BaseCommand):
-    help = "Create 5000 tweets in bulk"
-
-    def handle(self, *args, **kwargs):
-        users = User.objects.all()
-        tweets = []
-        for i in range(5000):
-            contents = f"Tweet {i}"
-            user = random.choice(users)
-            tweets.append(Tweet(contents=contents, user=user))
-        Tweet.objects.bulk_create(tweets)
-        print("created 5000 tweets")
+    help = "Generate users, tweets, likes and follows in batches for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=0)
+        parser.add_argument("--tweets", type=int, default=5000)
+        parser.add_argument("--likes", type=int, default=0)
+        parser.add_argument("--follows", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--days",
+            type=float,
+            default=30,
+            help="spread tweets and likes over the last DAYS days",
+        )
+        parser.add_argument("--seed", type=int, help="seed for reproducible data")
+        parser.add_argument(
+            "--alpha",
+            type=float,
+            default=1.1,
+            help="exponent of the power-law popularity of users and tweets",
+        )
+        parser.add_argument(
+            "--skip-timelines",
+            action="store_true",
+            help="do not rebuild the home timelines afterwards",
+        )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        alpha = options["alpha"]
+        self.now = timezone.now()
+        self.since = self.now - timedelta(days=options["days"])
+
+        if options["users"]:
+            self.create_users(options["users"])
+        user_ids = list(User.objects.order_by("pk").values_list("pk", flat=True))
+        if not user_ids:
+            print("no users to create data for")
+            return
+        # ツイートする人・フォローされる人は一部の人気ユーザーに偏る
+        popular_users = power_law(user_ids, alpha, self.rng)
+
+        if options["tweets"]:
+            self.create_tweets(options["tweets"], popular_users)
+        if options["likes"]:
+            tweet_ids = Tweet.objects.order_by("pk").values_list("pk", flat=True)
+            popular_tweets = power_law(tweet_ids, alpha, self.rng)
+            self.create_likes(options["likes"], user_ids, popular_tweets)
+        if options["follows"]:
+            self.create_follows(options["follows"], user_ids, popular_users)
+
+        # bulk_createではシグナルが飛ばないので、件数・検索インデックス・タグ・
+        # トレンドのバケツ・タイムラインを作り直す
+        call_command("reconcile_like_counts", batch_size=self.batch_size)
+        call_command("reconcile_profile_counts", batch_size=self.batch_size)
+        call_command("rebuild_search_index", batch_size=self.batch_size)
+        call_command("backfill_tags", batch_size=self.batch_size)
+        trending.rebuild_buckets()
+        if not options["skip_timelines"]:
+            call_command("rebuild_timelines")
+
+    def report(self, label, count, started):
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0
+        print(f"created {count} {label} in {elapsed:.1f}s ({rate:.0f}/s)")
+
+    def random_time(self, after):
+        """afterから今までのどこか"""
+        return after + (self.now - after) * self.rng.random()
+
+    def create_users(self, total):
+        started = time.perf_counter()
+        password = make_password(PASSWORD)
+        first = (User.objects.aggregate(Max("pk"))["pk__max"] or 0) + 1
+        for start, size in batches(total, self.batch_size):
+            usernames = [f"loadtest{first + start + i}" for i in range(size)]
+            with transaction.atomic():
+                User.objects.bulk_create(
+                    User(
+                        username=username,
+                        email=f"{username}@example.com",
+                        password=password,
+                    )
+                    for username in usernames
+                )
+                # SQLiteではbulk_createがpkを返さないので引き直す
+                user_ids = User.objects.filter(username__in=usernames).values_list(
+                    "pk", flat=True
+                )
+                Profile.objects.bulk_create(Profile(user_id=pk) for pk in user_ids)
+        self.report("users", total, started)
+
+    def create_tweets(self, total, popular_users):
+        started = time.perf_counter()
+        authors, cum_weights = popular_users
+        for start, size in batches(total, self.batch_size):
+            user_ids = self.rng.choices(authors, cum_weights=cum_weights, k=size)
+            with transaction.atomic():
+                Tweet.objects.bulk_create(
+                    Tweet(user_id=user_id, contents=f"Tweet {start + i}")
+                    for i, user_id in enumerate(user_ids)
+                )
+                # created_atはauto_now_addで今の時刻になるので、あとから期間に散らす。
+                # 番号が大きい(pkが大きい)ほど新しくなるようにする
+                tweets = list(Tweet.objects.order_by("-pk").only("pk")[:size])[::-1]
+                for i, tweet in enumerate(tweets):
+                    tweet.created_at = self.since + (self.now - self.since) * (
+                        (start + i + self.rng.random()) / total
+                    )
+                Tweet.objects.bulk_update(tweets, ["created_at"])
+        self.report("tweets", total, started)
+
+    def create_likes(self, total, user_ids, popular_tweets):
+        started = time.perf_counter()
+        tweets, cum_weights = popular_tweets
+        if not tweets:
+            print("no tweets to like")
+            return
+        created_at = dict(Tweet.objects.values_list("pk", "created_at"))
+        for _, size in batches(total, self.batch_size):
+            likes = zip(
+                self.rng.choices(user_ids, k=size),
+                self.rng.choices(tweets, cum_weights=cum_weights, k=size),
+            )
+            with transaction.atomic():
+                # 同じ組み合わせが出たらユニーク制約で捨てる
+                Like.objects.bulk_create(
+                    (
+                        Like(
+                            user_id=u,
+                            tweet_id=t,
+                            created_at=self.random_time(created_at[t]),
+                        )
+                        for u, t in likes
+                    ),
+                    ignore_conflicts=True,
+                )
+        self.report("likes (duplicates skipped)", total, started)
+
+    def create_follows(self, total, user_ids, popular_users):
+        started = time.perf_counter()
+        followings, cum_weights = popular_users
+        for _, size in batches(total, self.batch_size):
+            follows = list(
+                zip(
+                    self.rng.choices(user_ids, k=size),
+                    self.rng.choices(followings, cum_weights=cum_weights, k=size),
+                )
+            )
+            with transaction.atomic():
+                FriendShip.objects.bulk_create(
+                    (
+                        FriendShip(follower_id=follower, following_id=following)
+                        for follower, following in follows
+                        if follower != following
+                    ),
+                    ignore_conflicts=True,
+                )
+                suggestions.mark_stale({follower for follower, _ in follows})
+        self.report("follows (duplicates skipped)", total, started)
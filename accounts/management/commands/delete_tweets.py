@@ -1,11 +1,86 @@
-from django.core.management.base import BaseCommand
+import datetime
+import json
+import os
 
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from tweets import deletion
 from tweets.models import Tweet
 
 
 class Command(BaseCommand):
-    help = "Delete all tweets in bulk"
+    help = "Delete tweets in primary-key order, a batch per transaction"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", dest="usernames", action="append", help="delete only this user"
+        )
+        parser.add_argument(
+            "--older-than",
+            type=datetime.date.fromisoformat,
+            help="delete only tweets created before this date (YYYY-MM-DD)",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--checkpoint",
+            help="file to record progress in; rerun with it to resume",
+        )
+
+    def handle(self, *args, **options):
+        tweets = Tweet.objects.all()
+        filters = {}
+        if options["usernames"]:
+            filters["usernames"] = sorted(options["usernames"])
+            tweets = tweets.filter(user__username__in=options["usernames"])
+        if options["older_than"]:
+            filters["older_than"] = options["older_than"].isoformat()
+            tweets = tweets.filter(
+                created_at__lt=timezone.make_aware(
+                    datetime.datetime.combine(options["older_than"], datetime.time())
+                )
+            )
+
+        checkpoint = options["checkpoint"]
+        last_pk, deleted = self.load_checkpoint(checkpoint, filters)
+        if last_pk:
+            print(f"resume after pk {last_pk} ({deleted} tweets already deleted)")
+
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    tweets.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .values_list("pk", "user_id")[: options["batch_size"]]
+                )
+                if not rows:
+                    break
+                deletion.delete_tweets(rows)
+            last_pk = rows[-1][0]
+            deleted += len(rows)
+            self.save_checkpoint(checkpoint, filters, last_pk, deleted)
+            print(f"deleted {deleted} tweets (up to pk {last_pk})")
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        print(f"finish delete: {deleted} tweets")
+
+    def load_checkpoint(self, path, filters):
+        if not path or not os.path.exists(path):
+            return 0, 0
+        with open(path) as f:
+            state = json.load(f)
+        if state["filters"] != filters:
+            raise CommandError(
+                f"{path} was written with other filters: {state['filters']}"
+            )
+        return state["last_pk"], state["deleted"]
 
-    def handle(self, *args, **kwargs):
-        Tweet.objects.all().delete()
-        print("finish delete")
+    def save_checkpoint(self, path, filters, last_pk, deleted):
+        if not path:
+            return
+        # 書きかけで落ちても壊れないように、別名で書いてから置き換える
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"filters": filters, "last_pk": last_pk, "deleted": deleted}, f)
+        os.replace(f"{path}.tmp", path)
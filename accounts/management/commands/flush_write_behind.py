@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tweets import writebehind
+
+
+class Command(BaseCommand):
+    help = "Apply queued like/follow intents in batches (write-behind mode)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--loop", action="store_true", help="keep flushing until interrupted"
+        )
+        parser.add_argument("--interval", type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        if not writebehind.is_enabled():
+            raise CommandError("WRITE_BEHIND is not configured")
+        while True:
+            started = time.perf_counter()
+            flushed = writebehind.flush(batch_size=options["batch_size"])
+            if flushed or not options["loop"]:
+                elapsed = time.perf_counter() - started
+                print(f"flushed {flushed} intents in {elapsed:.2f}s")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
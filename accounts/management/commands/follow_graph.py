@@ -0,0 +1,55 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...graph import FollowGraph
+from ...models import FriendShip, User
+
+
+class Command(BaseCommand):
+    help = "Report the in-memory follow graph size and time lookups against the ORM"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lookups", type=int, default=1000, help="follow checks to time"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        graph = FollowGraph.load()
+        print(f"loaded in {(time.perf_counter() - started) * 1000:.1f}ms")
+        for key, value in graph.memory_usage().items():
+            print(f"  {key:<16} {value}")
+
+        user_ids = list(User.objects.values_list("pk", flat=True))
+        if not user_ids or not options["lookups"]:
+            return
+        # 半分はフォローしている組、半分はランダムな組を引く
+        rng = random.Random(options["seed"])
+        edges = list(
+            FriendShip.objects.order_by("?").values_list("follower_id", "following_id")[
+                : options["lookups"] // 2
+            ]
+        )
+        pairs = edges + [
+            (rng.choice(user_ids), rng.choice(user_ids))
+            for _ in range(options["lookups"] - len(edges))
+        ]
+
+        started = time.perf_counter()
+        in_memory = [graph.follows(a, b) for a, b in pairs]
+        graph_time = time.perf_counter() - started
+        started = time.perf_counter()
+        orm = [
+            FriendShip.objects.filter(follower_id=a, following_id=b).exists()
+            for a, b in pairs
+        ]
+        orm_time = time.perf_counter() - started
+
+        if in_memory != orm:
+            self.stderr.write("the graph and the database disagree")
+        print(f"{len(pairs)} lookups")
+        print(f"  graph {graph_time / len(pairs) * 1e6:.2f}us/lookup")
+        print(f"  orm   {orm_time / len(pairs) * 1e6:.2f}us/lookup")
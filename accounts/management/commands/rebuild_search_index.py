@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tweets import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of tweet contents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = search.rebuild(options["batch_size"])
+        print(f"indexed {count} tweets")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tweets import timeline
+
+from ...models import User
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialised home timeline of every user"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", dest="usernames", action="append", help="rebuild only this user"
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by("pk")
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+        count = 0
+        for user in users.iterator():
+            with transaction.atomic():
+                timeline.rebuild(user)
+            count += 1
+        print(f"rebuilt {count} timelines")
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from tweets.models import Like, Tweet
+
+
+class Command(BaseCommand):
+    help = "Recalculate Tweet.like_count from the Like table in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_pk = 0
+        checked = fixed = 0
+        while True:
+            with transaction.atomic():
+                tweets = list(
+                    Tweet.objects.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .values_list("pk", "like_count")[:batch_size]
+                )
+                if not tweets:
+                    break
+                last_pk = tweets[-1][0]
+                actual = dict(
+                    Like.objects.filter(tweet_id__in=[pk for pk, _ in tweets])
+                    .values("tweet_id")
+                    .annotate(count=Count("*"))
+                    .values_list("tweet_id", "count")
+                )
+                wrong = [
+                    Tweet(pk=pk, like_count=actual.get(pk, 0))
+                    for pk, like_count in tweets
+                    if like_count != actual.get(pk, 0)
+                ]
+                Tweet.objects.bulk_update(wrong, ["like_count"])
+            checked += len(tweets)
+            fixed += len(wrong)
+        print(f"checked {checked} tweets, fixed {fixed} like counts")
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from tweets.models import Tweet
+
+from ...models import FriendShip, Profile
+
+COUNTED_FIELDS = ("follower_count", "following_count", "tweet_count")
+
+
+def count_by(queryset, field, ids):
+    return dict(
+        queryset.filter(**{f"{field}__in": ids})
+        .values(field)
+        .annotate(count=Count("*"))
+        .values_list(field, "count")
+    )
+
+
+class Command(BaseCommand):
+    help = "Recalculate follower/following/tweet counts on Profile in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_pk = 0
+        checked = fixed = 0
+        while True:
+            with transaction.atomic():
+                profiles = list(
+                    Profile.objects.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .only("pk", *COUNTED_FIELDS)[:batch_size]
+                )
+                if not profiles:
+                    break
+                last_pk = profiles[-1].pk
+                ids = [profile.pk for profile in profiles]
+                actual = {
+                    "follower_count": count_by(FriendShip.objects, "following", ids),
+                    "following_count": count_by(FriendShip.objects, "follower", ids),
+                    "tweet_count": count_by(Tweet.objects, "user", ids),
+                }
+                wrong = []
+                for profile in profiles:
+                    counts = {
+                        field: actual[field].get(profile.pk, 0)
+                        for field in COUNTED_FIELDS
+                    }
+                    if any(getattr(profile, f) != c for f, c in counts.items()):
+                        wrong.append(Profile(pk=profile.pk, **counts))
+                Profile.objects.bulk_update(wrong, COUNTED_FIELDS)
+            checked += len(profiles)
+            fixed += len(wrong)
+        print(f"checked {checked} profiles, fixed {fixed} profile counts")
@@ -0,0 +1,53 @@
+# Generated by Django 4.0.10 on 2026-10-18 15:48
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Min
+
+from mysite.migration_operations import AddIndexOnline, AddUniqueConstraintOnline
+
+DEDUPE_BATCH_SIZE = 1000
+
+
+def delete_duplicate_friendships(apps, schema_editor):
+    """同じ(follower, following)の行が複数あれば、一番古い行だけ残す"""
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    duplicates = (
+        FriendShip.objects.values("follower", "following")
+        .annotate(keep_id=Min("id"), count=Count("id"))
+        .filter(count__gt=1)
+        .values_list("follower", "following", "keep_id")
+    )
+    while True:
+        batch = list(duplicates[:DEDUPE_BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic():
+            for follower_id, following_id, keep_id in batch:
+                FriendShip.objects.filter(
+                    follower_id=follower_id, following_id=following_id
+                ).exclude(id=keep_id).delete()
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLYはトランザクションの外でしか実行できない
+    atomic = False
+
+    dependencies = [
+        ("accounts", "0002_friendship_follower_friendship_following"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_friendships, migrations.RunPython.noop),
+        AddUniqueConstraintOnline(
+            model_name="friendship",
+            constraint=models.UniqueConstraint(
+                fields=("follower", "following"), name="follower_and_following_unique"
+            ),
+        ),
+        AddIndexOnline(
+            model_name="friendship",
+            index=models.Index(
+                fields=["following", "follower"], name="friendship_following_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.10 on 2026-10-18 15:50
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef("pk")})
+            .values(field)
+            .annotate(count=Count("*"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def fill_profile_counts(apps, schema_editor):
+    Profile = apps.get_model("accounts", "Profile")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    Tweet = apps.get_model("tweets", "Tweet")
+    Profile.objects.update(
+        follower_count=count_of(FriendShip, "following"),
+        following_count=count_of(FriendShip, "follower"),
+        tweet_count=count_of(Tweet, "user"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0003_friendship_unique_and_indexes"),
+        ("tweets", "0005_tweet_user_created_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="follower_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="following_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="tweet_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_profile_counts, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 
@@ -19,9 +20,23 @@ class Profile(models.Model):
     )
     introduction = models.CharField("自己紹介", max_length=255, blank=True)
     hobby = models.CharField("趣味", max_length=255, blank=True)
+    # 毎回COUNTしなくていいように件数を持っておく。FriendShip/Tweetのシグナルで増減させる
+    follower_count = models.IntegerField(default=0)
+    following_count = models.IntegerField(default=0)
+    tweet_count = models.IntegerField(default=0)
+    # フォローの増減でおすすめユーザーを計算し直す必要があるか(accounts/suggestions.py)
+    suggestions_stale = models.BooleanField(default=True)
 
     class Meta:
         db_table = "Profile"
+        # 計算し直すユーザーだけを拾う部分インデックス
+        indexes = [
+            models.Index(
+                fields=["suggestions_stale"],
+                condition=models.Q(suggestions_stale=True),
+                name="profile_suggestions_stale_idx",
+            ),
+        ]
 
     def __str__(self):
         return str(self.user)
@@ -46,5 +61,67 @@ class FriendShip(models.Model):
         User, related_name="following", on_delete=models.CASCADE
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["follower", "following"], name="follower_and_following_unique"
+            )
+        ]
+        # (follower, following)の検索はユニーク制約のインデックスを使う。
+        # フォロワー一覧やフォロワー数は逆向きなのでもう1本作っておく
+        indexes = [
+            models.Index(
+                fields=["following", "follower"], name="friendship_following_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.follower.username} : {self.following.username}"
+
+
+@receiver(post_save, sender=FriendShip)
+def friendship_is_created(sender, instance, created, **kwargs):
+    if created:
+        Profile.objects.filter(pk=instance.follower_id).update(
+            following_count=F("following_count") + 1
+        )
+        Profile.objects.filter(pk=instance.following_id).update(
+            follower_count=F("follower_count") + 1
+        )
+
+
+# ユーザーの削除に伴うカスケード削除でも呼ばれる
+@receiver(post_delete, sender=FriendShip)
+def friendship_is_deleted(sender, instance, **kwargs):
+    Profile.objects.filter(pk=instance.follower_id).update(
+        following_count=F("following_count") - 1
+    )
+    Profile.objects.filter(pk=instance.following_id).update(
+        follower_count=F("follower_count") - 1
+    )
+
+
+class FollowSuggestion(models.Model):
+    """
+    「おすすめユーザー」の計算結果。compute_follow_suggestionsコマンドが書き込み、
+    ページを表示するときはuser+scoreのインデックスを読むだけにする
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="follow_suggestions"
+    )
+    suggested = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+    # userがフォローしている人のうち、suggestedをフォローしている人数
+    mutual_count = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "suggested"],
+                name="suggestion_user_and_suggested_unique",
+            )
+        ]
+        indexes = [
+            models.Index(fields=["user", "-score"], name="suggestion_user_score_idx"),
+        ]
@@ -0,0 +1,135 @@
+"""
+「おすすめユーザー」(who to follow)。
+
+候補はフォローしている人がフォローしている人(friends-of-friends)。
+共通のフォロー数と、候補の最近のツイート・いいねの数からスコアを付けて、
+上位をFollowSuggestionに書き込んでおく。ページを表示するときはそれを読むだけで、
+リクエストごとにグラフをたどらない。
+
+フォローの増減で候補が変わるのは、フォローした本人とその人のフォロワーだけなので、
+その人たちのProfile.suggestions_staleを立てておき、compute_follow_suggestionsで
+立っている人だけを計算し直す
+"""
+
+import math
+from datetime import timedelta
+
+from django.db.models import Count, Exists, OuterRef, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from tweets.models import Like, Tweet
+
+from .models import FollowSuggestion, FriendShip, Profile
+
+# 1人に残すおすすめの数
+SUGGESTION_LIMIT = 20
+# 共通のフォロー数で絞り込んでからスコアを付ける候補の数
+CANDIDATE_LIMIT = 200
+# この日数以内のツイート・いいねを「最近の活動」として数える
+ACTIVITY_DAYS = 7
+# 共通のフォロー1人に対する、最近の活動の重み(件数の対数にかける)
+ACTIVITY_WEIGHT = 0.5
+
+
+def mark_stale(user_ids):
+    """user_idsと、そのフォロワーのおすすめを計算し直す対象にする"""
+    Profile.objects.filter(
+        Q(pk__in=user_ids)
+        | Q(
+            pk__in=FriendShip.objects.filter(following__in=user_ids).values(
+                "follower_id"
+            )
+        ),
+        suggestions_stale=False,
+    ).update(suggestions_stale=True)
+
+
+def score(mutual_count, activity):
+    return mutual_count + ACTIVITY_WEIGHT * math.log1p(activity)
+
+
+def _recent_activity(user_ids):
+    """{ユーザーid: 最近のツイート数 + いいね数}"""
+    since = timezone.now() - timedelta(days=ACTIVITY_DAYS)
+    activity = dict.fromkeys(user_ids, 0)
+    for model, field in ((Tweet, "user_id"), (Like, "user_id")):
+        counts = (
+            model.objects.filter(**{f"{field}__in": user_ids}, created_at__gte=since)
+            .values(field)
+            .annotate(count=Count("*"))
+            .values_list(field, "count")
+        )
+        for user_id, count in counts:
+            activity[user_id] += count
+    return activity
+
+
+def candidates(user):
+    """
+    userへのおすすめを{候補のid: 共通のフォロー数}で返す。
+    まだ誰もフォローしていなければ、フォロワーの多い人を共通のフォロー数0で返す
+    """
+    followings = FriendShip.objects.filter(follower=user).values("following_id")
+    mutual = dict(
+        FriendShip.objects.filter(follower__in=followings)
+        .exclude(following=user)
+        .exclude(following__in=followings)
+        .values("following_id")
+        .annotate(mutual_count=Count("*"))
+        .order_by("-mutual_count", "-following_id")
+        .values_list("following_id", "mutual_count")[:CANDIDATE_LIMIT]
+    )
+    if mutual:
+        return mutual
+    popular = (
+        Profile.objects.exclude(pk=user.pk)
+        .exclude(pk__in=followings)
+        .order_by("-follower_count", "-pk")
+        .values_list("pk", flat=True)[:CANDIDATE_LIMIT]
+    )
+    return dict.fromkeys(popular, 0)
+
+
+def compute(user):
+    """userのおすすめを計算し直してFollowSuggestionを入れ替える"""
+    mutual = candidates(user)
+    activity = _recent_activity(list(mutual))
+    scores = {pk: score(count, activity[pk]) for pk, count in mutual.items()}
+    # 同じスコアならcandidates()の順(共通のフォロー数やフォロワー数の多い順)のまま
+    ranked = sorted(mutual, key=scores.get, reverse=True)[:SUGGESTION_LIMIT]
+    FollowSuggestion.objects.filter(user=user).delete()
+    FollowSuggestion.objects.bulk_create(
+        FollowSuggestion(
+            user=user, suggested_id=pk, score=scores[pk], mutual_count=mutual[pk]
+        )
+        for pk in ranked
+    )
+
+
+def suggestions_for(user, limit=5):
+    """計算済みのおすすめをスコアの高い順に返す。計算したあとにフォローした人は除く"""
+    return (
+        FollowSuggestion.objects.filter(user=user)
+        .filter(
+            ~Exists(
+                FriendShip.objects.filter(
+                    follower=user, following=OuterRef("suggested")
+                )
+            )
+        )
+        .select_related("suggested")
+        .order_by("-score")[:limit]
+    )
+
+
+@receiver(post_save, sender=FriendShip)
+def friendship_is_created(sender, instance, created, **kwargs):
+    if created:
+        mark_stale([instance.follower_id])
+
+
+@receiver(post_delete, sender=FriendShip)
+def friendship_is_deleted(sender, instance, **kwargs):
+    mark_stale([instance.follower_id])
@@ -1,12 +1,38 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import SESSION_KEY
 from django.contrib.messages import get_messages
-from django.test import TestCase
+from django.contrib.sessions.models import Session
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from mysite import settings
-from tweets.models import Tweet
+from mysite import benchmark, metrics, settings
+from mysite.middleware import (
+    ReplicaStickinessMiddleware,
+    RequestMetricsMiddleware,
+    install_query_recorder,
+)
+from mysite.routers import PrimaryReplicaRouter, routing
+from tweets import timeline, trending
+from tweets.models import Like, LikeBucket, TimelineEntry, Tweet
 
-from .models import FriendShip, Profile, User
+from . import follows, graph, suggestions
+from .models import FollowSuggestion, FriendShip, Profile, User
 
 
 class SignUpTests(TestCase):
@@ -239,6 +265,46 @@ class TestHomeView(TestCase):
         )
         # 順番も一致させる必要があるみたい
 
+    def test_success_get_with_cursor(self):
+        user = User.objects.get(username="yamada")
+        # 同じ時刻のツイートがあってもidで順番が決まることを確認する
+        tweets = Tweet.objects.bulk_create(
+            [Tweet(user=user, contents=f"tweet {i}") for i in range(25)]
+        )
+        Tweet.objects.filter(pk__in=[t.pk for t in tweets[:10]]).update(
+            created_at=tweets[0].created_at
+        )
+        timeline.rebuild(user)
+        expected = list(Tweet.objects.order_by("-created_at", "-id"))
+
+        response = self.client.get(reverse("accounts:home"))
+        self.assertEquals(list(response.context["tweets_list"]), expected[:20])
+        next_cursor = response.context["next_cursor"]
+        self.assertIsNotNone(next_cursor)
+
+        response = self.client.get(reverse("accounts:home"), {"cursor": next_cursor})
+        self.assertEquals(list(response.context["tweets_list"]), expected[20:])
+        self.assertIsNone(response.context["next_cursor"])
+
+    def test_failure_get_with_invalid_cursor(self):
+        response = self.client.get(reverse("accounts:home"), {"cursor": "!!!"})
+        self.assertEquals(response.status_code, 404)
+
+    def test_success_get_with_viewer_state(self):
+        user = User.objects.get(username="yamada")
+        liked = Tweet.objects.create(user=user, contents="いいねした")
+        not_liked = Tweet.objects.create(user=user, contents="いいねしていない")
+        self.client.post(reverse("tweets:like", kwargs={"pk": liked.pk}))
+        timeline.rebuild(user)
+
+        response = self.client.get(reverse("accounts:home"))
+        state = {
+            tweet.pk: (tweet.is_liked_by_viewer, tweet.like_count)
+            for tweet in response.context["tweets_list"]
+        }
+        self.assertEquals(state, {liked.pk: (True, 1), not_liked.pk: (False, 0)})
+        self.assertNotIn("liked_list", response.context)
+
 
 class TestLoginView(TestCase):
     def setUp(self):
@@ -338,6 +404,17 @@ class TestUserProfileView(TestCase):
             Tweet.objects.filter(user=user).order_by("created_at"),
         )
 
+    def test_success_get_with_viewer_state(self):
+        user = User.objects.get(username="yamada")
+        tweet = Tweet.objects.create(user=user, contents="いいねした")
+        self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        response = self.client.get(
+            reverse("accounts:user_profile", kwargs={"pk": user.pk})
+        )
+        (tweet_in_page,) = response.context["tweets_list"]
+        self.assertTrue(tweet_in_page.is_liked_by_viewer)
+        self.assertEquals(tweet_in_page.like_count, 1)
+
     def test_failure_get_with_not_exists_user(self):
         response = self.client.get(
             reverse("accounts:user_profile", kwargs={"pk": 1000})
@@ -458,6 +535,11 @@ class TestFollowView(TestCase):
         message = str(messages[0])
         self.assertEquals(message, f"{self.user2.username}は既にフォローしてるだろ！！！！")
 
+    def test_failure_create_duplicated_friendship(self):
+        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        with self.assertRaises(IntegrityError):
+            FriendShip.objects.create(follower=self.user1, following=self.user2)
+
 
 class TestUnfollowView(TestCase):
     def setUp(self):
@@ -553,3 +635,675 @@ class TestFollowerListView(TestCase):
         )
         self.assertEquals(response.status_code, 200)
         self.assertTemplateUsed(response, "accounts/follower_list.html")
+
+
+class TestFriendShipListPagination(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.viewer = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.others = [
+            User.objects.create_user(username=f"user{i}", password="wasuretene1108")
+            for i in range(5)
+        ]
+        FriendShip.objects.create(follower=self.viewer, following=self.owner)
+        for other in self.others:
+            FriendShip.objects.create(follower=other, following=self.owner)
+            FriendShip.objects.create(follower=self.owner, following=other)
+        # 閲覧者はuser0をフォローしていて、user1にフォローされている
+        FriendShip.objects.create(follower=self.viewer, following=self.others[0])
+        FriendShip.objects.create(follower=self.others[1], following=self.viewer)
+        self.client.login(username="satou", password="wasuretene1108")
+
+    def test_follower_pages(self):
+        usernames = []
+        cursor = None
+        while True:
+            rows, cursor = follows.followers_page(self.owner, self.viewer, cursor, 2)
+            usernames += [row.follower.username for row in rows]
+            if cursor is None:
+                break
+            self.assertEquals(len(rows), 2)
+        self.assertEquals(
+            usernames, [u.username for u in reversed(self.others)] + ["satou"]
+        )
+
+    def test_query_count_does_not_grow_with_rows(self):
+        url = reverse("accounts:follower_list", kwargs={"pk": self.owner.pk})
+        # セッション、ユーザー、プロフィール、一覧、base.htmlのuser.profile
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEquals(len(response.context["follower_list"]), 6)
+        self.assertContains(response, "フォローされています", count=1)
+
+    def test_annotations(self):
+        rows = {
+            row["username"]: row
+            for row in self.client.get(
+                reverse("accounts:api_following_list", kwargs={"pk": self.owner.pk})
+            ).json()["users"]
+        }
+        self.assertEquals(len(rows), 5)
+        self.assertTrue(rows["user0"]["is_followed_by_viewer"])
+        self.assertFalse(rows["user0"]["follows_viewer"])
+        self.assertFalse(rows["user1"]["is_followed_by_viewer"])
+        self.assertTrue(rows["user1"]["follows_viewer"])
+        self.assertFalse(rows["user2"]["is_followed_by_viewer"])
+        self.assertFalse(rows["user2"]["follows_viewer"])
+
+    def test_bad_cursor_and_missing_profile(self):
+        url = reverse("accounts:follower_list", kwargs={"pk": self.owner.pk})
+        self.assertEquals(self.client.get(url, {"cursor": "壊れた"}).status_code, 404)
+        url = reverse("accounts:api_follower_list", kwargs={"pk": self.owner.pk})
+        self.assertEquals(self.client.get(url, {"cursor": "壊れた"}).status_code, 400)
+        url = reverse("accounts:api_follower_list", kwargs={"pk": 9999})
+        self.assertEquals(self.client.get(url).status_code, 404)
+
+
+class TestProfileCounts(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user2 = User.objects.create_user(
+            username="satou", email="asaka@test.com", password="wasurenaide1111"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+
+    def counts(self, user):
+        profile = Profile.objects.get(user=user)
+        return (profile.follower_count, profile.following_count, profile.tweet_count)
+
+    def test_follow_and_unfollow(self):
+        self.client.post(reverse("accounts:follow", kwargs={"username": "satou"}))
+        self.assertEquals(self.counts(self.user1), (0, 1, 0))
+        self.assertEquals(self.counts(self.user2), (1, 0, 0))
+
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": "satou"}))
+        self.assertEquals(self.counts(self.user1), (0, 0, 0))
+        self.assertEquals(self.counts(self.user2), (0, 0, 0))
+
+    def test_tweet_create_and_delete(self):
+        self.client.post(reverse("tweets:create"), {"contents": "ワンピース"})
+        self.assertEquals(self.counts(self.user1), (0, 0, 1))
+
+        tweet = Tweet.objects.get(contents="ワンピース")
+        self.client.post(reverse("tweets:delete", kwargs={"pk": tweet.pk}))
+        self.assertEquals(self.counts(self.user1), (0, 0, 0))
+
+    def test_cascade_delete(self):
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        self.assertEquals(self.counts(self.user1), (1, 0, 0))
+        self.user2.delete()
+        self.assertEquals(self.counts(self.user1), (0, 0, 0))
+
+    def test_profile_view_reads_counts_from_profile(self):
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        response = self.client.get(
+            reverse("accounts:user_profile", kwargs={"pk": self.user1.pk})
+        )
+        self.assertContains(response, "1人：フォロワー覧")
+        self.assertContains(response, "0人：フォロ一覧")
+
+    def test_reconcile_profile_counts(self):
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        Tweet.objects.create(user=self.user1, contents="ワンピース")
+        Profile.objects.update(follower_count=10, following_count=10, tweet_count=10)
+
+        call_command("reconcile_profile_counts", batch_size=1)
+
+        self.assertEquals(self.counts(self.user1), (1, 0, 1))
+        self.assertEquals(self.counts(self.user2), (0, 1, 0))
+
+
+class TestCreateTweets(TestCase):
+    def setUp(self):
+        User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+
+    def test_create_all(self):
+        call_command(
+            "create_tweets",
+            users=9,
+            tweets=50,
+            likes=40,
+            follows=30,
+            batch_size=7,
+            seed=1,
+            # 全部のいいねがトレンドの窓(1時間)に入るようにする
+            days=0.01,
+        )
+
+        self.assertEquals(User.objects.count(), 10)
+        self.assertEquals(Profile.objects.count(), 10)
+        self.assertEquals(Tweet.objects.count(), 50)
+        self.assertTrue(
+            self.client.login(username="loadtest2", password="loadtest1234")
+        )
+        likes = Like.objects.count()
+        self.assertTrue(0 < likes <= 40)
+        self.assertEquals(
+            sum(Tweet.objects.values_list("like_count", flat=True)), likes
+        )
+        follows = FriendShip.objects.count()
+        self.assertTrue(0 < follows <= 30)
+        self.assertFalse(FriendShip.objects.filter(follower=F("following")).exists())
+        self.assertEquals(
+            sum(Profile.objects.values_list("follower_count", flat=True)), follows
+        )
+        self.assertEquals(
+            sum(Profile.objects.values_list("tweet_count", flat=True)), 50
+        )
+        self.assertEquals(
+            sum(LikeBucket.objects.values_list("count", flat=True)),
+            Like.objects.filter(created_at__gte=trending.window_start()).count(),
+        )
+
+    def test_mark_suggestions_stale(self):
+        call_command("create_tweets", users=5, tweets=0, seed=1)
+        Profile.objects.update(suggestions_stale=False)
+
+        call_command("create_tweets", tweets=0, follows=10, seed=1)
+
+        followers = set(FriendShip.objects.values_list("follower_id", flat=True))
+        self.assertTrue(followers)
+        self.assertLessEqual(
+            followers,
+            set(
+                Profile.objects.filter(suggestions_stale=True).values_list(
+                    "pk", flat=True
+                )
+            ),
+        )
+
+    def test_spread_over_days(self):
+        call_command(
+            "create_tweets", users=5, tweets=50, likes=40, days=10, batch_size=7, seed=1
+        )
+
+        created_at = list(
+            Tweet.objects.order_by("pk").values_list("created_at", flat=True)
+        )
+        self.assertEquals(created_at, sorted(created_at))
+        self.assertGreater(created_at[0], timezone.now() - datetime.timedelta(days=10))
+        self.assertLess(created_at[0], timezone.now() - datetime.timedelta(days=9))
+        self.assertGreater(created_at[-1], timezone.now() - datetime.timedelta(days=1))
+        self.assertFalse(
+            Like.objects.filter(created_at__lt=F("tweet__created_at")).exists()
+        )
+
+    def test_same_seed_creates_same_data(self):
+        User.objects.create_user(
+            username="tanaka", email="tanaka@test.com", password="wasurenaide1108"
+        )
+
+        def authors():
+            call_command("create_tweets", tweets=30, seed=42, skip_timelines=True)
+            user_ids = list(Tweet.objects.order_by("pk").values_list("user", flat=True))
+            Tweet.objects.all().delete()
+            return user_ids
+
+        self.assertEquals(authors(), authors())
+
+
+class TestDeleteTweets(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user2 = User.objects.create_user(
+            username="tanaka", email="tanaka@test.com", password="wasurenaide1108"
+        )
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        self.tweets = [
+            Tweet.objects.create(user=user, contents=f"ツイート{i}")
+            for i, user in enumerate([self.user1, self.user2, self.user1, self.user1])
+        ]
+        for tweet in self.tweets:
+            timeline.fan_out(tweet)
+            Like.objects.create(user=self.user2, tweet=tweet)
+
+    def test_delete_all(self):
+        call_command("delete_tweets", batch_size=3)
+
+        self.assertFalse(Tweet.objects.exists())
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEquals(
+            list(Profile.objects.values_list("tweet_count", flat=True)), [0, 0]
+        )
+
+    def test_delete_by_user(self):
+        call_command("delete_tweets", usernames=["yamada"], batch_size=1)
+
+        self.assertEquals(list(Tweet.objects.all()), [self.tweets[1]])
+        self.assertEquals(Like.objects.get().tweet, self.tweets[1])
+        self.assertEquals(Profile.objects.get(user=self.user1).tweet_count, 0)
+        self.assertEquals(Profile.objects.get(user=self.user2).tweet_count, 1)
+
+    def test_delete_older_than(self):
+        Tweet.objects.filter(pk=self.tweets[0].pk).update(
+            created_at=timezone.make_aware(datetime.datetime(2022, 1, 1))
+        )
+
+        call_command("delete_tweets", older_than=datetime.date(2022, 1, 2))
+
+        self.assertFalse(Tweet.objects.filter(pk=self.tweets[0].pk).exists())
+        self.assertEquals(Tweet.objects.count(), 3)
+
+    def test_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.json")
+            with open(path, "w") as f:
+                json.dump(
+                    {"filters": {}, "last_pk": self.tweets[1].pk, "deleted": 2}, f
+                )
+
+            call_command("delete_tweets", checkpoint=path)
+
+            self.assertFalse(os.path.exists(path))
+        # チェックポイントより前は消し終わった扱いなので触らない
+        self.assertEquals(list(Tweet.objects.order_by("pk")), self.tweets[:2])
+
+    def test_failure_resume_with_other_filters(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.json")
+            with open(path, "w") as f:
+                json.dump({"filters": {}, "last_pk": 1, "deleted": 1}, f)
+
+            with self.assertRaises(CommandError):
+                call_command("delete_tweets", usernames=["yamada"], checkpoint=path)
+        self.assertEquals(Tweet.objects.count(), 4)
+
+
+class TestQueryCounts(TestCase):
+    def test_constant_with_data_size(self):
+        names = [
+            name
+            for name, _, url_name, _ in benchmark.SCENARIOS
+            if url_name.startswith("accounts:")
+        ]
+        report = benchmark.run([5, 30], names=names, repeat=1)
+
+        self.assertEquals(benchmark.query_count_changes(report), {})
+        for results in report["sizes"].values():
+            self.assertEquals(set(results), set(names))
+            for result in results.values():
+                self.assertLess(result["status"], 400)
+
+    def test_follow_scenario_creates_friendship(self):
+        dataset = benchmark.Dataset(5)
+        self.assertFalse(
+            FriendShip.objects.filter(
+                follower=dataset.viewer, following=dataset.not_following
+            ).exists()
+        )
+        self.client.force_login(dataset.viewer)
+
+        response = self.client.post(
+            reverse("accounts:follow", args=[dataset.not_following.username])
+        )
+
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue(
+            FriendShip.objects.filter(
+                follower=dataset.viewer, following=dataset.not_following
+            ).exists()
+        )
+
+
+class TestRequestMetrics(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.user = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse("accounts:home"))
+
+        timings = dict(
+            entry.split(";", 1) for entry in response["Server-Timing"].split(", ")
+        )
+        self.assertEquals(set(timings), {"db", "dup", "tpl", "total"})
+        self.assertRegex(timings["db"], r'^dur=[\d.]+;desc="[1-9]\d* queries"$')
+
+    def test_count_duplicate_queries(self):
+        def execute(sql, params, many, context):
+            pass
+
+        request_metrics = metrics.RequestMetrics()
+        request_metrics(execute, "SELECT %s", (1,), False, {})
+        request_metrics(execute, "SELECT %s", (2,), False, {})
+        request_metrics(execute, "SELECT %s", (1,), False, {})
+
+        self.assertEquals(request_metrics.queries, 3)
+        self.assertEquals(request_metrics.duplicates, 1)
+
+    async def test_count_queries_of_async_view(self):
+        install_query_recorder(connection=connection)
+
+        async def view(request):
+            # sync_to_asyncの先のスレッドで実行したクエリも数える
+            await sync_to_async(Tweet.objects.count)()
+            await sync_to_async(Tweet.objects.count)()
+            return HttpResponse()
+
+        response = await RequestMetricsMiddleware(view)(RequestFactory().get("/"))
+        self.assertIn('desc="2 queries"', response["Server-Timing"])
+
+    def test_aggregate_by_url_name(self):
+        for _ in range(3):
+            self.client.get(reverse("accounts:home"))
+        self.client.get(reverse("accounts:user_profile", kwargs={"pk": self.user.pk}))
+
+        snapshot = metrics.registry.snapshot()
+        self.assertEquals(snapshot["accounts:home"]["count"], 3)
+        self.assertEquals(sum(snapshot["accounts:home"]["histogram_ms"].values()), 3)
+        self.assertEquals(snapshot["accounts:user_profile"]["count"], 1)
+        self.assertGreater(snapshot["accounts:home"]["queries"]["p50"], 0)
+
+    def test_success_get_metrics_as_staff(self):
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.client.get(reverse("accounts:home"))
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEquals(response.status_code, 200)
+        self.assertIn("accounts:home", response.json()["views"])
+
+    def test_failure_get_metrics_as_not_staff(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEquals(response.status_code, 302)
+
+
+class TestDatabaseSettings(TestCase):
+    def test_sqlite_pragmas(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            # 1 = NORMAL
+            self.assertEquals(cursor.fetchone()[0], 1)
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEquals(cursor.fetchone()[0], 20000)
+
+    def test_conn_max_age_by_entry_point(self):
+        def conn_max_age(module):
+            env = {k: v for k, v in os.environ.items() if k != "DATABASE_CONN_MAX_AGE"}
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    f"import {module}; from django.conf import settings; "
+                    "print(settings.DATABASES['default']['CONN_MAX_AGE'])",
+                ],
+                cwd=settings.BASE_DIR,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            return int(output)
+
+        # ASGIではリクエストごとにスレッドが変わって接続を使い回せないので持続的な接続を使わない
+        self.assertEquals(conn_max_age("mysite.asgi"), 0)
+        self.assertEquals(conn_max_age("mysite.wsgi"), 60)
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_route_reads_to_replica(self):
+        router = PrimaryReplicaRouter()
+
+        with routing():
+            self.assertEquals(router.db_for_read(Tweet), "replica")
+            self.assertEquals(router.db_for_read(Profile), "replica")
+            self.assertEquals(router.db_for_read(Session), "default")
+            self.assertEquals(router.db_for_write(Tweet), "default")
+        self.assertTrue(router.allow_migrate("default", "tweets"))
+        self.assertFalse(router.allow_migrate("replica", "tweets"))
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_route_reads_to_default_outside_request(self):
+        # 管理コマンドやwrite-behindのスレッドは、読んだ結果を書き込むのでdefaultから読む
+        self.assertEquals(PrimaryReplicaRouter().db_for_read(Tweet), "default")
+
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(PrimaryReplicaRouter().db_for_read(Tweet))
+        )
+        with routing():
+            thread.start()
+            thread.join()
+        self.assertEquals(result, ["default"])
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_route_reads_to_default_without_replica(self):
+        self.assertEquals(PrimaryReplicaRouter().db_for_read(Tweet), "default")
+
+
+@override_settings(DATABASE_REPLICAS=["replica1", "replica2"], REPLICA_PIN_SECONDS=10)
+class TestReplicaStickiness(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.router = PrimaryReplicaRouter()
+
+    def run_middleware(self, request, write=False):
+        """ビューの中でTweetを読んだときの振り分け先とレスポンスを返す"""
+        routed = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(Tweet)
+            routed.append(self.router.db_for_read(Tweet))
+            return HttpResponse()
+
+        response = ReplicaStickinessMiddleware(view)(request)
+        return routed[0], response
+
+    def test_read_from_replica(self):
+        db, response = self.run_middleware(self.factory.get("/"))
+
+        self.assertIn(db, ["replica1", "replica2"])
+        self.assertNotIn("pin_primary", response.cookies)
+
+    def test_pin_after_write(self):
+        db, response = self.run_middleware(self.factory.post("/"), write=True)
+
+        self.assertEquals(db, "default")
+        self.assertEquals(response.cookies["pin_primary"]["max-age"], 10)
+
+        request = self.factory.get("/")
+        request.COOKIES["pin_primary"] = response.cookies["pin_primary"].value
+        db, _ = self.run_middleware(request)
+        self.assertEquals(db, "default")
+
+    def test_read_from_primary_after_write_in_same_request(self):
+        db, response = self.run_middleware(self.factory.get("/"), write=True)
+
+        self.assertEquals(db, "default")
+        self.assertIn("pin_primary", response.cookies)
+
+    def test_not_pin_after_post_without_write(self):
+        _, response = self.run_middleware(self.factory.post("/"))
+
+        self.assertNotIn("pin_primary", response.cookies)
+
+    async def test_pin_after_write_in_async_view(self):
+        async def view(request):
+            await sync_to_async(self.router.db_for_write)(Tweet)
+            return HttpResponse()
+
+        response = await ReplicaStickinessMiddleware(view)(self.factory.post("/"))
+        self.assertIn("pin_primary", response.cookies)
+
+    @override_settings(DEBUG=True)
+    def test_not_adapted_under_asgi(self):
+        # どちらのミドルウェアもasyncのまま動くので、sync_to_asyncで包まれない
+        # (DEBUGのときだけ包んだことをログに出す)
+        with self.assertNoLogs("django.request", "DEBUG"):
+            ASGIHandler()
+
+    def test_read_from_replica_after_pin_expired(self):
+        request = self.factory.get("/")
+        request.COOKIES["pin_primary"] = str(int(time.time()) - 1)
+
+        db, _ = self.run_middleware(request)
+        self.assertIn(db, ["replica1", "replica2"])
+
+
+class TestFollowSuggestions(TestCase):
+    def setUp(self):
+        self.users = {
+            name: User.objects.create_user(username=name, password="wasuretene1108")
+            for name in ["yamada", "satou", "suzuki", "tanaka", "itou", "katou"]
+        }
+        u = self.users
+        # yamada -> satou, suzuki
+        # satou -> tanaka, itou / suzuki -> tanaka, katou
+        for follower, following in [
+            ("yamada", "satou"),
+            ("yamada", "suzuki"),
+            ("satou", "tanaka"),
+            ("satou", "itou"),
+            ("suzuki", "tanaka"),
+            ("suzuki", "katou"),
+            ("suzuki", "yamada"),
+        ]:
+            FriendShip.objects.create(follower=u[follower], following=u[following])
+
+    def suggested(self, name):
+        return [
+            s.suggested.username
+            for s in suggestions.suggestions_for(self.users[name], limit=10)
+        ]
+
+    def test_friends_of_friends_ranked_by_mutual_count_and_activity(self):
+        Tweet.objects.create(user=self.users["katou"], contents="最近のツイート")
+        call_command("compute_follow_suggestions")
+
+        # tanakaは2人から、katouは最近ツイートしている、itouは何もしていない
+        self.assertEquals(self.suggested("yamada"), ["tanaka", "katou", "itou"])
+        tanaka = FollowSuggestion.objects.get(
+            user=self.users["yamada"], suggested=self.users["tanaka"]
+        )
+        self.assertEquals(tanaka.mutual_count, 2)
+        self.assertFalse(Profile.objects.filter(suggestions_stale=True).exists())
+
+    def test_new_user_gets_popular_users(self):
+        self.users["newbie"] = User.objects.create_user(username="newbie")
+        call_command("compute_follow_suggestions")
+        # まだ誰もフォローしていないので、フォロワーが一番多いtanakaから
+        self.assertEquals(self.suggested("newbie")[0], "tanaka")
+
+    def test_only_changed_neighbourhood_is_recomputed(self):
+        call_command("compute_follow_suggestions")
+        FriendShip.objects.create(
+            follower=self.users["satou"], following=self.users["katou"]
+        )
+        stale = set(
+            Profile.objects.filter(suggestions_stale=True).values_list(
+                "user__username", flat=True
+            )
+        )
+        # satou本人と、satouをフォローしているyamadaだけ
+        self.assertEquals(stale, {"satou", "yamada"})
+
+        call_command("compute_follow_suggestions")
+        self.assertEquals(self.suggested("yamada")[0], "katou")
+
+    def test_followed_users_are_hidden_until_recomputed(self):
+        call_command("compute_follow_suggestions")
+        FriendShip.objects.create(
+            follower=self.users["yamada"], following=self.users["tanaka"]
+        )
+        self.assertNotIn("tanaka", self.suggested("yamada"))
+
+    def test_home_shows_suggestions(self):
+        call_command("compute_follow_suggestions")
+        self.client.login(username="yamada", password="wasuretene1108")
+        response = self.client.get(reverse("accounts:home"))
+        self.assertContains(response, "おすすめユーザー")
+        self.assertEquals(
+            [s.suggested.username for s in response.context["follow_suggestions"]],
+            ["tanaka", "katou", "itou"],
+        )
+
+
+class TestFollowGraph(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.user3 = User.objects.create_user(
+            username="suzuki", email="suzuki@test.com", password="wasuretene1108"
+        )
+        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        FriendShip.objects.create(follower=self.user3, following=self.user2)
+
+    def test_lookups(self):
+        g = graph.FollowGraph(sorted([(1, 2), (1, 3), (2, 1), (3, 2), (3, 4)]))
+        self.assertTrue(g.follows(1, 3))
+        self.assertFalse(g.follows(3, 1))
+        self.assertFalse(g.follows(5, 1))
+        self.assertEquals(g.following(1), [2, 3])
+        self.assertEquals(g.followers(2), [1, 3])
+        self.assertEquals((g.following_count(3), g.follower_count(4)), (2, 1))
+        self.assertEquals(g.mutual_follows(1), [2])
+        self.assertEquals(g.common_following(1, 3), [2])
+
+    def test_incremental_updates_and_compaction(self):
+        g = graph.FollowGraph(sorted([(1, 2), (2, 1)]))
+        with mock.patch.object(graph, "COMPACT_AFTER", 3):
+            g.add(1, 3)
+            g.add(1, 3)
+            g.remove(1, 2)
+            self.assertEquals(g.following(1), [3])
+            self.assertEquals(g.follower_count(2), 0)
+            self.assertEquals(g.memory_usage()["pending_changes"], 2)
+            g.add(3, 1)
+            # 作り直したあとも同じ
+            self.assertEquals(g.memory_usage()["pending_changes"], 0)
+            self.assertEquals(g.following(1), [3])
+            self.assertEquals(g.followers(1), [2, 3])
+            self.assertEquals(g.mutual_follows(1), [3])
+            self.assertEquals(g.memory_usage()["edges"], 3)
+
+    @override_settings(FOLLOW_GRAPH_INDEX=True)
+    def test_views_use_graph_and_follow_signals_update_it(self):
+        self.assertTrue(graph.is_following(self.user1.pk, self.user2.pk))
+        self.assertFalse(graph.is_following(self.user1.pk, self.user3.pk))
+
+        self.client.login(username="yamada", password="wasurenaide1108")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accounts:follow", kwargs={"username": "suzuki"}))
+        self.assertTrue(graph.get_graph().follows(self.user1.pk, self.user3.pk))
+        response = self.client.get(
+            reverse("accounts:user_profile", kwargs={"pk": self.user3.pk})
+        )
+        self.assertTrue(response.context["has_following_connection"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accounts:unfollow", kwargs={"username": "satou"}))
+        self.assertFalse(graph.get_graph().follows(self.user1.pk, self.user2.pk))
+        self.assertEquals(graph.get_graph().follower_count(self.user2.pk), 1)
+
+    @override_settings(FOLLOW_GRAPH_INDEX=True)
+    def test_rolled_back_follow_is_not_indexed(self):
+        graph.get_graph()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                FriendShip.objects.create(follower=self.user1, following=self.user3)
+                transaction.set_rollback(True)
+        self.assertEquals(callbacks, [])
+        self.assertFalse(graph.is_following(self.user1.pk, self.user3.pk))
+
+    def test_command(self):
+        call_command("follow_graph", lookups=10)
@@ -27,6 +27,16 @@ urlpatterns = [
         views.FollowerListView.as_view(),
         name="follower_list",
     ),
+    path(
+        "api/<int:pk>/following_list/",
+        views.FollowingListApiView,
+        name="api_following_list",
+    ),
+    path(
+        "api/<int:pk>/follower_list/",
+        views.FollowerListApiView,
+        name="api_follower_list",
+    ),
     path("<str:username>/follow/", views.FollowView.as_view(), name="follow"),
     path("<str:username>/unfollow/", views.UnFollowView.as_view(), name="unfollow"),
 ]
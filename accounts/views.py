@@ -1,11 +1,14 @@
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.views import LoginView, LogoutView
-from django.http import Http404, HttpResponseRedirect
+from django.db import transaction
+from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
 from django.views import View
+from django.views.decorators.http import require_GET
 from django.views.generic import (
     CreateView,
     DetailView,
@@ -14,11 +17,16 @@ from django.views.generic import (
     UpdateView,
 )
 
-from tweets.models import Like, Tweet
+from tweets import fragments, timeline, writebehind
+from tweets.models import Tweet
+from tweets.pagination import CursorPaginationMixin, paginate_by_cursor
 
+from . import follows, graph, suggestions
 from .forms import LoginForm, ProfileForm, SignupForm
 from .models import FriendShip, Profile, User
 
+API_PAGE_SIZE = 50
+
 
 class SignupView(CreateView):
     model = User
@@ -57,13 +65,21 @@ class UserProfileView(LoginRequiredMixin, DetailView):
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
         user = self.object.user
-        context["tweets_list"] = Tweet.objects.select_related("user").filter(user=user)
-        context["following_count"] = FriendShip.objects.filter(follower=user).count()
-        context["follower_count"] = FriendShip.objects.filter(following=user).count()
-        context["has_following_connection"] = (
-            FriendShip.objects.select_related("follower", "following")
-            .filter(follower=self.request.user, following=user)
-            .exists()
+        tweets = (
+            Tweet.objects.select_related("user")
+            .filter(user=user)
+            .with_viewer_state(self.request.user)
+        )
+        try:
+            tweets, context["next_cursor"] = paginate_by_cursor(
+                tweets, self.request.GET.get("cursor")
+            )
+        except ValueError:
+            raise Http404("不正なカーソルです")
+        context["tweets_list"] = fragments.attach_tweet_versions(tweets)
+        context["profile_version"] = fragments.get_profile_version(self.object.pk)
+        context["has_following_connection"] = graph.is_following(
+            self.request.user.pk, user.pk
         )
 
         return context
@@ -83,21 +99,28 @@ class UserProfileEditView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return current_user.pk == self.kwargs["pk"]
 
 
-class HomeView(LoginRequiredMixin, ListView):
+class HomeView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = Tweet
     template_name = "accounts/home.html"
     context_object_name = "tweets_list"
+    paginate_by = 20
 
     def get_queryset(self):
         return Tweet.objects.all().select_related("user")
 
-    def get_context_data(self, *args, **kwargs):
-        context = super().get_context_data(*args, **kwargs)
-        user = self.request.user
-
-        context["liked_list"] = Like.objects.filter(user=user).values_list(
-            "tweet", flat=True
+    def get_cursor_page(self, queryset, cursor, page_size):
+        # フォローしているユーザーのツイートだけをタイムラインテーブルから読む
+        tweets, next_cursor = timeline.home_timeline(
+            self.request.user, cursor, page_size
+        )
+        tweets = fragments.attach_tweet_versions(
+            tweets.with_viewer_state(self.request.user)
         )
+        return tweets, next_cursor
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["follow_suggestions"] = suggestions.suggestions_for(self.request.user)
         return context
 
 
@@ -117,11 +140,18 @@ class FollowView(LoginRequiredMixin, View):
         if follower == following:
             messages.warning(request, "自分自身はフォローできない")
             return render(request, "accounts/home.html", status=200)
-        elif FriendShip.objects.filter(follower=follower, following=following).exists():
+        elif graph.is_following(follower.pk, following.pk):
             messages.warning(request, f"{following.username}は既にフォローしてるだろ！！！！")
             return render(request, "accounts/home.html", status=200)
         else:
-            FriendShip.objects.get_or_create(follower=follower, following=following)
+            if writebehind.is_enabled():
+                writebehind.enqueue(writebehind.FOLLOW, follower.pk, following.pk)
+            else:
+                with transaction.atomic():
+                    FriendShip.objects.get_or_create(
+                        follower=follower, following=following
+                    )
+                    timeline.backfill(follower, following)
             messages.info(request, f"あなたは{following.username}をフォローしました")
         return HttpResponseRedirect(reverse("accounts:home"))
 
@@ -138,41 +168,83 @@ class UnFollowView(LoginRequiredMixin, View):
         if follower == following:
             messages.warning(request, "自分自身のフォローを外せません")
             return render(request, "accounts/home.html", status=200)
-        elif FriendShip.objects.filter(follower=follower, following=following).exists():
-            FriendShip.objects.filter(follower=follower, following=following).delete()
+        elif graph.is_following(follower.pk, following.pk):
+            if writebehind.is_enabled():
+                writebehind.enqueue(writebehind.UNFOLLOW, follower.pk, following.pk)
+            else:
+                with transaction.atomic():
+                    FriendShip.objects.filter(
+                        follower=follower, following=following
+                    ).delete()
+                    timeline.prune(follower, following)
             messages.success(request, f"あなたは{following.username}のフォローを外しました")
         else:
             messages.warning(request, f"もともと{following.username}をフォローをしてねえから。わかったかクソガキ")
         return HttpResponseRedirect(reverse("accounts:home"))
 
 
-class FollowerListView(LoginRequiredMixin, DetailView):
-    template_name = "accounts/follower_list.html"
+class FriendShipListView(LoginRequiredMixin, DetailView):
+    """
+    ?cursor=...でページングするフォロワー/フォロー一覧。
+    1ページ分はサブクラスのpage(follows.pyの関数)で取る
+    """
+
     model = Profile
+    paginate_by = 20
 
     def get_queryset(self):
         return super().get_queryset().select_related("user")
 
     def get_context_data(self, *args, **kwargs):
-        user = self.object.user
         context = super().get_context_data(*args, **kwargs)
-        context["follower_list"] = FriendShip.objects.select_related("follower").filter(
-            following=user
-        )
+        try:
+            rows, next_cursor = self.page(
+                self.object.user,
+                self.request.user,
+                self.request.GET.get("cursor"),
+                self.paginate_by,
+            )
+        except ValueError:
+            raise Http404("不正なカーソルです")
+        context[self.context_list_name] = rows
+        context["next_cursor"] = next_cursor
         return context
 
 
-class FollowingListView(LoginRequiredMixin, DetailView):
+class FollowerListView(FriendShipListView):
+    template_name = "accounts/follower_list.html"
+    context_list_name = "follower_list"
+    page = staticmethod(follows.followers_page)
+
+
+class FollowingListView(FriendShipListView):
     template_name = "accounts/following_list.html"
-    model = Profile
+    context_list_name = "following_list"
+    page = staticmethod(follows.following_page)
 
-    def get_queryset(self):
-        return super().get_queryset().select_related("user")
 
-    def get_context_data(self, *args, **kwargs):
-        user = self.object.user
-        context = super().get_context_data(*args, **kwargs)
-        context["following_list"] = FriendShip.objects.select_related(
-            "following"
-        ).filter(follower=user)
-        return context
+def friendship_page_json(request, pk, page, other):
+    """無限スクロール用。カーソルが壊れていれば400"""
+    if not Profile.objects.filter(pk=pk).exists():
+        raise Http404
+    try:
+        rows, next_cursor = page(
+            User(pk=pk), request.user, request.GET.get("cursor"), API_PAGE_SIZE
+        )
+    except ValueError:
+        return JsonResponse({"error": "不正なカーソルです"}, status=400)
+    return JsonResponse(
+        {"users": follows.serialise(rows, other), "next_cursor": next_cursor}
+    )
+
+
+@require_GET
+@login_required
+def FollowerListApiView(request, pk):
+    return friendship_page_json(request, pk, follows.followers_page, "follower")
+
+
+@require_GET
+@login_required
+def FollowingListApiView(request, pk):
+    return friendship_page_json(request, pk, follows.following_page, "following")
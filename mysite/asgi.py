@@ -9,8 +9,16 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+# ASGIでは同期のビューやDBアクセスがリクエストごとに新しいスレッドで動くので、接続を
+# 使い回せずに開いたままの接続がたまる。指定がなければ持続的な接続を使わない
+os.environ.setdefault("DATABASE_CONN_MAX_AGE", "0")
 
-application = get_asgi_application()
+# get_asgi_application()と同じ手順で、チャットのストリーミングを流せるハンドラーを使う
+django.setup(set_prefix=False)
+
+from mysite.streaming import AsyncStreamingASGIHandler  # noqa: E402
+
+application = AsyncStreamingASGIHandler()
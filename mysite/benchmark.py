@@ -0,0 +1,228 @@
+"""
+ビューごとのクエリ数・処理時間・メモリのピークを測るベンチマーク。
+
+データの量を変えて同じURLを叩き、クエリ数がデータ量によって変わらないこと(N+1がないこと)を
+テストとmanage.py benchmarkの両方から確かめる。結果はJSONにしてコミット間で比べられるようにする
+"""
+
+import contextlib
+import io
+import statistics
+import time
+import tracemalloc
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import FriendShip, Profile, User
+from tweets import tags, trending
+from tweets.chat import ChatBackend
+from tweets.models import Like, Tweet
+
+PASSWORD = "benchmark1234"
+
+# ハッシュタグとメンションのシナリオで読むツイートの本文
+TAGGED_CONTENTS = "#benchmark @benchmark"
+
+# 閲覧者がフォローする人数の上限
+MAX_FOLLOWING = 100
+
+
+class Dataset:
+    """size人分のデータを作り、各シナリオで使う閲覧者・相手・ツイートを決める"""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        # create_tweetsとrebuild_timelinesの出力は要らない
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.viewer = User.objects.create_user(
+                username="benchmark", email="benchmark@example.com", password=PASSWORD
+            )
+            call_command(
+                "create_tweets", users=size, tweets=0, seed=seed, skip_timelines=True
+            )
+            following_ids = (
+                User.objects.exclude(pk=self.viewer.pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:MAX_FOLLOWING]
+            )
+            FriendShip.objects.bulk_create(
+                FriendShip(follower=self.viewer, following_id=pk)
+                for pk in following_ids
+            )
+            call_command(
+                "create_tweets",
+                tweets=size * 5,
+                likes=size * 5,
+                follows=size * 3,
+                seed=seed,
+            )
+        # タグとメンションのページ用に、閲覧者以外の全員が1つずつタグ付きでツイートする
+        Tweet.objects.bulk_create(
+            Tweet(user_id=pk, contents=TAGGED_CONTENTS)
+            for pk in User.objects.exclude(pk=self.viewer.pk).values_list(
+                "pk", flat=True
+            )
+        )
+        tags.save_tags(Tweet.objects.filter(contents=TAGGED_CONTENTS))
+        Tweet.objects.create(user=self.viewer, contents="benchmark")
+        # 一番ツイートしている人と、一番いいねされているツイートを相手にする
+        self.other = (
+            Profile.objects.exclude(pk=self.viewer.pk)
+            .select_related("user")
+            .order_by("-tweet_count", "pk")
+            .first()
+            .user
+        )
+        self.tweet = Tweet.objects.order_by("-like_count", "pk").first()
+        self.own_tweet = Tweet.objects.filter(user=self.viewer).first()
+        # create_tweetsのフォローは乱数なので、閲覧者がフォローしていない人を別に作っておく
+        self.not_following = User.objects.create_user(
+            username="benchmark_stranger", email="stranger@example.com"
+        )
+        Tweet.objects.create(user=self.not_following, contents="benchmark")
+        Like.objects.get_or_create(user=self.viewer, tweet=self.tweet)
+        # 前のデータセットのランキングがキャッシュに残らないように計算し直す
+        trending.refresh()
+
+
+# (名前, メソッド, URL名, datasetからURLの引数を作る関数)
+SCENARIOS = [
+    ("welcome", "get", "accounts:welcome", None),
+    ("signup", "get", "accounts:signup", None),
+    ("login", "get", "accounts:login", None),
+    ("home", "get", "accounts:home", None),
+    ("logout", "get", "accounts:logout", None),
+    ("user_profile", "get", "accounts:user_profile", lambda d: [d.other.pk]),
+    ("user_profile_edit", "get", "accounts:user_profile_edit", lambda d: [d.viewer.pk]),
+    ("following_list", "get", "accounts:following_list", lambda d: [d.viewer.pk]),
+    ("follower_list", "get", "accounts:follower_list", lambda d: [d.other.pk]),
+    (
+        "api_following_list",
+        "get",
+        "accounts:api_following_list",
+        lambda d: [d.viewer.pk],
+    ),
+    (
+        "api_follower_list",
+        "get",
+        "accounts:api_follower_list",
+        lambda d: [d.other.pk],
+    ),
+    ("follow", "post", "accounts:follow", lambda d: [d.not_following.username]),
+    ("unfollow", "post", "accounts:unfollow", lambda d: [d.other.username]),
+    ("tweet_create", "get", "tweets:create", None),
+    ("chat", "get", "tweets:chat", None),
+    ("tweet_detail", "get", "tweets:detail", lambda d: [d.tweet.pk]),
+    ("tweet_delete", "post", "tweets:delete", lambda d: [d.own_tweet.pk]),
+    ("like", "post", "tweets:like", lambda d: [d.tweet.pk]),
+    ("unlike", "post", "tweets:unlike", lambda d: [d.tweet.pk]),
+    ("api_home", "get", "tweets:api_home", None),
+    ("api_user_timeline", "get", "tweets:api_user_timeline", lambda d: [d.other.pk]),
+    ("api_detail", "get", "tweets:api_detail", lambda d: [d.tweet.pk]),
+    ("chat_stream", "post", "tweets:chat_stream", None),
+    ("search", "get", "tweets:search", None),
+    ("api_search", "get", "tweets:api_search", None),
+    ("hashtag", "get", "tweets:hashtag", lambda d: ["benchmark"]),
+    ("api_hashtag", "get", "tweets:api_hashtag", lambda d: ["benchmark"]),
+    ("mentions", "get", "tweets:mentions", None),
+    ("api_mentions", "get", "tweets:api_mentions", None),
+    ("trending", "get", "tweets:trending", None),
+]
+
+# リクエストに付けるデータ(GETならクエリ文字列、POSTならフォーム)。{シナリオ名: 値}
+REQUEST_DATA = {
+    "chat_stream": {"sentence": "benchmark"},
+    # create_tweetsのツイートは全部「Tweet n」なので、データ量に比例してヒットする
+    "search": {"q": "Tweet"},
+    "api_search": {"q": "Tweet"},
+}
+
+
+class BenchmarkChatBackend(ChatBackend):
+    """上流には繋がずに決まったトークンを返す。ストリームを最後まで読んでも外に出ない"""
+
+    TOKENS = ["bench", "mark"]
+
+    def __init__(self, **options):
+        pass
+
+    async def stream(self, messages):
+        for token in self.TOKENS:
+            yield token
+
+
+def measure(client, method, url, data=None):
+    """
+    1リクエスト分を測る。書き込むビューもあるので最後にロールバックして元に戻す。
+    ストリーミングのレスポンスは最後まで読んだところまでを測る
+    """
+    with transaction.atomic():
+        tracemalloc.start()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, data)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        transaction.set_rollback(True)
+    return {
+        "status": response.status_code,
+        "queries": len(queries),
+        "time_ms": elapsed * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+
+@override_settings(CHAT_BACKEND="mysite.benchmark.BenchmarkChatBackend")
+def run_scenarios(dataset, names=None, repeat=3):
+    """{シナリオ名: 結果}を返す。時間とメモリは中央値、クエリ数は全回で同じはずなので最後の回"""
+    client = Client()
+    results = {}
+    for name, method, url_name, make_args in SCENARIOS:
+        if names is not None and name not in names:
+            continue
+        url = reverse(url_name, args=make_args(dataset) if make_args else None)
+        runs = []
+        for _ in range(repeat):
+            # logoutなどでセッションが変わるので毎回ログインし直す
+            client.force_login(dataset.viewer)
+            runs.append(measure(client, method, url, REQUEST_DATA.get(name)))
+        results[name] = {
+            "url": url,
+            "status": runs[-1]["status"],
+            "queries": [r["queries"] for r in runs],
+            "time_ms": statistics.median(r["time_ms"] for r in runs),
+            "peak_kib": statistics.median(r["peak_kib"] for r in runs),
+        }
+    return results
+
+
+def run(sizes, names=None, repeat=3, seed=0):
+    """
+    サイズごとにデータを作って測り、終わったらデータを消す。
+    データの作成も含めて1つのトランザクションの中でやり、最後にロールバックする
+    """
+    report = {"sizes": {}}
+    for size in sizes:
+        with transaction.atomic():
+            dataset = Dataset(size, seed=seed)
+            report["sizes"][str(size)] = run_scenarios(dataset, names, repeat)
+            transaction.set_rollback(True)
+    return report
+
+
+def query_count_changes(report):
+    """データ量によってクエリ数が変わったシナリオの{名前: {サイズ: クエリ数}}"""
+    changes = {}
+    by_size = report["sizes"]
+    for name in next(iter(by_size.values()), {}):
+        counts = {size: results[name]["queries"] for size, results in by_size.items()}
+        if len({tuple(c) for c in counts.values()}) > 1:
+            changes[name] = counts
+    return changes
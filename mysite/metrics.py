@@ -0,0 +1,150 @@
+"""
+リクエストごとのコストをプロセス内に集計する。
+
+RequestMetricsMiddleware(mysite/middleware.py)が1リクエストごとにRequestMetricsを作って記録し、
+終わったらURL名(accounts:homeなど)ごとにregistryへ入れる。
+リクエストに紐づかない件数(チャットのキャッシュのヒット数など)はregistry.incrementで数える。
+集計はプロセスごとなので、複数プロセスで動かしているときはプロセスごとの値になる
+"""
+
+import bisect
+import threading
+import time
+from collections import Counter, deque
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+# URL名ごとに残す直近のサンプル数。パーセンタイルはこの中から計算する
+MAX_SAMPLES = 1000
+
+# 処理時間のヒストグラムの上限(ミリ秒)。最後のバケツはそれより遅いもの全部
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class RequestMetrics:
+    """1リクエスト分。connection.execute_wrapperに渡してSQLを数える"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self._statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            # executemanyのパラメータは大きいので、SQL文だけで比べる
+            self._statements[(sql, None if many else repr(params))] += 1
+
+    @property
+    def duplicates(self):
+        """同じSQLを同じパラメータでもう一度投げた回数"""
+        return sum(count - 1 for count in self._statements.values())
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timingヘッダーの値。durはミリ秒"""
+        return ", ".join(
+            [
+                f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+                f'dup;desc="{self.duplicates} duplicate queries"',
+                f"tpl;dur={self.template_time * 1000:.1f}",
+                f"total;dur={self.total_time * 1000:.1f}",
+            ]
+        )
+
+
+def percentile(values, p):
+    """ソート済みのvaluesのpパーセンタイル(最近傍)"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class MetricsRegistry:
+    FIELDS = ("total_ms", "db_ms", "template_ms", "queries", "duplicates")
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._views = {}
+        self._counters = {}
+
+    def record(self, view_name, metrics):
+        total_ms = metrics.total_time * 1000
+        sample = (
+            total_ms,
+            metrics.db_time * 1000,
+            metrics.template_time * 1000,
+            metrics.queries,
+            metrics.duplicates,
+        )
+        with self._lock:
+            view = self._views.get(view_name)
+            if view is None:
+                view = self._views[view_name] = {
+                    "count": 0,
+                    "histogram": [0] * (len(BUCKETS_MS) + 1),
+                    "samples": deque(maxlen=self.max_samples),
+                }
+            view["count"] += 1
+            view["histogram"][bisect.bisect_left(BUCKETS_MS, total_ms)] += 1
+            view["samples"].append(sample)
+
+    def increment(self, group, name, value=1):
+        with self._lock:
+            self._counters.setdefault(group, Counter())[name] += value
+
+    def counters(self):
+        """{グループ: {名前: 件数}}"""
+        with self._lock:
+            return {group: dict(c) for group, c in sorted(self._counters.items())}
+
+    def snapshot(self):
+        """{URL名: {件数, 処理時間のヒストグラム, 項目ごとのp50/p90/p99}}"""
+        with self._lock:
+            views = {
+                name: (view["count"], list(view["histogram"]), list(view["samples"]))
+                for name, view in self._views.items()
+            }
+        result = {}
+        for name, (count, histogram, samples) in sorted(views.items()):
+            summary = {}
+            for i, field in enumerate(self.FIELDS):
+                values = sorted(sample[i] for sample in samples)
+                summary[field] = {f"p{p}": percentile(values, p) for p in (50, 90, 99)}
+                summary[field]["max"] = values[-1] if values else None
+            histogram_ms = {f"le_{bound}": n for bound, n in zip(BUCKETS_MS, histogram)}
+            histogram_ms["inf"] = histogram[-1]
+            result[name] = {"count": count, "histogram_ms": histogram_ms, **summary}
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+            self._counters.clear()
+
+
+registry = MetricsRegistry()
+
+
+@require_GET
+@staff_member_required
+def MetricsView(request):
+    return JsonResponse(
+        {
+            "views": registry.snapshot(),
+            "counters": registry.counters(),
+            "buckets_ms": BUCKETS_MS,
+        }
+    )
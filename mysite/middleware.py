@@ -0,0 +1,137 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import RequestMetrics, registry
+from .routers import routing
+
+# 今のリクエストのRequestMetrics。asyncのビューからsync_to_asyncで別のスレッドに移っても引き継がれる
+_current_metrics = ContextVar("request_metrics", default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender=None, connection=None, **kwargs):
+    """
+    接続ごとに1回だけ_record_queryを付けておく。asyncのビューのクエリは
+    別のスレッドの接続で実行されるので、リクエストのたびに付け外しはしない
+    """
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class RequestMetricsMiddleware:
+    """
+    クエリ数・DBの時間・重複したクエリ・テンプレートの描画時間・全体の時間を測り、
+    Server-Timingヘッダーで返してURL名ごとに集計する。
+    全体の時間に他のミドルウェアも含めるため、MIDDLEWAREの先頭に置く。
+    ASGIではasyncのまま動くので、asyncのビューの前にスレッドを取らない
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        # すでに開いている接続(テストなど)には、まだ付いていないことがある
+        for connection in connections.all():
+            install_query_recorder(connection=connection)
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        return self.finish(request, response)
+
+    def start(self, request):
+        request.metrics = RequestMetrics()
+        return _current_metrics.set(request.metrics)
+
+    def finish(self, request, response):
+        match = request.resolver_match
+        registry.record(match.view_name if match else "<unresolved>", request.metrics)
+        response["Server-Timing"] = request.metrics.server_timing()
+        return response
+
+    def process_template_response(self, request, response):
+        # TemplateResponseを返すビュー(クラスベースのビュー)だけ、描画時間を測れる
+        started = time.perf_counter()
+
+        def rendered(response):
+            request.metrics.template_time += time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+class ReplicaStickinessMiddleware:
+    """
+    レプリカの遅れで自分の変更が見えなくならないようにする。
+    GET/HEADなど以外のリクエストはdefaultだけを使い、書き込みがあればクッキーを付けて
+    REPLICA_PIN_SECONDS秒のあいだその人の読み込みもdefaultに向ける
+    """
+
+    cookie_name = "pin_primary"
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with routing(pinned=self.is_pinned(request)) as state:
+            response = self.get_response(request)
+        return self.pin(state, response)
+
+    async def __acall__(self, request):
+        # ContextVarなので、sync_to_asyncの中の書き込みも同じRoutingStateに記録される
+        with routing(pinned=self.is_pinned(request)) as state:
+            response = await self.get_response(request)
+        return self.pin(state, response)
+
+    def pin(self, state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            # 値は期限(UNIX時間)。ブラウザが期限を守らなくても古いクッキーは無視する
+            response.set_cookie(
+                self.cookie_name,
+                str(int(time.time()) + settings.REPLICA_PIN_SECONDS),
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+    def is_pinned(self, request):
+        if request.method not in ("GET", "HEAD", "OPTIONS"):
+            return True
+        try:
+            return int(request.COOKIES.get(self.cookie_name, 0)) > time.time()
+        except ValueError:
+            return False
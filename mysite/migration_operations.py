@@ -0,0 +1,73 @@
+"""
+大きなテーブルにも当てられるマイグレーション操作。
+
+PostgreSQLではCREATE INDEX CONCURRENTLYで書き込みを止めずにインデックスを作る。
+CONCURRENTLYはトランザクションの中では使えないので、これらを使うマイグレーションは
+atomic = False にすること。SQLiteなどではDjango標準の操作と同じになる
+"""
+
+from django.db import migrations
+
+
+def _is_postgresql(schema_editor):
+    return schema_editor.connection.vendor == "postgresql"
+
+
+class AddIndexOnline(migrations.AddIndex):
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if _is_postgresql(schema_editor):
+            schema_editor.add_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if _is_postgresql(schema_editor):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
+
+
+class AddUniqueConstraintOnline(migrations.AddConstraint):
+    """
+    UniqueConstraintをユニークインデックスとして作る。
+    SQLiteでAddConstraintを使うとテーブル全体を作り直してしまうのでそれを避ける。
+    PostgreSQLではインデックスを作ってからUSING INDEXで制約に昇格させる
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        quote = schema_editor.quote_name
+        table = quote(model._meta.db_table)
+        name = quote(self.constraint.name)
+        columns = ", ".join(
+            quote(model._meta.get_field(field).column)
+            for field in self.constraint.fields
+        )
+        if _is_postgresql(schema_editor):
+            schema_editor.execute(
+                f"CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({columns})"
+            )
+            schema_editor.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}"
+            )
+        else:
+            schema_editor.execute(f"CREATE UNIQUE INDEX {name} ON {table} ({columns})")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if _is_postgresql(schema_editor):
+            schema_editor.remove_constraint(model, self.constraint)
+        else:
+            schema_editor.execute(
+                f"DROP INDEX {schema_editor.quote_name(self.constraint.name)}"
+            )
@@ -0,0 +1,66 @@
+"""
+書き込みはdefaultに、accounts/tweetsの読み込みはレプリカに振り分ける。
+
+セッションや権限などDjango本体のテーブルは、書いた直後に読むのでdefaultから読む。
+書き込みのあるリクエストの中と、書き込んだ人のその後REPLICA_PIN_SECONDS秒のあいだは
+自分の変更が見えるようにdefaultから読む(ReplicaStickinessMiddleware)。
+レプリカから読むのはリクエストの中(routing()の中)だけ。管理コマンドやwrite-behindの
+スレッドは読んだ結果をそのまま書き込むので、遅れたデータを書き戻さないようにdefaultから読む。
+レプリカにはマイグレーションを流さない(プライマリから複製される前提)。
+ローカルで2つのSQLiteファイルで試すときは、マイグレーションしたdb.sqlite3をコピーして
+DATABASE_REPLICAに指定する
+"""
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+REPLICATED_APPS = {"accounts", "tweets"}
+
+
+class RoutingState:
+    def __init__(self, pinned=False):
+        # Trueならレプリカを使わない
+        self.pinned = pinned
+        # このリクエストでdefaultに書き込んだか
+        self.wrote = False
+
+
+# リクエストごとの状態。asyncのビューやsync_to_asyncの中にも引き継がれる
+_state = ContextVar("database_routing_state", default=None)
+
+
+@contextmanager
+def routing(pinned=False):
+    """この中の読み込みと書き込みをRoutingStateに記録する"""
+    state = RoutingState(pinned)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.pinned or state.wrote:
+            return "default"
+        if settings.DATABASE_REPLICAS and model._meta.app_label in REPLICATED_APPS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはdefaultと同じデータなので、どこから読んだオブジェクト同士でも関連付けてよい
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 他のミドルウェアの時間も測るので先頭に置く
+    "mysite.middleware.RequestMetricsMiddleware",
+    # セッションの保存なども書き込みとして数えるので、SessionMiddlewareより外側に置く
+    "mysite.middleware.ReplicaStickinessMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -76,10 +81,91 @@ WSGI_APPLICATION = "mysite.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
+# 既定はSQLite(mysite/sqlite3で接続ごとにWALなどのPRAGMAを設定する)。
+# DATABASE_ENGINE=postgresql でPostgreSQLにする。接続はCONN_MAX_AGE秒使い回すので、
+# それ以上のプールが要るときはPgBouncerなどを前に置く。
+# ASGI(mysite/asgi.py)では接続を使い回せないので、CONN_MAX_AGEの既定は0になる。
+# DATABASE_REPLICAに読み込み用のレプリカ(SQLiteならファイル、PostgreSQLならホスト)を指定すると、
+# タイムラインやプロフィールの読み込みはレプリカに行く(mysite/routers.py)
+
+DATABASE_ENGINES = {
+    "sqlite": "mysite.sqlite3",
+    "postgresql": "django.db.backends.postgresql",
+}
+DATABASE_ENGINE = os.environ.get("DATABASE_ENGINE", "sqlite")
+
+PRIMARY_DATABASE = {
+    "ENGINE": DATABASE_ENGINES[DATABASE_ENGINE],
+    "NAME": os.environ.get(
+        "DATABASE_NAME",
+        BASE_DIR / "db.sqlite3" if DATABASE_ENGINE == "sqlite" else "mysite",
+    ),
+    "USER": os.environ.get("DATABASE_USER", ""),
+    "PASSWORD": os.environ.get("DATABASE_PASSWORD", ""),
+    "HOST": os.environ.get("DATABASE_HOST", ""),
+    "PORT": os.environ.get("DATABASE_PORT", ""),
+    "CONN_MAX_AGE": int(os.environ.get("DATABASE_CONN_MAX_AGE", 60)),
+    # SQLiteはロックが取れるまで待つ秒数
+    "OPTIONS": {"timeout": 20} if DATABASE_ENGINE == "sqlite" else {},
+}
+
+DATABASES = {"default": PRIMARY_DATABASE}
+DATABASE_REPLICAS = []
+# カンマ区切りで複数指定すると、読み込みはレプリカにばらける
+for i, replica in enumerate(
+    filter(None, os.environ.get("DATABASE_REPLICA", "").split(",")), 1
+):
+    location = "NAME" if DATABASE_ENGINE == "sqlite" else "HOST"
+    DATABASES[f"replica{i}"] = {
+        **PRIMARY_DATABASE,
+        location: replica.strip(),
+        # テストではレプリカもdefaultと同じデータベースを見る
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(f"replica{i}")
+
+DATABASE_ROUTERS = ["mysite.routers.PrimaryReplicaRouter"]
+# 書き込んだ人はこの秒数のあいだプライマリから読む(レプリカの遅れより長くする)
+REPLICA_PIN_SECONDS = int(os.environ.get("REPLICA_PIN_SECONDS", 10))
+
+# いいね/フォローをキューに溜めてまとめて書き込む(tweets/writebehind.py)。Noneなら直接書き込む。
+# WRITE_BEHIND=memory はプロセス内のキューをflush_interval秒ごとに反映する。
+# WRITE_BEHIND=file はWRITE_BEHIND_LOCATIONのファイルに積み、flush_write_behindコマンドで反映する
+WRITE_BEHIND = None
+if os.environ.get("WRITE_BEHIND"):
+    WRITE_BEHIND = {
+        "queue": os.environ["WRITE_BEHIND"],
+        "location": os.environ.get(
+            "WRITE_BEHIND_LOCATION", str(BASE_DIR / "writebehind")
+        ),
+        "flush_interval": 1.0,
+    }
+
+# フォローしているかをプロセス内のフォローグラフ(accounts/graph.py)で判定する。
+# 更新は同じプロセスのフォローしか届かないので、複数プロセスで動かすときは有効にしない
+FOLLOW_GRAPH_INDEX = bool(os.environ.get("FOLLOW_GRAPH_INDEX"))
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# 既定はプロセスごとのローカルメモリ。複数プロセスで共有したいときは
+# CACHE_BACKEND=file (CACHE_LOCATIONにディレクトリ) や redis / memcached (CACHE_LOCATIONに接続先) を指定する
+
+CACHE_BACKENDS = {
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",
+    "file": "django.core.cache.backends.filebased.FileBasedCache",
+    "redis": "django.core.cache.backends.redis.RedisCache",
+    "memcached": "django.core.cache.backends.memcached.PyMemcacheCache",
+}
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "locmem")
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": CACHE_BACKENDS[CACHE_BACKEND],
+        "LOCATION": os.environ.get(
+            "CACHE_LOCATION",
+            str(BASE_DIR / "cache") if CACHE_BACKEND == "file" else "",
+        ),
     }
 }
 
@@ -132,3 +218,44 @@ AUTH_USER_MODEL = "accounts.User"
 LOGIN_URL = "accounts:login"
 LOGIN_REDIRECT_URL = "accounts:home"
 LOGOUT_REDIRECT_URL = "welcome:top"
+
+
+# Home timeline
+# フォロワーがこの人数以上のユーザーのツイートはfan-outせず、読み込み時に混ぜる
+TIMELINE_FANOUT_LIMIT = 10000
+# フォローした直後にタイムラインへ入れる相手のツイート数
+TIMELINE_BACKFILL_SIZE = 200
+
+# Trending
+# 直近この分数のいいねだけでトレンドを計算する
+TRENDING_WINDOW_MINUTES = 60
+# この分数たつごとに、いいねの重みを半分にする
+TRENDING_HALF_LIFE_MINUTES = 15
+# トレンドに出すツイートとハッシュタグの数
+TRENDING_TOP_K = 20
+# 計算したトレンドをキャッシュしておく秒数
+TRENDING_CACHE_SECONDS = 60
+
+# Archive
+# archive_tweetsコマンドでこの日数より古いツイートをARCHIVE_ROOTのファイルに移す(tweets/archive.py)
+TWEET_RETENTION_DAYS = int(os.environ.get("TWEET_RETENTION_DAYS", 365))
+ARCHIVE_ROOT = os.environ.get("ARCHIVE_ROOT", str(BASE_DIR / "archive"))
+
+
+# Chat
+# OpenAI互換の/chat/completionsを持つサーバーならどこにでも向けられる。APIキーは.envのAPI_KEY
+CHAT_BACKEND = "tweets.chat.OpenAIChatBackend"
+CHAT_API_BASE = os.environ.get("CHAT_API_BASE", "https://api.openai.com/v1")
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "gpt-3.5-turbo")
+CHAT_BACKEND_OPTIONS = {
+    "timeout": 30,
+    "connect_timeout": 5,
+    "max_connections": 20,
+    # 1プロセスから同時に投げるリクエストの上限
+    "max_concurrency": 10,
+}
+# 同じ質問への応答をプロセス内に取っておく。Noneにするとキャッシュしない
+CHAT_CACHE = {
+    "timeout": 60 * 60,
+    "max_entries": 1000,
+}
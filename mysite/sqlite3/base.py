@@ -0,0 +1,24 @@
+"""
+同時アクセスに強くしたSQLiteのバックエンド。
+
+接続を作るたびにPRAGMAを設定する。WALにすると読み込みが書き込みを待たなくなり、
+synchronous=NORMALはWALでは安全なまま書き込みのfsyncを減らせる
+"""
+
+from django.db.backends.sqlite3 import base
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # ロックが取れないときにすぐエラーにせず待つミリ秒
+    "busy_timeout": 20000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
@@ -0,0 +1,78 @@
+"""
+非同期イテレータを中身にするStreamingHttpResponse。
+
+Django 4.0のASGIHandlerはストリーミングレスポンスを同期的にしか回せないので、
+AsyncStreamingASGIHandler(mysite/asgi.pyで使う)がイベントループの上でasync forしながら送る。
+WSGI(runserverやテストクライアント)では新しいイベントループで1チャンクずつ取り出して返す
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.http import StreamingHttpResponse
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    def __init__(self, async_content, *args, **kwargs):
+        self.async_content = async_content
+        super().__init__(self._iterate_in_new_loop(), *args, **kwargs)
+
+    async def aiter_bytes(self):
+        iterator = self.async_content.__aiter__()
+        try:
+            async for chunk in iterator:
+                yield self.make_bytes(chunk)
+        finally:
+            # 途中で止めたときも上流への接続を閉じる
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def _iterate_in_new_loop(self):
+        iterator = self.async_content.__aiter__()
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            if hasattr(iterator, "aclose"):
+                loop.run_until_complete(iterator.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+
+class AsyncStreamingASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+
+        headers = [
+            (header.encode("ascii"), value.encode("latin1"))
+            for header, value in response.items()
+        ]
+        for cookie in response.cookies.values():
+            headers.append(
+                (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        chunks = response.aiter_bytes()
+        try:
+            async for chunk in chunks:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            # 送れなかった(クライアントが切断した)ときは例外のまま抜けて、もう送らない
+            await send({"type": "http.response.body"})
+        finally:
+            await chunks.aclose()
+            # ASGIHandlerと同じく閉じてrequest_finishedを飛ばし、古いDB接続を片付けさせる
+            await sync_to_async(response.close, thread_sensitive=True)()
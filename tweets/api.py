@@ -0,0 +1,200 @@
+"""
+タイムラインのJSON API。
+
+ETagはページに載るツイートと投稿者のフラグメントのバージョン(fragments.py)から作るので、
+If-None-Matchが一致すればツイート本体を読まずに304を返せる
+"""
+
+import hashlib
+
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET
+
+from accounts.models import User
+
+from . import fragments, search, tags, timeline
+from .models import Tweet
+from .pagination import paginate_by_cursor
+
+PAGE_SIZE = 20
+
+# モデルを作らずにvalues()で取り出す列
+TWEET_FIELDS = (
+    "id",
+    "contents",
+    "created_at",
+    "like_count",
+    "user_id",
+    "user__username",
+    "is_liked_by_viewer",
+)
+
+
+def serialise_tweets(viewer, ids):
+    """idsの順番のまま、ツイートを辞書のリストにする"""
+    rows = (
+        Tweet.objects.filter(pk__in=ids).with_viewer_state(viewer).values(*TWEET_FIELDS)
+    )
+    by_id = {row["id"]: row for row in rows}
+    tweets = []
+    for pk in ids:
+        if pk in by_id:
+            row = by_id[pk]
+            row["username"] = row.pop("user__username")
+            tweets.append(row)
+    return tweets
+
+
+def make_etag(viewer, tweet_ids, author_ids, next_cursor=None):
+    """
+    ツイート(いいね数・自分のいいねを含む)と投稿者(ユーザー名)が変わるとバージョンが変わる。
+    閲覧者ごとに中身が違うのでviewerも混ぜる
+    """
+    tweet_versions = fragments.get_versions(fragments.TWEET, tweet_ids)
+    author_versions = fragments.get_versions(fragments.PROFILE, set(author_ids))
+    parts = [str(viewer.pk), next_cursor or ""]
+    parts += [f"t{pk}:{tweet_versions[pk]}" for pk in tweet_ids]
+    parts += [f"u{pk}:{version}" for pk, version in sorted(author_versions.items())]
+    digest = hashlib.sha256("|".join(parts).encode()).hexdigest()
+    versions = list(tweet_versions.values()) + list(author_versions.values())
+    return f'"{digest}"', versions
+
+
+def conditional_json(request, etag, build_payload, last_modified=None):
+    """条件付きGETに一致すれば304を返し、そうでなければbuild_payload()でJSONを作る"""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(build_payload())
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "private, no-cache"
+    patch_vary_headers(response, ["Cookie"])
+    return response
+
+
+def latest(versions):
+    return max(map(fragments.version_time, versions), default=None)
+
+
+@require_GET
+@login_required
+def HomeTimelineApiView(request):
+    try:
+        rows, next_cursor = timeline.home_timeline_rows(
+            request.user, request.GET.get("cursor"), PAGE_SIZE
+        )
+    except ValueError:
+        return JsonResponse({"error": "不正なカーソルです"}, status=400)
+    tweet_ids = [pk for _, pk, _ in rows]
+    etag, _ = make_etag(
+        request.user, tweet_ids, [author_id for _, _, author_id in rows], next_cursor
+    )
+    # フォローしている人のツイートが消えてページの中身が入れ替わっても残ったツイートの
+    # 更新時刻は変わらないので、ホームではLast-Modifiedを返さずETagだけで判定する
+    return conditional_json(
+        request,
+        etag,
+        lambda: {
+            "tweets": serialise_tweets(request.user, tweet_ids),
+            "next_cursor": next_cursor,
+        },
+    )
+
+
+@require_GET
+@login_required
+def UserTimelineApiView(request, pk):
+    try:
+        rows, next_cursor = paginate_by_cursor(
+            Tweet.objects.filter(user_id=pk).values("created_at", "id"),
+            request.GET.get("cursor"),
+            PAGE_SIZE,
+        )
+    except ValueError:
+        return JsonResponse({"error": "不正なカーソルです"}, status=400)
+    if not rows and not User.objects.filter(pk=pk).exists():
+        raise Http404
+    tweet_ids = [row["id"] for row in rows]
+    # 投稿者のバージョンはツイートの作成・削除でも変わるので、ページの入れ替わりも検知できる
+    etag, versions = make_etag(request.user, tweet_ids, [pk], next_cursor)
+    return conditional_json(
+        request,
+        etag,
+        lambda: {
+            "tweets": serialise_tweets(request.user, tweet_ids),
+            "next_cursor": next_cursor,
+        },
+        last_modified=latest(versions),
+    )
+
+
+@require_GET
+@login_required
+def TweetApiView(request, pk):
+    author_id = Tweet.objects.filter(pk=pk).values_list("user_id", flat=True).first()
+    if author_id is None:
+        raise Http404
+    etag, versions = make_etag(request.user, [pk], [author_id])
+
+    def build_payload():
+        tweets = serialise_tweets(request.user, [pk])
+        if not tweets:
+            raise Http404
+        return tweets[0]
+
+    return conditional_json(
+        request, etag, build_payload, last_modified=latest(versions)
+    )
+
+
+def tweet_page_json(request, get_tweet_ids):
+    """get_tweet_ids(cursor, page_size)が返す1ページ分をJSONにする。カーソルが壊れていれば400"""
+    try:
+        tweet_ids, next_cursor = get_tweet_ids(request.GET.get("cursor"), PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({"error": "不正なカーソルです"}, status=400)
+    return JsonResponse(
+        {
+            "tweets": serialise_tweets(request.user, tweet_ids),
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@require_GET
+@login_required
+def SearchApiView(request):
+    """?q=...の検索結果。?order=relevanceで一致度順"""
+    order = request.GET.get("order")
+    order = order if order == search.RELEVANCE else search.RECENT
+    return tweet_page_json(
+        request,
+        lambda cursor, page_size: search.search(
+            request.GET.get("q", ""), cursor, page_size, order
+        ),
+    )
+
+
+@require_GET
+@login_required
+def HashtagApiView(request, name):
+    return tweet_page_json(
+        request,
+        lambda cursor, page_size: tags.hashtag_timeline_ids(name, cursor, page_size),
+    )
+
+
+@require_GET
+@login_required
+def MentionsApiView(request):
+    """ログインしているユーザーへの@メンション"""
+    return tweet_page_json(
+        request,
+        lambda cursor, page_size: tags.mentions_timeline_ids(
+            request.user, cursor, page_size
+        ),
+    )
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TweetsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "tweets"
+
+    def ready(self):
+        # フラグメントキャッシュの無効化と検索インデックスの更新のシグナルを登録する
+        from . import fragments, search  # noqa: F401
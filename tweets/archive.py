@@ -0,0 +1,155 @@
+"""
+古いツイートのアーカイブ(コールドストレージ)。
+
+archive_tweetsコマンドが古いツイートをいいねごとARCHIVE_ROOTの月ごとのファイル
+(YYYY-MM.jsonl.gz)に書き足して、DBからは消す。1バッチのうち同じ月の分を
+gzipの1メンバーにして末尾に足すだけなので、ファイルは書き換えない
+(gzipは複数のメンバーをつなげても1つのgzipとして読める)。
+
+消したツイートにはArchivedTweet(ファイル名とメンバーの位置)だけ残しておき、
+詳細ページはそのメンバーだけを読んで展開する。展開したものはキャッシュに入れておく
+"""
+
+import fcntl
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import ArchivedTweet, Like, Tweet
+
+# 展開したツイートをキャッシュしておく秒数
+CACHE_SECONDS = 3600
+
+
+def partition_of(created_at):
+    """created_atのツイートを入れるファイル名。月の区切りはUTC"""
+    return f"{created_at.astimezone(dt_timezone.utc):%Y-%m}.jsonl.gz"
+
+
+def _path(partition):
+    return os.path.join(settings.ARCHIVE_ROOT, partition)
+
+
+def append_member(partition, records):
+    """
+    recordsをgzipの1メンバーにしてpartitionの末尾に足し、(位置, バイト数)を返す。
+    DBから消す前にディスクまで書き出しておく
+    """
+    data = gzip.compress(
+        "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        ).encode()
+    )
+    os.makedirs(settings.ARCHIVE_ROOT, exist_ok=True)
+    with open(_path(partition), "ab") as f:
+        # 同時に書き足されても位置がずれないように、ロックしてから末尾の位置を取る
+        fcntl.flock(f, fcntl.LOCK_EX)
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return offset, len(data)
+
+
+def archive_batch(pks):
+    """
+    pksのツイートといいねをファイルに書き、ArchivedTweetを作る。DBの行は消さないので、
+    呼ぶ側が同じトランザクションで消す。コミット前に落ちるとファイルには書いたのに
+    ArchivedTweetがないメンバーが残るが、次の実行で同じツイートを書き直すので読み出しには困らない。
+    返り値は{"tweets": 件数, "likes": 件数, "raw_bytes": 圧縮前, "archived_bytes": 圧縮後}
+    """
+    # 書いたあとにプライマリの行を消すので、レプリカの遅れた行を書かないようにプライマリから読む
+    likes = defaultdict(list)
+    for tweet_id, user_id, created_at in (
+        Like.objects.using(DEFAULT_DB_ALIAS)
+        .filter(tweet_id__in=pks)
+        .values_list("tweet_id", "user_id", "created_at")
+    ):
+        likes[tweet_id].append([user_id, created_at.isoformat()])
+
+    partitions = defaultdict(list)
+    for tweet in (
+        Tweet._base_manager.using(DEFAULT_DB_ALIAS)
+        .filter(pk__in=pks)
+        .order_by("pk")
+        .values("id", "user_id", "contents", "created_at", "like_count")
+    ):
+        partitions[partition_of(tweet["created_at"])].append(tweet)
+
+    stats = {"tweets": 0, "likes": 0, "raw_bytes": 0, "archived_bytes": 0}
+    stubs = []
+    for partition, tweets in partitions.items():
+        records = [
+            {
+                **tweet,
+                "created_at": tweet["created_at"].isoformat(),
+                "likes": likes[tweet["id"]],
+            }
+            for tweet in tweets
+        ]
+        offset, length = append_member(partition, records)
+        stubs += [
+            ArchivedTweet(
+                id=tweet["id"],
+                user_id=tweet["user_id"],
+                created_at=tweet["created_at"],
+                like_count=tweet["like_count"],
+                partition=partition,
+                offset=offset,
+                length=length,
+            )
+            for tweet in tweets
+        ]
+        stats["tweets"] += len(records)
+        stats["likes"] += sum(len(record["likes"]) for record in records)
+        stats["raw_bytes"] += sum(
+            len(json.dumps(record, ensure_ascii=False).encode()) + 1
+            for record in records
+        )
+        stats["archived_bytes"] += length
+    ArchivedTweet.objects.using(DEFAULT_DB_ALIAS).bulk_create(stubs)
+    return stats
+
+
+def read_record(stub):
+    """stubのツイートをファイルから読んで、書いたときのdictで返す"""
+    with open(_path(stub.partition), "rb") as f:
+        f.seek(stub.offset)
+        data = f.read(stub.length)
+    for line in gzip.decompress(data).splitlines():
+        record = json.loads(line)
+        if record["id"] == stub.pk:
+            return record
+    raise ArchivedTweet.DoesNotExist(f"tweet {stub.pk} is not in {stub.partition}")
+
+
+def rehydrate(stub, viewer=None):
+    """
+    アーカイブしたツイートを保存しないTweetに戻す。Tweetと同じく
+    is_liked_by_viewerを付け、アーカイブ済みの印にarchived=Trueを付ける
+    """
+    key = f"archived_tweet:{stub.pk}"
+    record = cache.get(key)
+    if record is None:
+        record = read_record(stub)
+        cache.set(key, record, CACHE_SECONDS)
+    tweet = Tweet(
+        id=record["id"],
+        user=stub.user,
+        contents=record["contents"],
+        created_at=datetime.fromisoformat(record["created_at"]),
+        like_count=record["like_count"],
+    )
+    viewer_id = viewer.pk if viewer is not None and viewer.is_authenticated else None
+    tweet.is_liked_by_viewer = any(
+        user_id == viewer_id for user_id, _ in record["likes"]
+    )
+    tweet.archived = True
+    return tweet
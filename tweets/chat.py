@@ -0,0 +1,270 @@
+"""
+ChatViewから呼ぶチャットのバックエンド。
+
+settings.CHAT_BACKENDで差し替えられるので、テストではローカルに立てた偽のモデルサーバーに向けられる。
+OpenAIChatBackendはOpenAI互換の/chat/completionsをhttpxの非同期クライアントで呼び、
+同時に投げるリクエストの数をセマフォで制限する。クライアントはイベントループごとに作り、
+ループが終わるとき(shutdown_asyncgens)に閉じる。
+settings.CHAT_CACHEがあればCachedChatBackendで包み、同じ質問への応答を使い回す。
+キャッシュのヒット数などは/metrics/のcounters["chat_cache"]で見られる
+"""
+
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+
+import httpx
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from dotenv import load_dotenv
+
+from mysite.metrics import registry
+
+load_dotenv()
+
+SYSTEM_PROMPT = "日本語で応答してください"
+
+
+class ChatBackendError(Exception):
+    pass
+
+
+# 上流の応答のJSONの形がおかしいときに出る例外
+INVALID_RESPONSE_ERRORS = (ValueError, KeyError, IndexError, TypeError, AttributeError)
+
+
+def build_messages(sentence, system_prompt=SYSTEM_PROMPT):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": sentence},
+    ]
+
+
+class ChatBackend(abc.ABC):
+    @abc.abstractmethod
+    def stream(self, messages):
+        """応答をトークンが届いた順に返す非同期イテレータ"""
+
+    async def complete(self, messages):
+        return "".join([token async for token in self.stream(messages)])
+
+
+class OpenAIChatBackend(ChatBackend):
+    def __init__(
+        self,
+        api_base,
+        model,
+        api_key=None,
+        timeout=30,
+        connect_timeout=5,
+        max_connections=20,
+        max_concurrency=10,
+    ):
+        self.api_base = api_base.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self.max_concurrency = max_concurrency
+        # httpxのクライアントとセマフォはイベントループに紐づくので、ループごとに作って使い回す
+        self._pools = weakref.WeakKeyDictionary()
+
+    async def _pool(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._pools:
+            headers = {}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            client = httpx.AsyncClient(
+                base_url=self.api_base,
+                headers=headers,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+            closer = _close_on_shutdown(client)
+            await closer.__anext__()
+            self._pools[loop] = (
+                client,
+                asyncio.Semaphore(self.max_concurrency),
+                closer,
+            )
+        client, semaphore, _ = self._pools[loop]
+        return client, semaphore
+
+    async def stream(self, messages):
+        client, semaphore = await self._pool()
+        payload = {"model": self.model, "messages": messages, "stream": True}
+        try:
+            async with semaphore:
+                async with client.stream(
+                    "POST", "/chat/completions", json=payload
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        # Server-Sent Eventsの "data: {...}" 行だけを読む
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:") :].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            delta = json.loads(data)["choices"][0].get("delta", {})
+                        except INVALID_RESPONSE_ERRORS as e:
+                            raise ChatBackendError(f"invalid chunk: {data}") from e
+                        if delta.get("content"):
+                            yield delta["content"]
+        except httpx.HTTPError as e:
+            raise ChatBackendError(str(e)) from e
+
+    async def complete(self, messages):
+        client, semaphore = await self._pool()
+        payload = {"model": self.model, "messages": messages}
+        try:
+            async with semaphore:
+                response = await client.post("/chat/completions", json=payload)
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise ChatBackendError(str(e)) from e
+        try:
+            return response.json()["choices"][0]["message"]["content"]
+        except INVALID_RESPONSE_ERRORS as e:
+            raise ChatBackendError(f"invalid response: {response.text}") from e
+
+
+async def _close_on_shutdown(client):
+    """
+    一度進めておくと、ループのshutdown_asyncgens(asyncio.runやasync_to_syncが終わるときに
+    呼ばれる)でfinallyが走ってclientを閉じる。WSGIではリクエストごとにループを作って捨てるので、
+    こうしないとクライアントが閉じられずに残る
+    """
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+
+def normalise(sentence):
+    """全角・半角や空白の違いだけの質問を同じものとして扱う"""
+    return " ".join(unicodedata.normalize("NFKC", sentence).split())
+
+
+class CachedChatBackend(ChatBackend):
+    """
+    応答をプロセス内にキャッシュする。件数の上限を超えると最後に使われたのが古いものから捨てる。
+    同じ質問が同時に来たときは最初のリクエストだけが上流に投げ、残りはその結果を待つ
+    (待っている側にはトークンごとではなく、まとめて1回で返す)
+    """
+
+    def __init__(self, backend, timeout=3600, max_entries=1000):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Futureはイベントループに紐づくので、実行中の問い合わせはループごとに持つ
+        self._in_flight = weakref.WeakKeyDictionary()
+
+    def cache_key(self, messages):
+        parts = [getattr(self.backend, "model", "")]
+        parts += [[m["role"], normalise(m["content"])] for m in messages]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, text = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def _set(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        registry.increment("chat_cache", name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def stream(self, messages):
+        key = self.cache_key(messages)
+        text = self._get(key)
+        if text is not None:
+            self._count("hits")
+            yield text
+            return
+
+        loop = asyncio.get_running_loop()
+        in_flight = self._in_flight.setdefault(loop, {})
+        if key in in_flight:
+            self._count("coalesced")
+            # 待っている側がキャンセルされても上流への問い合わせは止めない
+            yield await asyncio.shield(in_flight[key])
+            return
+
+        self._count("misses")
+        future = in_flight[key] = loop.create_future()
+        tokens = []
+        try:
+            async for token in self.backend.stream(messages):
+                tokens.append(token)
+                yield token
+            text = "".join(tokens)
+            self._set(key, text)
+            future.set_result(text)
+        except ChatBackendError as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del in_flight[key]
+            if not future.done():
+                # クライアントが切断して最後まで読まれなかった
+                future.set_exception(ChatBackendError("応答が途中で打ち切られました"))
+            # 誰も待っていなくても「取り出されなかった例外」の警告が出ないように一度取り出す
+            future.exception()
+
+
+@lru_cache(maxsize=None)
+def get_chat_backend():
+    backend_class = import_string(settings.CHAT_BACKEND)
+    options = {
+        "api_base": settings.CHAT_API_BASE,
+        "model": settings.CHAT_MODEL,
+        "api_key": os.getenv("API_KEY"),
+        **settings.CHAT_BACKEND_OPTIONS,
+    }
+    backend = backend_class(**options)
+    if settings.CHAT_CACHE:
+        backend = CachedChatBackend(backend, **settings.CHAT_CACHE)
+    return backend
+
+
+@receiver(setting_changed)
+def chat_setting_changed(setting, **kwargs):
+    if setting.startswith("CHAT_"):
+        get_chat_backend.cache_clear()
@@ -0,0 +1,44 @@
+"""
+ツイートをまとめて消す。delete_tweetsとarchive_tweetsコマンドから使う。
+
+Tweet.delete()だと1件ずつCASCADEの先を集めてシグナルを飛ばすので、
+ぶら下がっている行もツイートも_raw_deleteのDELETE文でまとめて消し、
+シグナルの代わりにプロフィールのツイート数とキャッシュをここで直す
+"""
+
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models import F
+
+from accounts.models import Profile
+
+from . import fragments
+from .models import Tweet
+
+
+def delete_dependents(pks, using=DEFAULT_DB_ALIAS):
+    """
+    pksのツイートにCASCADEでぶら下がっている行(Like, TimelineEntryなど)を消す。
+    _raw_deleteはオブジェクトを集めずシグナルも飛ばさないDELETE文を1本投げるだけなので、
+    ぶら下がりのさらに先は見ない
+    """
+    for related in Tweet._meta.related_objects:
+        if related.on_delete is not models.CASCADE:
+            continue
+        related.related_model._base_manager.using(using).filter(
+            **{f"{related.field.name}__in": pks}
+        )._raw_delete(using)
+
+
+def delete_tweets(rows, using=DEFAULT_DB_ALIAS):
+    """rowsは(ツイートのid, 投稿者のid)のリスト。呼ぶ側のトランザクションの中で呼ぶ"""
+    pks = [pk for pk, _ in rows]
+    delete_dependents(pks, using)
+    Tweet._base_manager.using(using).filter(pk__in=pks)._raw_delete(using)
+    # シグナルを飛ばしていないので、ツイート数とキャッシュはここで直す
+    for user_id, count in Counter(user_id for _, user_id in rows).items():
+        Profile.objects.using(using).filter(pk=user_id).update(
+            tweet_count=F("tweet_count") - count
+        )
+        fragments.invalidate(fragments.PROFILE, user_id)
@@ -0,0 +1,100 @@
+"""
+タイムラインのツイートとプロフィールのヘッダーをテンプレートの{% cache %}でキャッシュするためのバージョン管理。
+
+フラグメントのキーは(id, バージョン)で、バージョンはキャッシュに入れておいたランダムな文字列。
+中身が変わるときはシグナルでバージョンを新しくするだけで、古いフラグメントは参照されなくなり
+タイムアウトで消える。
+いいねはlikes.pyとwritebehind.pyが直接invalidateする。Likeにシグナルを付けると
+ツイートやユーザーを消したときのカスケードでいいねを1件ずつ読み込むことになるので付けない
+"""
+
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from accounts.models import FriendShip, Profile, User
+
+from .models import Tweet
+
+TWEET = "tweet"
+PROFILE = "profile"
+
+
+def _version_key(kind, pk):
+    return f"fragment-version:{kind}:{pk}"
+
+
+def _new_version():
+    # 先頭は変更された時刻(ナノ秒)。APIのLast-Modifiedに使う
+    return f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+
+def version_time(version):
+    """バージョンを作った時刻(UNIX時間の秒)"""
+    return int(version.split("-", 1)[0]) // 10**9
+
+
+def get_versions(kind, pks):
+    """{pk: バージョン}を1回のキャッシュアクセスで取る。まだなければ作る"""
+    keys = {pk: _version_key(kind, pk) for pk in pks}
+    found = cache.get_many(keys.values())
+    missing = {key: _new_version() for key in keys.values() if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return {pk: found[key] for pk, key in keys.items()}
+
+
+def attach_tweet_versions(tweets):
+    """テンプレートで使うfragment_versionを各ツイートに付けてリストで返す"""
+    tweets = list(tweets)
+    versions = get_versions(TWEET, [tweet.pk for tweet in tweets])
+    for tweet in tweets:
+        tweet.fragment_version = versions[tweet.pk]
+    return tweets
+
+
+def get_profile_version(pk):
+    return get_versions(PROFILE, [pk])[pk]
+
+
+def invalidate(kind, pk):
+    """
+    すぐにバージョンを変え、コミット後にもう一度変える。
+    コミット前に別のリクエストが古いデータでフラグメントを作ってしまっても使われないようにするため
+    """
+    cache.set(_version_key(kind, pk), _new_version(), timeout=None)
+    transaction.on_commit(
+        lambda: cache.set(_version_key(kind, pk), _new_version(), timeout=None)
+    )
+
+
+@receiver(post_save, sender=Tweet)
+@receiver(post_delete, sender=Tweet)
+def tweet_is_changed(sender, instance, **kwargs):
+    invalidate(TWEET, instance.pk)
+    # ツイート数が変わる
+    invalidate(PROFILE, instance.user_id)
+
+
+@receiver(post_save, sender=FriendShip)
+@receiver(post_delete, sender=FriendShip)
+def friendship_is_changed(sender, instance, **kwargs):
+    invalidate(PROFILE, instance.follower_id)
+    invalidate(PROFILE, instance.following_id)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def profile_is_changed(sender, instance, **kwargs):
+    invalidate(PROFILE, instance.pk)
+
+
+@receiver(post_save, sender=User)
+def user_is_changed(sender, instance, **kwargs):
+    # ユーザー名とメールアドレスはプロフィールのヘッダーに出している
+    invalidate(PROFILE, instance.pk)
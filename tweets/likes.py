@@ -0,0 +1,135 @@
+"""
+いいね/いいね解除。Tweet.like_countはLikeの追加・削除と同じトランザクションで増減させるので、
+件数を表示するたびにCOUNTしなくてよい。
+
+一番多い書き込みなので、SQLを直接書いてLikeのINSERT(重複は無視)かDELETEを1本と、
+like_countのUPDATE ... RETURNINGを1本だけ投げる。ツイートがあるかどうかはUPDATEで
+更新した行があるかで確かめ、前もってSELECTしない。
+SQLを直接投げるのでpost_save/post_deleteは飛ばない。フラグメントのキャッシュと
+トレンドのLikeBucketはここで更新する
+"""
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from . import fragments, trending
+from .models import Like, Tweet
+
+
+def _quote(connection, model, field=None):
+    if field is None:
+        return connection.ops.quote_name(model._meta.db_table)
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def _update_like_count(cursor, connection, tweet_id, delta):
+    """like_countをdeltaだけ変えて新しい値を返す。ツイートがなければNone"""
+    table = _quote(connection, Tweet)
+    like_count = _quote(connection, Tweet, "like_count")
+    pk = _quote(connection, Tweet, "id")
+    sql = f"UPDATE {table} SET {like_count} = {like_count} + %s WHERE {pk} = %s"
+    # RETURNINGが使えるならUPDATEと同じ文で新しい値を受け取る
+    if connection.features.can_return_columns_from_insert:
+        cursor.execute(f"{sql} RETURNING {like_count}", [delta, tweet_id])
+        row = cursor.fetchone()
+        return row[0] if row else None
+    cursor.execute(sql, [delta, tweet_id])
+    if not cursor.rowcount:
+        return None
+    return _select_like_count(cursor, connection, tweet_id)
+
+
+def _select_like_count(cursor, connection, tweet_id):
+    table = _quote(connection, Tweet)
+    like_count = _quote(connection, Tweet, "like_count")
+    pk = _quote(connection, Tweet, "id")
+    cursor.execute(f"SELECT {like_count} FROM {table} WHERE {pk} = %s", [tweet_id])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _from_db_datetime(connection, value):
+    """生のSQLで読んだcreated_atをdatetimeにする"""
+    field = Like._meta.get_field("created_at")
+    col = field.get_col(Like._meta.db_table)
+    for converter in connection.ops.get_db_converters(col) + field.get_db_converters(
+        connection
+    ):
+        value = converter(value, col, connection)
+    return value
+
+
+def _delete_like(cursor, connection, user_id, tweet_id):
+    """いいねを消して、消したいいねのcreated_atのリストを返す"""
+    table = _quote(connection, Like)
+    tweet = _quote(connection, Like, "tweet")
+    user = _quote(connection, Like, "user")
+    created_at = _quote(connection, Like, "created_at")
+    where = f"WHERE {tweet} = %s AND {user} = %s"
+    if connection.features.can_return_columns_from_insert:
+        cursor.execute(
+            f"DELETE FROM {table} {where} RETURNING {created_at}", [tweet_id, user_id]
+        )
+        rows = cursor.fetchall()
+    else:
+        # RETURNINGが使えなければ消す前に読む(同じトランザクションの中)
+        cursor.execute(f"SELECT {created_at} FROM {table} {where}", [tweet_id, user_id])
+        rows = cursor.fetchall()
+        if rows:
+            cursor.execute(f"DELETE FROM {table} {where}", [tweet_id, user_id])
+    return [_from_db_datetime(connection, value) for value, in rows]
+
+
+def add_like(user_id, tweet_id):
+    """
+    いいねして、新しいいいね数を返す。すでにいいねしていれば何もしない。
+    ツイートがなければTweet.DoesNotExist
+    """
+    using = router.db_for_write(Like)
+    connection = connections[using]
+    table = _quote(connection, Like)
+    columns = ", ".join(
+        _quote(connection, Like, field) for field in ("tweet", "user", "created_at")
+    )
+    now = timezone.now()
+    created_at = Like._meta.get_field("created_at").get_db_prep_save(now, connection)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # (tweet, user)のユニーク制約にぶつかったら何もしない
+        cursor.execute(
+            f"{connection.ops.insert_statement(ignore_conflicts=True)} {table} "
+            f"({columns}) VALUES (%s, %s, %s) "
+            f"{connection.ops.ignore_conflicts_suffix_sql(ignore_conflicts=True)}",
+            [tweet_id, user_id, created_at],
+        )
+        if cursor.rowcount:
+            count = _update_like_count(cursor, connection, tweet_id, 1)
+            if count is None:
+                # 外部キーはコミット時に検査されるので、その前にロールバックさせる
+                raise Tweet.DoesNotExist
+            trending.record(cursor, connection, tweet_id, now, 1)
+            fragments.invalidate(fragments.TWEET, tweet_id)
+        else:
+            # すでにいいねしている(いいねがあるのでツイートもある)
+            count = _select_like_count(cursor, connection, tweet_id)
+    return count
+
+
+def remove_like(user_id, tweet_id):
+    """
+    いいねを取り消して、新しいいいね数を返す。いいねしていなければ何もしない。
+    ツイートがなければTweet.DoesNotExist
+    """
+    using = router.db_for_write(Like)
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        deleted = _delete_like(cursor, connection, user_id, tweet_id)
+        if deleted:
+            count = _update_like_count(cursor, connection, tweet_id, -len(deleted))
+            for liked_at in deleted:
+                trending.record(cursor, connection, tweet_id, liked_at, -1)
+            fragments.invalidate(fragments.TWEET, tweet_id)
+        else:
+            count = _select_like_count(cursor, connection, tweet_id)
+    if count is None:
+        raise Tweet.DoesNotExist
+    return count
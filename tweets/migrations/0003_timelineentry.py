@@ -0,0 +1,127 @@
+# Generated by Django 4.0.10 on 2026-10-18 15:44
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+# このマイグレーションを書いたときのTIMELINE_FANOUT_LIMITとTIMELINE_BACKFILL_SIZE
+FANOUT_LIMIT = 10000
+BACKFILL_SIZE = 200
+BATCH_SIZE = 1000
+
+
+def fill_timelines(apps, schema_editor):
+    """
+    既存のツイートでタイムラインを作る(全員にrebuild_timelinesを流したのと同じ)。
+    各ユーザーの最近のBACKFILL_SIZE件を本人とフォロワーに配る。
+    フォロワーがFANOUT_LIMIT人以上のユーザーは読み込み時に混ぜるので、本人にだけ入れる
+    """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Tweet = apps.get_model("tweets", "Tweet")
+    TimelineEntry = apps.get_model("tweets", "TimelineEntry")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    alias = schema_editor.connection.alias
+    friendships = FriendShip.objects.using(alias)
+    follower_counts = dict(
+        friendships.values("following_id")
+        .annotate(count=Count("*"))
+        .values_list("following_id", "count")
+    )
+
+    entries = []
+    for author_id in User.objects.using(alias).values_list("pk", flat=True).iterator():
+        tweets = list(
+            Tweet.objects.using(alias)
+            .filter(user_id=author_id)
+            .order_by("-created_at", "-id")
+            .values_list("pk", "created_at")[:BACKFILL_SIZE]
+        )
+        if not tweets:
+            continue
+        owner_ids = [author_id]
+        if follower_counts.get(author_id, 0) < FANOUT_LIMIT:
+            owner_ids += friendships.filter(following_id=author_id).values_list(
+                "follower_id", flat=True
+            )
+        for owner_id in owner_ids:
+            entries += [
+                TimelineEntry(
+                    owner_id=owner_id,
+                    tweet_id=pk,
+                    author_id=author_id,
+                    created_at=created_at,
+                )
+                for pk, created_at in tweets
+            ]
+            if len(entries) >= BATCH_SIZE:
+                TimelineEntry.objects.using(alias).bulk_create(
+                    entries, ignore_conflicts=True
+                )
+                entries = []
+    TimelineEntry.objects.using(alias).bulk_create(entries, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("accounts", "0002_friendship_follower_friendship_following"),
+        ("tweets", "0002_like_tweet_and_user_unique"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TimelineEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField()),
+                (
+                    "author",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timeline_entries",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "tweet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timeline_entries",
+                        to="tweets.tweet",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="timelineentry",
+            index=models.Index(
+                fields=["owner", "-created_at", "-tweet"],
+                name="timeline_owner_created_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="timelineentry",
+            constraint=models.UniqueConstraint(
+                fields=("owner", "tweet"), name="timeline_owner_and_tweet_unique"
+            ),
+        ),
+        migrations.RunPython(fill_timelines, migrations.RunPython.noop),
+    ]
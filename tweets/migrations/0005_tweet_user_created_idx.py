@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+from mysite.migration_operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLYはトランザクションの外でしか実行できない
+    atomic = False
+
+    dependencies = [
+        ("tweets", "0004_tweet_like_count"),
+    ]
+
+    operations = [
+        AddIndexOnline(
+            model_name="tweet",
+            index=models.Index(
+                fields=["user", "-created_at"], name="tweet_user_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,111 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:13
+
+import unicodedata
+
+import django.db.models.deletion
+from django.db import DatabaseError, migrations, models, transaction
+
+# このマイグレーションを書いたときのtweets/search.pyの中身。
+# あとでトークナイザーを変えてもこのマイグレーションの結果が変わらないように写しておく
+FTS_TABLE = "tweet_search"
+
+
+def tokenize(text):
+    tokens = []
+    for word in unicodedata.normalize("NFKC", text).lower().split():
+        tokens += [word[i : i + 2] for i in range(len(word) - 1)]
+        tokens.append(word[-1])
+    return tokens
+
+
+def create_fts_index(apps, schema_editor):
+    """
+    SQLiteでFTS5が使えればtweet_searchを作る。使えなければSearchTokenがインデックスになる。
+    ツイートを消すとトリガーでインデックスからも消える
+    """
+    Tweet = apps.get_model("tweets", "Tweet")
+    SearchToken = apps.get_model("tweets", "SearchToken")
+    connection = schema_editor.connection
+    tweets = Tweet.objects.using(connection.alias).only("pk", "contents")
+
+    has_fts = False
+    if connection.vendor == "sqlite":
+        try:
+            with transaction.atomic(using=connection.alias):
+                schema_editor.execute(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    "tokens, tokenize = 'unicode61 remove_diacritics 0')"
+                )
+            has_fts = True
+        except DatabaseError:
+            pass
+
+    if has_fts:
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABLE}_tweet_deleted AFTER DELETE ON "
+            f"{Tweet._meta.db_table} BEGIN "
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = old.id; END"
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, tokens) VALUES (%s, %s)",
+                (
+                    (tweet.pk, " ".join(tokenize(tweet.contents)))
+                    for tweet in tweets.iterator()
+                ),
+            )
+    else:
+        SearchToken.objects.using(connection.alias).bulk_create(
+            (
+                SearchToken(token=token, tweet_id=tweet.pk)
+                for tweet in tweets.iterator()
+                for token in dict.fromkeys(tokenize(tweet.contents))
+            ),
+            batch_size=1000,
+        )
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_tweet_deleted")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0005_tweet_user_created_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SearchToken",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token", models.CharField(max_length=16)),
+                (
+                    "tweet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="search_tokens",
+                        to="tweets.tweet",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="searchtoken",
+            constraint=models.UniqueConstraint(
+                fields=("token", "tweet"), name="search_token_and_tweet_unique"
+            ),
+        ),
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0007_hashtags_and_mentions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LikeBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("minute", models.DateTimeField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "tweet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="like_buckets",
+                        to="tweets.tweet",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="likebucket",
+            index=models.Index(fields=["minute"], name="like_bucket_minute_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="likebucket",
+            constraint=models.UniqueConstraint(
+                fields=("tweet", "minute"), name="like_bucket_tweet_and_minute_unique"
+            ),
+        ),
+    ]
@@ -1,21 +1,63 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
-from accounts.models import User
+from accounts.models import Profile, User
+
+
+class TweetQuerySet(models.QuerySet):
+    def with_viewer_state(self, viewer):
+        """
+        viewerがいいねしているかをis_liked_by_viewerとして付ける。
+        EXISTSの相関サブクエリなので、ページに出す行の分しか調べない
+        """
+        if not viewer.is_authenticated:
+            return self.annotate(
+                is_liked_by_viewer=models.Value(False, models.BooleanField())
+            )
+        return self.annotate(
+            is_liked_by_viewer=models.Exists(
+                Like.objects.filter(tweet=models.OuterRef("pk"), user=viewer)
+            )
+        )
 
 
 class Tweet(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, to_field="id")
     contents = models.TextField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Likeの件数。いいね/いいね解除と同じトランザクションでF()を使って増減させる
+    like_count = models.IntegerField(default=0)
+
+    objects = TweetQuerySet.as_manager()
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["user", "-created_at"], name="tweet_user_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.contents} ({self.user.username})"
 
 
+@receiver(post_save, sender=Tweet)
+def tweet_is_created(sender, instance, created, **kwargs):
+    if created:
+        Profile.objects.filter(pk=instance.user_id).update(
+            tweet_count=models.F("tweet_count") + 1
+        )
+
+
+# delete_tweetsのような一括削除やユーザー削除のカスケードでも1件ずつ呼ばれる
+@receiver(post_delete, sender=Tweet)
+def tweet_is_deleted(sender, instance, **kwargs):
+    Profile.objects.filter(pk=instance.user_id).update(
+        tweet_count=models.F("tweet_count") - 1
+    )
+
+
 class Like(models.Model):
     """投稿に対するいいね"""
 
@@ -24,8 +66,163 @@ class Like(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
+        # (tweet, user)のインデックスも兼ねる
         constraints = [
             models.UniqueConstraint(
                 fields=["tweet", "user"], name="tweet_and_user_unique"
             )
         ]
+
+
+class TimelineEntry(models.Model):
+    """
+    ホームタイムラインの実体。ツイート時にフォロワー全員分の行を書き込んでおき(fan-out-on-write)、
+    読み込みはowner+created_atのインデックスを範囲スキャンするだけにする
+    """
+
+    owner = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="timeline_entries"
+    )
+    tweet = models.ForeignKey(
+        Tweet, on_delete=models.CASCADE, related_name="timeline_entries"
+    )
+    # フォロー解除時の削除とページングに使うのでTweetからコピーしておく
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner", "tweet"], name="timeline_owner_and_tweet_unique"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["owner", "-created_at", "-tweet"],
+                name="timeline_owner_created_idx",
+            ),
+        ]
+
+
+class SearchToken(models.Model):
+    """
+    全文検索の転置インデックス(トークン -> ツイート)。
+    SQLiteのFTS5が使えないときだけ使う(tweets/search.py)
+    """
+
+    token = models.CharField(max_length=16)
+    tweet = models.ForeignKey(
+        Tweet, on_delete=models.CASCADE, related_name="search_tokens"
+    )
+
+    class Meta:
+        # トークンで引いてツイートの新しい順に読むインデックスも兼ねる
+        constraints = [
+            models.UniqueConstraint(
+                fields=["token", "tweet"], name="search_token_and_tweet_unique"
+            )
+        ]
+
+
+class Hashtag(models.Model):
+    """ハッシュタグ。nameはNFKCで正規化して小文字にしたもの(tweets/tags.py)"""
+
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return f"#{self.name}"
+
+
+class TweetHashtag(models.Model):
+    """
+    ツイートとハッシュタグの対応。タグのページはhashtag+created_atのインデックスを
+    範囲スキャンするだけにして、本文をLIKEで探さない
+    """
+
+    tweet = models.ForeignKey(
+        Tweet, on_delete=models.CASCADE, related_name="tweet_hashtags"
+    )
+    hashtag = models.ForeignKey(
+        Hashtag, on_delete=models.CASCADE, related_name="tweet_hashtags"
+    )
+    # ページングに使うのでTweetからコピーしておく
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["hashtag", "tweet"], name="hashtag_and_tweet_unique"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["hashtag", "-created_at", "-tweet"],
+                name="hashtag_created_idx",
+            ),
+        ]
+
+
+class Mention(models.Model):
+    """ツイートの中の@usernameで言及されたユーザー"""
+
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="mentions")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="mentions")
+    # ページングに使うのでTweetからコピーしておく
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "tweet"], name="mention_user_and_tweet_unique"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["user", "-created_at", "-tweet"],
+                name="mention_user_created_idx",
+            ),
+        ]
+
+
+class LikeBucket(models.Model):
+    """
+    ツイートごと・1分ごとのいいね数(tweets/trending.py)。いいね/いいね解除のたびに
+    その分のバケツを増減させるので、トレンドの計算でLikeテーブル全体を集計しなくてよい
+    """
+
+    tweet = models.ForeignKey(
+        Tweet, on_delete=models.CASCADE, related_name="like_buckets"
+    )
+    # その1分の始まり(UTC)
+    minute = models.DateTimeField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tweet", "minute"], name="like_bucket_tweet_and_minute_unique"
+            )
+        ]
+        # 直近の窓のバケツを読むのと、古いバケツを消すのに使う
+        indexes = [
+            models.Index(fields=["minute"], name="like_bucket_minute_idx"),
+        ]
+
+
+class ArchivedTweet(models.Model):
+    """
+    archive_tweetsでファイルに移したツイートの目印(tweets/archive.py)。
+    本文といいねはファイルのほうにあり、ここには詳細ページで読み出すための位置だけ持つ
+    """
+
+    # 元のTweetのid
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="archived_tweets"
+    )
+    created_at = models.DateTimeField()
+    like_count = models.IntegerField(default=0)
+    # ARCHIVE_ROOTからのファイル名(YYYY-MM.jsonl.gz)と、そのツイートが入っているgzipのメンバーの位置
+    partition = models.CharField(max_length=32)
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
@@ -0,0 +1,92 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+from django.http import Http404
+
+
+def encode_keys(*keys):
+    """キーセットの値をカーソル文字列にする。日時はISO形式、数値はそのまま文字列にする"""
+    raw = "|".join(
+        key.isoformat() if isinstance(key, datetime) else str(key) for key in keys
+    ).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_keys(cursor, *types):
+    """
+    encode_keysの逆。typesは値ごとに文字列から戻す関数(int, floatなど)。
+    数が合わないときや壊れているときはValueError
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = base64.urlsafe_b64decode(padded).decode().split("|")
+        if len(values) != len(types):
+            raise ValueError(f"expected {len(types)} keys")
+        return tuple(type_(value) for type_, value in zip(types, values))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+
+
+def encode_cursor(created_at, pk):
+    """「これより古いツイート」を表すカーソル文字列を作る"""
+    return encode_keys(created_at, pk)
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を(created_at, id)に戻す。壊れていればValueError"""
+    return decode_keys(cursor, datetime.fromisoformat, int)
+
+
+def filter_by_cursor(queryset, cursor=None, keys=("created_at", "id")):
+    """カーソルより古い行だけに絞り込み、keysの降順に並べたquerysetを返す"""
+    time_key, id_key = keys
+    queryset = queryset.order_by(f"-{time_key}", f"-{id_key}")
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f"{time_key}__lt": created_at})
+            | Q(**{time_key: created_at, f"{id_key}__lt": pk})
+        )
+    return queryset
+
+
+def paginate_by_cursor(queryset, cursor=None, page_size=20, keys=("created_at", "id")):
+    """
+    OFFSETを使わずに(created_at, id)のキーセットで1ページ分を取り出す。
+    返り値は(そのページの行のリスト, 次のページのカーソル or None)。
+    querysetはモデルインスタンスでもvalues()の辞書でもよい
+    """
+    # 1件多く取って次のページがあるか判定する(COUNTは投げない)
+    rows = list(filter_by_cursor(queryset, cursor, keys)[: page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    if isinstance(last, dict):
+        return rows, encode_cursor(*(last[key] for key in keys))
+    return rows, encode_cursor(*(getattr(last, key) for key in keys))
+
+
+class CursorPaginationMixin:
+    """ListView用。?cursor=...で「これより古い」ページを表示する"""
+
+    paginate_by = 20
+    cursor_kwarg = "cursor"
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        try:
+            rows, self.next_cursor = self.get_cursor_page(queryset, cursor, page_size)
+        except ValueError:
+            raise Http404("不正なカーソルです")
+        return (None, None, rows, self.next_cursor is not None)
+
+    def get_cursor_page(self, queryset, cursor, page_size):
+        return paginate_by_cursor(queryset, cursor, page_size)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["next_cursor"] = getattr(self, "next_cursor", None)
+        return context
@@ -0,0 +1,218 @@
+"""
+ツイート本文の全文検索。
+
+日本語は単語の区切りがないので、本文を文字のbi-gramに分けて転置インデックスに入れる。
+SQLiteでFTS5が使えるときはFTS5の仮想テーブル(tweet_search)を、使えないときは
+SearchTokenテーブルをインデックスにする。どちらもrowid/ツイートのidの降順に読めるので、
+新しい順の検索はインデックスを先頭から読むだけで済む。
+
+ツイートを保存するとpost_saveでインデックスに入れる。消したときはFTS5ならトリガー、
+SearchTokenならCASCADEで消えるので、_raw_deleteでまとめて消しても残らない。
+bulk_createで作ったツイートはrebuild_search_indexコマンドで入れ直す
+"""
+
+import unicodedata
+
+from django.db import connections, router
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import SearchToken, Tweet
+from .pagination import decode_keys, encode_keys
+
+FTS_TABLE = "tweet_search"
+
+RECENT = "recent"
+RELEVANCE = "relevance"
+
+# 長すぎる検索語は前から切る
+MAX_QUERY_TOKENS = 32
+
+
+def tokenize(text):
+    """
+    NFKCで正規化して小文字にし、空白で区切った語ごとに文字のbi-gramにする。
+    1文字の検索語でも引けるように、語の最後の1文字もトークンにする。
+    FTS5のスコアに出現回数を効かせるため、重複は取り除かない
+    """
+    tokens = []
+    for word in unicodedata.normalize("NFKC", text).lower().split():
+        tokens += [word[i : i + 2] for i in range(len(word) - 1)]
+        tokens.append(word[-1])
+    return tokens
+
+
+def query_terms(query):
+    """
+    検索語を(トークン, 前方一致か)のリストにする。全部を含むツイートがヒットする。
+    1文字の語はその文字で始まるトークンを前方一致で探す
+    """
+    terms = {}
+    for word in unicodedata.normalize("NFKC", query).lower().split():
+        if len(word) == 1:
+            terms[(word, True)] = None
+        for i in range(len(word) - 1):
+            terms[(word[i : i + 2], False)] = None
+    # 記号だけのトークンはFTS5のトークナイザーが捨ててしまうので、検索にも使わない
+    terms = [term for term in terms if any(c.isalnum() for c in term[0])]
+    return terms[:MAX_QUERY_TOKENS]
+
+
+def decode_cursor(cursor, order):
+    """RECENTなら(id,)、RELEVANCEなら(スコア, id)。壊れていればValueError"""
+    if order == RELEVANCE:
+        return decode_keys(cursor, float, int)
+    return decode_keys(cursor, int)
+
+
+class Fts5Index:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def add(self, tweets):
+        rows = [(tweet.pk, " ".join(tokenize(tweet.contents))) for tweet in tweets]
+        if not rows:
+            return
+        placeholders = ", ".join(["%s"] * len(rows))
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})",
+                [pk for pk, _ in rows],
+            )
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, tokens) VALUES (%s, %s)", rows
+            )
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    def search(self, terms, keys, limit, order):
+        """ヒットした(id, スコア)を並び順にlimit件まで返す"""
+        match = " ".join(
+            '"{}"{}'.format(token.replace('"', '""'), "*" if prefix else "")
+            for token, prefix in terms
+        )
+        if order == RELEVANCE:
+            # bm25は小さいほどよく一致している。同じスコアなら新しい順
+            sql = (
+                f"SELECT rowid, score FROM (SELECT rowid, bm25({FTS_TABLE}) AS score "
+                f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s)"
+            )
+            params = [match]
+            if keys:
+                sql += " WHERE score > %s OR (score = %s AND rowid < %s)"
+                params += [keys[0], keys[0], keys[1]]
+            sql += " ORDER BY score, rowid DESC LIMIT %s"
+        else:
+            sql = f"SELECT rowid, 0 FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+            params = [match]
+            if keys:
+                sql += " AND rowid < %s"
+                params.append(keys[0])
+            sql += " ORDER BY rowid DESC LIMIT %s"
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit])
+            return cursor.fetchall()
+
+
+class TokenTableIndex:
+    """SearchTokenテーブルを使う。スコアは付けないので、RELEVANCEでも新しい順になる"""
+
+    def __init__(self, using):
+        self.using = using
+
+    def add(self, tweets):
+        tweets = list(tweets)
+        manager = SearchToken.objects.using(self.using)
+        manager.filter(tweet__in=[tweet.pk for tweet in tweets]).delete()
+        manager.bulk_create(
+            SearchToken(token=token, tweet_id=tweet.pk)
+            for tweet in tweets
+            for token in dict.fromkeys(tokenize(tweet.contents))
+        )
+
+    def clear(self):
+        SearchToken.objects.using(self.using).all().delete()
+
+    def search(self, terms, keys, limit, order):
+        tweets = Tweet.objects.using(self.using).order_by("-pk")
+        if keys:
+            tweets = tweets.filter(pk__lt=keys[-1])
+        for token, prefix in terms:
+            lookup = "token__startswith" if prefix else "token"
+            tweets = tweets.filter(
+                pk__in=SearchToken.objects.filter(**{lookup: token}).values("tweet_id")
+            )
+        return [(pk, 0) for pk in tweets.values_list("pk", flat=True)[:limit]]
+
+
+# FTS5のテーブルがあると分かったデータベース
+_fts_aliases = set()
+
+
+def has_fts(connection):
+    if connection.alias in _fts_aliases:
+        return True
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [FTS_TABLE],
+        )
+        found = cursor.fetchone() is not None
+    if found:
+        _fts_aliases.add(connection.alias)
+    return found
+
+
+def get_index(using=None):
+    using = using or router.db_for_write(Tweet)
+    connection = connections[using]
+    if has_fts(connection):
+        return Fts5Index(connection)
+    return TokenTableIndex(using)
+
+
+def search(query, cursor=None, page_size=20, order=RECENT):
+    """
+    queryを含むツイートを1ページ分返す。返り値は(ツイートのid, 次のページのカーソル or None)。
+    カーソルが壊れていればValueError
+    """
+    keys = decode_cursor(cursor, order) if cursor else None
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    index = get_index(router.db_for_read(Tweet))
+    rows = index.search(terms, keys, page_size + 1, order)
+    if len(rows) <= page_size:
+        return [pk for pk, _ in rows], None
+    rows = rows[:page_size]
+    pk, score = rows[-1]
+    next_cursor = encode_keys(score, pk) if order == RELEVANCE else encode_keys(pk)
+    return [pk for pk, _ in rows], next_cursor
+
+
+def rebuild(batch_size=1000):
+    """インデックスを空にして全ツイートを入れ直す。入れた件数を返す"""
+    index = get_index()
+    index.clear()
+    last_pk = 0
+    count = 0
+    while True:
+        tweets = list(
+            Tweet.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .only("pk", "contents")[:batch_size]
+        )
+        if not tweets:
+            return count
+        index.add(tweets)
+        last_pk = tweets[-1].pk
+        count += len(tweets)
+
+
+@receiver(post_save, sender=Tweet)
+def tweet_is_saved(sender, instance, using, **kwargs):
+    get_index(using).add([instance])
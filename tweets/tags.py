@@ -0,0 +1,128 @@
+"""
+ツイートの#ハッシュタグと@メンションを取り出して、Hashtag/TweetHashtag/Mentionに書き込む。
+
+タグのページとメンションのページは(hashtag or user, created_at, tweet)のインデックスを
+範囲スキャンするだけで読めるので、本文をLIKE '%#tag%'で探さなくてよい
+"""
+
+import re
+import unicodedata
+
+from accounts.models import User
+
+from .models import Hashtag, Mention, Tweet, TweetHashtag
+from .pagination import paginate_by_cursor
+
+# 直前が英数字や#のときはタグにしない(URLの#fragmentやC#など)
+HASHTAG_RE = re.compile(r"(?<![\w#&])#(\w+)")
+# 直前が英数字のときはメールアドレスなのでメンションにしない
+MENTION_RE = re.compile(r"(?<![\w@])@([\w.+-]*\w)")
+
+MAX_HASHTAG_LENGTH = Hashtag._meta.get_field("name").max_length
+
+
+def normalise_hashtag(name):
+    """全角の＃やＡＢＣも半角と同じタグにする"""
+    return unicodedata.normalize("NFKC", name).lower()
+
+
+def extract_hashtags(text):
+    """本文のハッシュタグを正規化して、出てきた順に重複なしで返す。数字だけのものは除く"""
+    names = dict.fromkeys(
+        name.lower() for name in HASHTAG_RE.findall(unicodedata.normalize("NFKC", text))
+    )
+    return [
+        name for name in names if len(name) <= MAX_HASHTAG_LENGTH and not name.isdigit()
+    ]
+
+
+def extract_mentions(text):
+    """本文の@usernameのusernameを、出てきた順に重複なしで返す"""
+    return list(dict.fromkeys(MENTION_RE.findall(text)))
+
+
+def save_tags(tweets):
+    """
+    保存済みのtweetsのハッシュタグとメンションを書き込む。
+    すでに書き込んである組は無視するので、同じツイートに何度呼んでもよい。
+    存在しないユーザーへのメンションは捨てる
+    """
+    hashtags = {tweet.pk: extract_hashtags(tweet.contents) for tweet in tweets}
+    mentions = {tweet.pk: extract_mentions(tweet.contents) for tweet in tweets}
+
+    names = {name for names in hashtags.values() for name in names}
+    if names:
+        Hashtag.objects.bulk_create(
+            [Hashtag(name=name) for name in names], ignore_conflicts=True
+        )
+        hashtag_ids = dict(
+            Hashtag.objects.filter(name__in=names).values_list("name", "pk")
+        )
+        TweetHashtag.objects.bulk_create(
+            [
+                TweetHashtag(
+                    tweet=tweet,
+                    hashtag_id=hashtag_ids[name],
+                    created_at=tweet.created_at,
+                )
+                for tweet in tweets
+                for name in hashtags[tweet.pk]
+            ],
+            ignore_conflicts=True,
+        )
+
+    usernames = {username for usernames in mentions.values() for username in usernames}
+    if usernames:
+        user_ids = dict(
+            User.objects.filter(username__in=usernames).values_list("username", "pk")
+        )
+        Mention.objects.bulk_create(
+            [
+                Mention(
+                    tweet=tweet, user_id=user_ids[username], created_at=tweet.created_at
+                )
+                for tweet in tweets
+                for username in mentions[tweet.pk]
+                if username in user_ids
+            ],
+            ignore_conflicts=True,
+        )
+
+
+def _page_of_tweet_ids(queryset, cursor, page_size):
+    rows, next_cursor = paginate_by_cursor(
+        queryset.values("created_at", "tweet_id"),
+        cursor,
+        page_size,
+        keys=("created_at", "tweet_id"),
+    )
+    return [row["tweet_id"] for row in rows], next_cursor
+
+
+def hashtag_timeline_ids(name, cursor=None, page_size=20):
+    """
+    nameのタグが付いたツイートの1ページ分のidを新しい順に返す。
+    返り値は(idのリスト, 次のページのカーソル or None)
+    """
+    return _page_of_tweet_ids(
+        TweetHashtag.objects.filter(hashtag__name=normalise_hashtag(name)),
+        cursor,
+        page_size,
+    )
+
+
+def mentions_timeline_ids(user, cursor=None, page_size=20):
+    """
+    userに言及したツイートの1ページ分のidを新しい順に返す。
+    返り値は(idのリスト, 次のページのカーソル or None)
+    """
+    return _page_of_tweet_ids(Mention.objects.filter(user=user), cursor, page_size)
+
+
+def tweets_by_ids(ids):
+    """idsのツイートを新しい順に並べたqueryset"""
+    return (
+        Tweet.objects.filter(pk__in=ids)
+        .select_related("user")
+        .order_by("-created_at", "-id")
+    )
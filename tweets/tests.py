@@ -1,9 +1,48 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from accounts.models import User
+from accounts.models import FriendShip, Profile, User
+from mysite import benchmark, metrics
+from mysite.routers import routing
+from mysite.streaming import AsyncStreamingASGIHandler, AsyncStreamingHttpResponse
 
-from .models import Like, Tweet
+from . import archive, likes, search, tags, timeline, trending, writebehind
+from .chat import (
+    SYSTEM_PROMPT,
+    CachedChatBackend,
+    ChatBackend,
+    ChatBackendError,
+    build_messages,
+    get_chat_backend,
+)
+from .models import (
+    ArchivedTweet,
+    Hashtag,
+    Like,
+    LikeBucket,
+    Mention,
+    TimelineEntry,
+    Tweet,
+    TweetHashtag,
+)
 
 
 class TestTweetCreateView(TestCase):
@@ -68,6 +107,14 @@ class TestTweetDetailView(TestCase):
         self.assertEquals(response_get.status_code, 200)
         self.assertTemplateUsed(response_get, "tweets/tweets_detail.html")
         self.assertContains(response_get, data["contents"])
+        self.assertFalse(response_get.context["is_user_liked_for_tweet"])
+
+        self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        response_get = self.client.get(
+            reverse("tweets:detail", kwargs={"pk": tweet.pk})
+        )
+        self.assertTrue(response_get.context["is_user_liked_for_tweet"])
+        self.assertEquals(response_get.context["like_for_tweet_count"], 1)
 
 
 class TestTweetDeleteView(TestCase):
@@ -121,6 +168,17 @@ class TestFavoriteView(TestCase):
         response = self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
         self.assertEquals(response.status_code, 200)
         self.assertTrue(Like.objects.filter(tweet=tweet).exists())
+        self.assertEquals(response.json()["like_for_tweet_count"], 1)
+        tweet.refresh_from_db()
+        self.assertEquals(tweet.like_count, 1)
+
+    def test_success_post_twice(self):
+        tweet = Tweet.objects.create(user=self.user_1, contents="ワンピース")
+        self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        response = self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        self.assertEquals(response.json()["like_for_tweet_count"], 1)
+        tweet.refresh_from_db()
+        self.assertEquals(tweet.like_count, 1)
 
     def test_failure_post_with_not_exist_tweet(self):
         # 存在しないツイートに対してリクエストを送信する
@@ -128,6 +186,25 @@ class TestFavoriteView(TestCase):
         response = self.client.post(reverse("tweets:like", kwargs={"pk": 999}))
         self.assertEquals(response.status_code, 404)
         self.assertFalse(Like.objects.filter(tweet=tweet).exists())
+        self.assertFalse(Like.objects.exists())
+
+    def test_failure_get(self):
+        tweet = Tweet.objects.create(user=self.user_1, contents="ワンピース")
+        response = self.client.get(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        self.assertEquals(response.status_code, 405)
+        self.assertFalse(Like.objects.exists())
+
+    def test_write_in_one_statement(self):
+        tweet = Tweet.objects.create(user=self.user_1, contents="ワンピース")
+        # INSERTとUPDATE ... RETURNINGとLikeBucketの更新に、
+        # テストのトランザクションの中なのでSAVEPOINTとRELEASE
+        with self.assertNumQueries(5):
+            self.assertEquals(likes.add_like(self.user_1.pk, tweet.pk), 1)
+        # すでにいいねしていればINSERTとSELECTだけ
+        with self.assertNumQueries(4):
+            self.assertEquals(likes.add_like(self.user_1.pk, tweet.pk), 1)
+        with self.assertNumQueries(5):
+            self.assertEquals(likes.remove_like(self.user_1.pk, tweet.pk), 0)
 
 
 class TestUnfavoriteView(TestCase):
@@ -145,6 +222,9 @@ class TestUnfavoriteView(TestCase):
         )
         self.assertEquals(response.status_code, 200)
         self.assertFalse(Like.objects.filter(tweet=self.tweet).exists())
+        self.assertEquals(response.json()["like_for_tweet_count"], 0)
+        self.tweet.refresh_from_db()
+        self.assertEquals(self.tweet.like_count, 0)
 
     def test_failure_post_with_not_exist_tweet(self):
         response = self.client.post(reverse("tweets:unlike", kwargs={"pk": 999}))
@@ -157,4 +237,1145 @@ class TestUnfavoriteView(TestCase):
             reverse("tweets:unlike", kwargs={"pk": self.tweet.pk})
         )
         self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.json()["like_for_tweet_count"], 0)
         self.assertFalse(Like.objects.filter(tweet=self.tweet).exists())
+        self.tweet.refresh_from_db()
+        self.assertEquals(self.tweet.like_count, 0)
+
+    def test_failure_get(self):
+        response = self.client.get(
+            reverse("tweets:unlike", kwargs={"pk": self.tweet.pk})
+        )
+        self.assertEquals(response.status_code, 405)
+        self.assertTrue(Like.objects.filter(tweet=self.tweet).exists())
+
+
+class TestReconcileLikeCounts(TestCase):
+    def test_fix_wrong_counts(self):
+        user = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        tweets = [
+            Tweet.objects.create(user=user, contents=f"ツイート{i}") for i in range(3)
+        ]
+        Like.objects.create(user=user, tweet=tweets[0])
+        Like.objects.create(user=user, tweet=tweets[1])
+        Tweet.objects.filter(pk=tweets[1].pk).update(like_count=5)
+        Tweet.objects.filter(pk=tweets[2].pk).update(like_count=-1)
+
+        call_command("reconcile_like_counts", batch_size=2)
+
+        self.assertEquals(
+            list(Tweet.objects.order_by("pk").values_list("like_count", flat=True)),
+            [1, 1, 0],
+        )
+
+
+class TestHomeTimeline(TestCase):
+    def setUp(self):
+        self.user_1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user_2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.user_3 = User.objects.create_user(
+            username="suzuki", email="suzuki@test.com", password="wasuretene1108"
+        )
+        FriendShip.objects.create(follower=self.user_1, following=self.user_2)
+
+    def home_tweets(self, user):
+        tweets, _ = timeline.home_timeline(user)
+        return [tweet.contents for tweet in tweets]
+
+    def test_fan_out_on_create(self):
+        self.client.login(username="satou", password="wasuretene1108")
+        self.client.post(reverse("tweets:create"), {"contents": "フォロワーに届く"})
+        self.client.login(username="suzuki", password="wasuretene1108")
+        self.client.post(reverse("tweets:create"), {"contents": "フォロワーに届かない"})
+
+        self.assertEquals(self.home_tweets(self.user_1), ["フォロワーに届く"])
+        self.assertEquals(self.home_tweets(self.user_2), ["フォロワーに届く"])
+        self.assertEquals(self.home_tweets(self.user_3), ["フォロワーに届かない"])
+
+    def test_backfill_on_follow_and_prune_on_unfollow(self):
+        Tweet.objects.create(user=self.user_3, contents="フォロー前のツイート")
+        self.client.login(username="yamada", password="wasurenaide1108")
+
+        self.client.post(reverse("accounts:follow", kwargs={"username": "suzuki"}))
+        self.assertEquals(self.home_tweets(self.user_1), ["フォロー前のツイート"])
+
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": "suzuki"}))
+        self.assertEquals(self.home_tweets(self.user_1), [])
+
+    @override_settings(TIMELINE_FANOUT_LIMIT=1)
+    def test_fan_out_on_read_for_celebrity(self):
+        self.client.login(username="satou", password="wasuretene1108")
+        self.client.post(reverse("tweets:create"), {"contents": "有名人のツイート"})
+
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.user_1).exists())
+        self.assertEquals(self.home_tweets(self.user_1), ["有名人のツイート"])
+
+    def test_pagination_across_fan_out_and_celebrity_tweets(self):
+        for i in range(5):
+            timeline.fan_out(Tweet.objects.create(user=self.user_2, contents=f"{i}"))
+        with self.settings(TIMELINE_FANOUT_LIMIT=1):
+            for i in range(5, 10):
+                timeline.fan_out(
+                    Tweet.objects.create(user=self.user_2, contents=f"{i}")
+                )
+            contents = []
+            cursor = None
+            while True:
+                tweets, cursor = timeline.home_timeline(self.user_1, cursor, 3)
+                contents += [tweet.contents for tweet in tweets]
+                if cursor is None:
+                    break
+        self.assertEquals(contents, [str(i) for i in reversed(range(10))])
+
+    @override_settings(TIMELINE_BACKFILL_SIZE=2)
+    def test_rebuild_with_constant_queries(self):
+        FriendShip.objects.create(follower=self.user_1, following=self.user_3)
+        for user in [self.user_1, self.user_2, self.user_3]:
+            for i in range(3):
+                Tweet.objects.create(user=user, contents=f"{user.username}{i}")
+        TimelineEntry.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            timeline.rebuild(self.user_1)
+
+        self.assertEquals(
+            self.home_tweets(self.user_1),
+            ["suzuki2", "suzuki1", "satou2", "satou1", "yamada2", "yamada1"],
+        )
+        User.objects.bulk_create(
+            User(username=f"other{i}", email=f"other{i}@test.com") for i in range(5)
+        )
+        others = list(User.objects.filter(username__startswith="other"))
+        Profile.objects.bulk_create(Profile(user=other) for other in others)
+        FriendShip.objects.bulk_create(
+            FriendShip(follower=self.user_1, following=other) for other in others
+        )
+        for other in others:
+            Tweet.objects.create(user=other, contents=other.username)
+        with self.assertNumQueries(len(queries)):
+            timeline.rebuild(self.user_1)
+
+
+class TestFragmentCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+        self.tweet = Tweet.objects.create(user=self.user_1, contents="ワンピース")
+        self.url = reverse("accounts:user_profile", kwargs={"pk": self.user_1.pk})
+
+    def test_reuse_cached_fragment(self):
+        self.client.get(self.url)
+        # シグナルを飛ばさずに書き換えるとキャッシュされたフラグメントがそのまま使われる
+        Tweet.objects.filter(pk=self.tweet.pk).update(contents="書き換えた")
+        response = self.client.get(self.url)
+        self.assertContains(response, "ワンピース")
+        self.assertNotContains(response, "書き換えた")
+
+    def test_invalidate_tweet_fragment_on_like(self):
+        self.client.get(self.url)
+        self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        response = self.client.get(self.url)
+        self.assertContains(response, "1件のいいね")
+
+    def test_delete_likes_without_loading_them(self):
+        user_2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        likes.add_like(self.user_1.pk, self.tweet.pk)
+        likes.add_like(user_2.pk, self.tweet.pk)
+        # Likeにシグナルがないので、カスケードはDELETEを1本投げるだけで行を読まない
+        with CaptureQueriesContext(connection) as queries:
+            self.tweet.delete()
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(
+            [
+                query["sql"]
+                for query in queries.captured_queries
+                if query["sql"].startswith('SELECT "tweets_like"')
+            ]
+        )
+
+    def test_invalidate_profile_fragment(self):
+        user_2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.client.get(self.url)
+        FriendShip.objects.create(follower=user_2, following=self.user_1)
+        response = self.client.get(self.url)
+        self.assertContains(response, "1人：フォロワー覧")
+
+        self.user_1.profile.hobby = "サッカー"
+        self.user_1.profile.save()
+        response = self.client.get(self.url)
+        self.assertContains(response, "サッカー")
+
+
+class TestTimelineApi(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+        self.client.post(reverse("tweets:create"), {"contents": "ワンピース"})
+        self.tweet = Tweet.objects.get(contents="ワンピース")
+
+    def test_success_get_home(self):
+        response = self.client.get(reverse("tweets:api_home"))
+        self.assertEquals(response.status_code, 200)
+        (tweet,) = response.json()["tweets"]
+        self.assertEquals(tweet["id"], self.tweet.pk)
+        self.assertEquals(tweet["username"], "yamada")
+        self.assertEquals(tweet["like_count"], 0)
+        self.assertFalse(tweet["is_liked_by_viewer"])
+        self.assertIsNone(response.json()["next_cursor"])
+
+    def test_not_modified_until_tweet_changes(self):
+        url = reverse("tweets:api_home")
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.json()["tweets"][0]["is_liked_by_viewer"])
+
+    def test_user_timeline_pagination(self):
+        for i in range(25):
+            Tweet.objects.create(user=self.user_1, contents=f"ツイート{i}")
+        url = reverse("tweets:api_user_timeline", kwargs={"pk": self.user_1.pk})
+        page_1 = self.client.get(url).json()
+        page_2 = self.client.get(url, {"cursor": page_1["next_cursor"]}).json()
+        self.assertEquals(len(page_1["tweets"]), 20)
+        self.assertEquals(len(page_2["tweets"]), 6)
+        self.assertIsNone(page_2["next_cursor"])
+
+    def test_user_timeline_if_modified_since(self):
+        url = reverse("tweets:api_user_timeline", kwargs={"pk": self.user_1.pk})
+        last_modified = self.client.get(url)["Last-Modified"]
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+
+    def test_not_modified_without_loading_tweet(self):
+        url = reverse("tweets:api_detail", kwargs={"pk": self.tweet.pk})
+        etag = self.client.get(url)["ETag"]
+        # セッション、ユーザー、投稿者のidの3回だけで、ツイート本体は読まない
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+    def test_failure_get_with_not_exist_tweet(self):
+        response = self.client.get(reverse("tweets:api_detail", kwargs={"pk": 999}))
+        self.assertEquals(response.status_code, 404)
+
+    def test_failure_get_with_invalid_cursor(self):
+        response = self.client.get(reverse("tweets:api_home"), {"cursor": "!!!"})
+        self.assertEquals(response.status_code, 400)
+
+
+class FakeModelHandler(BaseHTTPRequestHandler):
+    """OpenAI互換の/chat/completionsだけを持つ偽のモデルサーバー。ユーザーの発言を1文字ずつ返す"""
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(payload)
+        tokens = list(payload["messages"][-1]["content"])
+        if payload.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            if payload["messages"][-1]["content"] == "壊れた応答":
+                self.wfile.write(b"data: {not json\n\n")
+                return
+            for token in tokens:
+                chunk = {"choices": [{"delta": {"content": token}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+        else:
+            body = json.dumps(
+                {"choices": [{"message": {"content": "".join(tokens)}}]}
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestChatView(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeModelHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings_override = override_settings(
+            CHAT_API_BASE=f"http://127.0.0.1:{cls.server.server_port}", CHAT_CACHE=None
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_success_get(self):
+        response = self.client.get(reverse("tweets:chat"))
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, "tweets/chat.html")
+
+    def test_success_post(self):
+        response = self.client.post(reverse("tweets:chat"), {"sentence": "こんにちは"})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context["chat_results"], "こんにちは")
+        request = self.server.requests[-1]
+        self.assertEquals(request["messages"][0]["content"], "日本語で応答してください")
+
+    def test_success_post_stream(self):
+        response = self.client.post(
+            reverse("tweets:chat_stream"), {"sentence": "こんにちは"}
+        )
+        self.assertEquals(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        tokens = [
+            json.loads(line[len("data: ") :])
+            for line in body.split("\n")
+            if line.startswith("data: ")
+        ]
+        self.assertEquals(tokens, ["こ", "ん", "に", "ち", "は", ""])
+        self.assertTrue(body.endswith('event: done\ndata: ""\n\n'))
+
+    def test_failure_post_stream_with_upstream_error(self):
+        with self.settings(CHAT_API_BASE="http://127.0.0.1:9"):
+            response = self.client.post(
+                reverse("tweets:chat_stream"), {"sentence": "こんにちは"}
+            )
+            body = b"".join(response.streaming_content).decode()
+        self.assertIn("event: error", body)
+
+    def test_failure_post_stream_with_malformed_chunk(self):
+        response = self.client.post(
+            reverse("tweets:chat_stream"), {"sentence": "壊れた応答"}
+        )
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn("event: error", body)
+        self.assertTrue(body.endswith('event: done\ndata: ""\n\n'))
+
+    def test_close_client_when_loop_finishes(self):
+        backend = get_chat_backend()
+
+        async def run():
+            tokens = [token async for token in backend.stream(build_messages("あ"))]
+            client, _ = await backend._pool()
+            self.assertFalse(client.is_closed)
+            return tokens, client
+
+        tokens, client = asyncio.run(run())
+        self.assertEquals(tokens, ["あ"])
+        self.assertTrue(client.is_closed)
+
+    def test_failure_get_stream(self):
+        response = self.client.get(reverse("tweets:chat_stream"))
+        self.assertEquals(response.status_code, 405)
+
+
+class TestAsyncStreamingHandler(TestCase):
+    def stream(self, send):
+        self.closed = closed = []
+
+        async def content():
+            try:
+                for chunk in ["a", "b", "c"]:
+                    yield chunk
+            finally:
+                closed.append("content")
+
+        def finished(**kwargs):
+            closed.append("request_finished")
+
+        request_finished.connect(finished)
+        self.addCleanup(request_finished.disconnect, finished)
+        response = AsyncStreamingHttpResponse(content())
+        asyncio.run(AsyncStreamingASGIHandler().send_response(response, send))
+        return closed
+
+    def test_send_and_close(self):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        closed = self.stream(send)
+        self.assertEquals(
+            [message.get("body") for message in messages[1:]], [b"a", b"b", b"c", None]
+        )
+        self.assertEquals(closed, ["content", "request_finished"])
+
+    def test_stop_after_client_disconnects(self):
+        messages = []
+
+        async def send(message):
+            if message.get("body") == b"b":
+                raise OSError("disconnected")
+            messages.append(message)
+
+        with self.assertRaises(OSError):
+            self.stream(send)
+        # 切断したあとは閉じるメッセージも送らない
+        self.assertEquals([message.get("body") for message in messages[1:]], [b"a"])
+        self.assertEquals(self.closed, ["content", "request_finished"])
+
+
+class FakeChatBackend(ChatBackend):
+    """呼ばれた回数を数える偽の上流。releaseがセットされるまで応答を返さない"""
+
+    model = "fake-model"
+
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+        self.release = None
+
+    async def stream(self, messages):
+        self.calls += 1
+        if self.release is not None:
+            await self.release.wait()
+        if self.fail:
+            raise ChatBackendError("upstream error")
+        for token in ["re:", messages[-1]["content"]]:
+            yield token
+
+
+class TestChatCache(TestCase):
+    def setUp(self):
+        self.upstream = FakeChatBackend()
+        self.backend = CachedChatBackend(self.upstream, timeout=60, max_entries=2)
+
+    def complete(self, sentence, system_prompt=SYSTEM_PROMPT):
+        return asyncio.run(
+            self.backend.complete(build_messages(sentence, system_prompt))
+        )
+
+    def test_hit_with_normalised_sentence(self):
+        self.assertEquals(self.complete("こんにちは 世界"), "re:こんにちは 世界")
+        self.assertEquals(self.complete("  こんにちは　世界\n"), "re:こんにちは 世界")
+        self.assertEquals(self.upstream.calls, 1)
+        self.assertEquals(self.backend.stats, {"hits": 1, "misses": 1, "coalesced": 0})
+
+    def test_expose_stats_in_metrics(self):
+        metrics.registry.clear()
+        self.complete("こんにちは")
+        self.complete("こんにちは")
+        User.objects.create_user(
+            username="yamada",
+            email="asaka@test.com",
+            password="wasurenaide1108",
+            is_staff=True,
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEquals(
+            response.json()["counters"], {"chat_cache": {"hits": 1, "misses": 1}}
+        )
+
+    def test_miss_with_other_system_prompt(self):
+        self.complete("こんにちは")
+        self.complete("こんにちは", system_prompt="英語で応答してください")
+        self.assertEquals(self.upstream.calls, 2)
+
+    def test_expire_after_timeout(self):
+        with mock.patch("tweets.chat.time.monotonic", return_value=1000):
+            self.complete("こんにちは")
+        with mock.patch("tweets.chat.time.monotonic", return_value=1059):
+            self.complete("こんにちは")
+        self.assertEquals(self.upstream.calls, 1)
+        with mock.patch("tweets.chat.time.monotonic", return_value=1060):
+            self.complete("こんにちは")
+        self.assertEquals(self.upstream.calls, 2)
+
+    def test_evict_least_recently_used(self):
+        self.complete("a")
+        self.complete("b")
+        self.complete("a")
+        self.complete("c")
+        self.assertEquals(self.upstream.calls, 3)
+        # bがいちばん長く使われていないので捨てられている
+        self.complete("a")
+        self.complete("b")
+        self.assertEquals(self.upstream.calls, 4)
+
+    def test_coalesce_concurrent_requests(self):
+        async def run():
+            self.upstream.release = asyncio.Event()
+            messages = build_messages("こんにちは")
+            tasks = [
+                asyncio.create_task(self.backend.complete(messages)) for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            self.upstream.release.set()
+            return await asyncio.gather(*tasks)
+
+        self.assertEquals(asyncio.run(run()), ["re:こんにちは"] * 3)
+        self.assertEquals(self.upstream.calls, 1)
+        self.assertEquals(self.backend.stats, {"hits": 0, "misses": 1, "coalesced": 2})
+
+    def test_not_cache_error(self):
+        self.upstream.fail = True
+
+        async def run():
+            self.upstream.release = asyncio.Event()
+            messages = build_messages("こんにちは")
+            tasks = [
+                asyncio.create_task(self.backend.complete(messages)) for _ in range(2)
+            ]
+            await asyncio.sleep(0)
+            self.upstream.release.set()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, ChatBackendError) for r in results))
+        self.upstream.fail = False
+        self.assertEquals(self.complete("こんにちは"), "re:こんにちは")
+        self.assertEquals(self.upstream.calls, 2)
+
+
+class TestQueryCounts(TestCase):
+    def test_constant_with_data_size(self):
+        names = [
+            name
+            for name, _, url_name, _ in benchmark.SCENARIOS
+            if url_name.startswith("tweets:")
+        ]
+        report = benchmark.run([5, 30], names=names, repeat=1)
+
+        self.assertEquals(benchmark.query_count_changes(report), {})
+        for results in report["sizes"].values():
+            self.assertEquals(set(results), set(names))
+            for result in results.values():
+                self.assertLess(result["status"], 400)
+
+    def test_read_streaming_response(self):
+        # ストリームを最後まで読まないと、上流(のかわりのバックエンド)は呼ばれない
+        with mock.patch.object(
+            benchmark.BenchmarkChatBackend,
+            "stream",
+            autospec=True,
+            side_effect=benchmark.BenchmarkChatBackend.stream,
+        ) as stream:
+            report = benchmark.run([5], names=["chat_stream"], repeat=1)
+
+        self.assertEquals(report["sizes"]["5"]["chat_stream"]["status"], 200)
+        self.assertEquals(stream.call_count, 1)
+
+
+@override_settings(WRITE_BEHIND={"queue": "memory", "flush_interval": 0})
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f"user{i}",
+                email=f"user{i}@test.com",
+                password="wasurenaide1108",
+            )
+            for i in range(4)
+        ]
+        self.tweets = [
+            Tweet.objects.create(user=self.users[i % 4], contents=f"ツイート{i}")
+            for i in range(6)
+        ]
+        self.client.login(username="user0", password="wasurenaide1108")
+
+    def snapshot(self):
+        return {
+            "likes": set(Like.objects.values_list("user_id", "tweet_id")),
+            "follows": set(
+                FriendShip.objects.values_list("follower_id", "following_id")
+            ),
+            "like_counts": list(
+                Tweet.objects.order_by("pk").values_list("like_count", flat=True)
+            ),
+            "profile_counts": list(
+                Profile.objects.order_by("pk").values_list(
+                    "follower_count", "following_count"
+                )
+            ),
+            "timelines": set(TimelineEntry.objects.values_list("owner_id", "tweet_id")),
+        }
+
+    def test_like_with_optimistic_count(self):
+        response = self.client.post(
+            reverse("tweets:like", kwargs={"pk": self.tweets[1].pk})
+        )
+
+        self.assertEquals(response.json()["like_for_tweet_count"], 1)
+        self.assertFalse(Like.objects.exists())
+
+        self.assertEquals(writebehind.flush(), 1)
+        self.assertTrue(Like.objects.filter(user=self.users[0]).exists())
+        self.tweets[1].refresh_from_db()
+        self.assertEquals(self.tweets[1].like_count, 1)
+
+    def test_follow_after_flush(self):
+        response = self.client.post(
+            reverse("accounts:follow", kwargs={"username": "user1"})
+        )
+
+        self.assertEquals(response.status_code, 302)
+        self.assertFalse(FriendShip.objects.exists())
+        writebehind.flush()
+        self.assertTrue(
+            FriendShip.objects.filter(
+                follower=self.users[0], following=self.users[1]
+            ).exists()
+        )
+        self.assertEquals(Profile.objects.get(user=self.users[1]).follower_count, 1)
+        self.assertTrue(
+            TimelineEntry.objects.filter(
+                owner=self.users[0], author=self.users[1]
+            ).exists()
+        )
+
+    def test_file_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(WRITE_BEHIND={"queue": "file", "location": directory}):
+                writebehind.like(self.users[0].pk, self.tweets[0].pk)
+                writebehind.enqueue(
+                    writebehind.FOLLOW, self.users[0].pk, self.users[2].pk
+                )
+                self.assertEquals(len(writebehind.get_queue()), 2)
+
+                call_command("flush_write_behind", batch_size=1)
+
+                self.assertEquals(len(writebehind.get_queue()), 0)
+                self.assertEquals(os.listdir(directory), [])
+        self.assertEquals(Like.objects.count(), 1)
+        self.assertEquals(FriendShip.objects.count(), 1)
+
+    def test_same_as_sequential_execution(self):
+        rng = random.Random(0)
+        intents = []
+        for _ in range(300):
+            user = rng.choice(self.users).pk
+            if rng.random() < 0.5:
+                op = rng.choice([writebehind.LIKE, writebehind.UNLIKE])
+                intents.append((op, user, rng.choice(self.tweets).pk))
+            else:
+                op = rng.choice([writebehind.FOLLOW, writebehind.UNFOLLOW])
+                intents.append((op, user, rng.choice(self.users).pk))
+
+        # 1件ずつ直接書き込んだ結果を取ってから、ロールバックして元に戻す
+        with transaction.atomic():
+            for op, user_id, target_id in intents:
+                follower, following = User(pk=user_id), User(pk=target_id)
+                if op == writebehind.LIKE:
+                    likes.add_like(user_id, target_id)
+                elif op == writebehind.UNLIKE:
+                    likes.remove_like(user_id, target_id)
+                elif user_id == target_id:
+                    continue
+                elif op == writebehind.FOLLOW:
+                    FriendShip.objects.get_or_create(
+                        follower=follower, following=following
+                    )
+                    timeline.backfill(follower, following)
+                else:
+                    FriendShip.objects.filter(
+                        follower=follower, following=following
+                    ).delete()
+                    timeline.prune(follower, following)
+            expected = self.snapshot()
+            transaction.set_rollback(True)
+        self.assertFalse(Like.objects.exists())
+
+        for intent in intents:
+            writebehind.enqueue(*intent)
+        self.assertEquals(writebehind.flush(batch_size=7), len(intents))
+
+        self.assertEquals(self.snapshot(), expected)
+
+    def test_remove_more_pairs_than_expression_depth(self):
+        # 1バッチ(既定の1000件)の外す意図がSQLiteの式の深さの上限(1000)を超えても消せる
+        User.objects.bulk_create(
+            User(username=f"many{i}", email=f"many{i}@test.com") for i in range(40)
+        )
+        users = list(User.objects.filter(username__startswith="many"))
+        Profile.objects.bulk_create(Profile(user=user) for user in users)
+        Tweet.objects.bulk_create(
+            Tweet(user=self.users[1], contents=f"ツイート{i}") for i in range(1100)
+        )
+        tweets = list(Tweet.objects.filter(user=self.users[1]))
+        Like.objects.bulk_create(Like(user=self.users[0], tweet=t) for t in tweets)
+        follows = [(f, g) for f in users for g in users if f != g][:1100]
+        FriendShip.objects.bulk_create(
+            FriendShip(follower=f, following=g) for f, g in follows
+        )
+
+        for tweet in tweets:
+            writebehind.enqueue(writebehind.UNLIKE, self.users[0].pk, tweet.pk)
+        for follower, following in follows:
+            writebehind.enqueue(writebehind.UNFOLLOW, follower.pk, following.pk)
+        self.assertEquals(writebehind.flush(), len(tweets) + len(follows))
+
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(FriendShip.objects.exists())
+
+    def test_requeue_failed_batch(self):
+        queue = writebehind.get_queue()
+        writebehind.like(self.users[0].pk, self.tweets[0].pk)
+        with mock.patch.object(writebehind, "apply", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                writebehind.flush()
+        self.assertEquals(len(queue), 1)
+
+        self.assertEquals(writebehind.flush(), 1)
+        self.assertTrue(Like.objects.filter(user=self.users[0]).exists())
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+        self.tweets = [
+            Tweet.objects.create(user=self.user, contents=contents)
+            for contents in [
+                "東京 東京 東京の話",
+                "今日は東京で雨",
+                "東京タワーに登った",
+                "大阪は晴れ",
+                "Hello Django World",
+            ]
+        ]
+
+    def search_contents(self, query, order=search.RECENT, page_size=20):
+        ids, _ = search.search(query, page_size=page_size, order=order)
+        return [Tweet.objects.get(pk=pk).contents for pk in ids]
+
+    def test_japanese_substring(self):
+        self.assertEquals(
+            self.search_contents("東京"),
+            ["東京タワーに登った", "今日は東京で雨", "東京 東京 東京の話"],
+        )
+        self.assertEquals(self.search_contents("東京タワー"), ["東京タワーに登った"])
+        self.assertEquals(self.search_contents("京都"), [])
+
+    def test_single_character_and_case(self):
+        self.assertEquals(self.search_contents("雨"), ["今日は東京で雨"])
+        self.assertEquals(self.search_contents("django"), ["Hello Django World"])
+        self.assertEquals(self.search_contents("ＤＪＡＮＧＯ"), ["Hello Django World"])
+
+    def test_symbols_only_query(self):
+        self.assertEquals(self.search_contents('"*'), [])
+
+    def test_relevance_order(self):
+        self.assertEquals(
+            self.search_contents("東京", order=search.RELEVANCE)[0],
+            "東京 東京 東京の話",
+        )
+
+    def test_pagination(self):
+        for order in (search.RECENT, search.RELEVANCE):
+            ids = []
+            cursor = None
+            while True:
+                page, cursor = search.search("東京", cursor, 1, order)
+                ids += page
+                if cursor is None:
+                    break
+            self.assertEquals(len(ids), 3)
+            self.assertEquals(set(ids), set(search.search("東京")[0]))
+
+    def test_index_follows_update_and_delete(self):
+        tweet = self.tweets[3]
+        tweet.contents = "名古屋は曇り"
+        tweet.save()
+        self.assertEquals(self.search_contents("大阪"), [])
+        self.assertEquals(self.search_contents("名古屋"), ["名古屋は曇り"])
+
+        # _raw_deleteで消してもインデックスに残らない
+        Tweet.objects.filter(pk=tweet.pk)._raw_delete("default")
+        self.assertEquals(search.search("名古屋")[0], [])
+
+    def test_rebuild(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user, contents="一括で作った")])
+        self.assertEquals(self.search_contents("一括"), [])
+        call_command("rebuild_search_index", batch_size=2)
+        self.assertEquals(self.search_contents("一括"), ["一括で作った"])
+        self.assertEquals(len(self.search_contents("東京")), 3)
+
+    def test_token_table_index(self):
+        index = search.TokenTableIndex("default")
+        index.add(self.tweets)
+        terms = search.query_terms("東京")
+        ids = [pk for pk, _ in index.search(terms, None, 2, search.RECENT)]
+        self.assertEquals(ids, [self.tweets[2].pk, self.tweets[1].pk])
+        ids = [pk for pk, _ in index.search(terms, (ids[-1],), 2, search.RECENT)]
+        self.assertEquals(ids, [self.tweets[0].pk])
+        terms = search.query_terms("雨")
+        self.assertEquals(
+            index.search(terms, None, 2, search.RECENT), [(self.tweets[1].pk, 0)]
+        )
+
+    def test_search_view(self):
+        response = self.client.get(reverse("tweets:search"), {"q": "東京"})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            [tweet.contents for tweet in response.context["tweets_list"]],
+            ["東京タワーに登った", "今日は東京で雨", "東京 東京 東京の話"],
+        )
+
+        response = self.client.get(
+            reverse("tweets:search"), {"q": "東京", "cursor": "壊れた"}
+        )
+        self.assertEquals(response.status_code, 404)
+
+    def test_search_api(self):
+        response = self.client.get(
+            reverse("tweets:api_search"), {"q": "東京", "order": "relevance"}
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            response.json()["tweets"][0]["contents"], "東京 東京 東京の話"
+        )
+        self.assertIsNone(response.json()["next_cursor"])
+
+        response = self.client.get(
+            reverse("tweets:api_search"), {"q": "東京", "cursor": "壊れた"}
+        )
+        self.assertEquals(response.status_code, 400)
+
+
+class TestHashtagsAndMentions(TestCase):
+    def setUp(self):
+        self.user_1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user_2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.client.login(username="yamada", password="wasurenaide1108")
+
+    def test_extract(self):
+        self.assertEquals(
+            tags.extract_hashtags("#Django と ＃django と #映画 #2023 C# a#b"),
+            ["django", "映画"],
+        )
+        self.assertEquals(
+            tags.extract_mentions("@satou さん、@satou. mail@example.com @nobody"),
+            ["satou", "nobody"],
+        )
+
+    def test_create_view_saves_tags(self):
+        self.client.post(
+            reverse("tweets:create"), {"contents": "@satou #映画 見た #Django"}
+        )
+        tweet = Tweet.objects.get()
+        self.assertEquals(
+            set(Hashtag.objects.values_list("name", flat=True)), {"映画", "django"}
+        )
+        self.assertEquals(TweetHashtag.objects.filter(tweet=tweet).count(), 2)
+        mention = Mention.objects.get()
+        self.assertEquals((mention.tweet, mention.user), (tweet, self.user_2))
+        self.assertEquals(mention.created_at, tweet.created_at)
+
+    def test_hashtag_timeline(self):
+        for i in range(5):
+            self.client.post(reverse("tweets:create"), {"contents": f"#映画 {i}"})
+        self.client.post(reverse("tweets:create"), {"contents": "#ドラマ"})
+
+        contents = []
+        cursor = None
+        while True:
+            response = self.client.get(
+                reverse("tweets:hashtag", kwargs={"name": "映画"}),
+                {"cursor": cursor} if cursor else {},
+            )
+            self.assertEquals(response.status_code, 200)
+            contents += [tweet.contents for tweet in response.context["tweets_list"]]
+            cursor = response.context["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEquals(contents, [f"#映画 {i}" for i in reversed(range(5))])
+
+        response = self.client.get(
+            reverse("tweets:api_hashtag", kwargs={"name": "ドラマ"})
+        )
+        self.assertEquals(
+            [tweet["contents"] for tweet in response.json()["tweets"]], ["#ドラマ"]
+        )
+
+    def test_mentions_timeline(self):
+        self.client.post(reverse("tweets:create"), {"contents": "@satou こんにちは"})
+        self.client.post(reverse("tweets:create"), {"contents": "@yamada 自分宛て"})
+
+        self.client.login(username="satou", password="wasuretene1108")
+        response = self.client.get(reverse("tweets:mentions"))
+        self.assertEquals(
+            [tweet.contents for tweet in response.context["tweets_list"]],
+            ["@satou こんにちは"],
+        )
+        response = self.client.get(reverse("tweets:api_mentions"))
+        self.assertEquals(
+            [tweet["contents"] for tweet in response.json()["tweets"]],
+            ["@satou こんにちは"],
+        )
+
+    def test_backfill_and_delete(self):
+        Tweet.objects.bulk_create(
+            [Tweet(user=self.user_1, contents=f"#古い @satou {i}") for i in range(5)]
+        )
+        self.assertFalse(TweetHashtag.objects.exists())
+        call_command("backfill_tags", batch_size=2)
+        # 2回流しても重複しない
+        call_command("backfill_tags", batch_size=2)
+        self.assertEquals(TweetHashtag.objects.count(), 5)
+        self.assertEquals(Mention.objects.filter(user=self.user_2).count(), 5)
+
+        call_command("delete_tweets", usernames=["yamada"])
+        self.assertFalse(TweetHashtag.objects.exists())
+        self.assertFalse(Mention.objects.exists())
+
+
+@override_settings(
+    TRENDING_WINDOW_MINUTES=60, TRENDING_HALF_LIFE_MINUTES=15, TRENDING_TOP_K=20
+)
+class TestTrending(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create_user(
+                username=f"user{i}",
+                email=f"user{i}@test.com",
+                password="wasurenaide1108",
+            )
+            for i in range(3)
+        ]
+        self.client.login(username="user0", password="wasurenaide1108")
+        self.now = trending.minute_of(timezone.now())
+
+    def create_tweet(self, contents):
+        tweet = Tweet.objects.create(user=self.users[0], contents=contents)
+        tags.save_tags([tweet])
+        return tweet
+
+    def bucket(self, tweet, minutes_ago, count):
+        return LikeBucket.objects.create(
+            tweet=tweet, minute=self.now - timedelta(minutes=minutes_ago), count=count
+        )
+
+    def test_like_and_unlike_update_bucket(self):
+        tweet = self.create_tweet("ワンピース")
+        likes.add_like(self.users[1].pk, tweet.pk)
+        likes.add_like(self.users[2].pk, tweet.pk)
+        # 2回目は数えない
+        likes.add_like(self.users[2].pk, tweet.pk)
+        self.assertEquals(
+            list(LikeBucket.objects.values_list("tweet_id", "count")), [(tweet.pk, 2)]
+        )
+        likes.remove_like(self.users[1].pk, tweet.pk)
+        likes.remove_like(self.users[1].pk, tweet.pk)
+        self.assertEquals(LikeBucket.objects.get().count, 1)
+
+    def test_recent_likes_rank_higher(self):
+        old = self.create_tweet("昔バズった")
+        new = self.create_tweet("いまバズっている")
+        outside = self.create_tweet("窓の外")
+        self.bucket(old, 50, 5)
+        self.bucket(new, 1, 2)
+        self.bucket(outside, 90, 100)
+        result = trending.compute(self.now)
+        self.assertEquals([pk for pk, _ in result["tweets"]], [new.pk, old.pk])
+        # 50分前の5件は半減期15分で約0.5件分
+        self.assertAlmostEqual(result["tweets"][1][1], 5 * 0.5 ** (50 / 15))
+
+    def test_hashtags_sum_scores_of_tweets(self):
+        first = self.create_tweet("#映画 #ドラマ")
+        second = self.create_tweet("#映画")
+        third = self.create_tweet("#アニメ")
+        self.bucket(first, 0, 1)
+        self.bucket(second, 0, 1)
+        self.bucket(third, 0, 3)
+        result = trending.compute(self.now)
+        self.assertEquals(
+            result["hashtags"], [("アニメ", 3.0), ("映画", 2.0), ("ドラマ", 1.0)]
+        )
+
+    @override_settings(TRENDING_TOP_K=2)
+    def test_top_k(self):
+        tweets = [self.create_tweet(f"ツイート{i}") for i in range(4)]
+        for i, tweet in enumerate(tweets):
+            self.bucket(tweet, 0, i + 1)
+        self.assertEquals(
+            [pk for pk, _ in trending.compute(self.now)["tweets"]],
+            [tweets[3].pk, tweets[2].pk],
+        )
+
+    def test_compact(self):
+        tweet = self.create_tweet("ワンピース")
+        self.bucket(tweet, 61, 3)
+        self.bucket(tweet, 5, 0)
+        kept = self.bucket(tweet, 1, 1)
+        self.assertEquals(trending.compact(self.now), 2)
+        self.assertEquals(list(LikeBucket.objects.all()), [kept])
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_compact_deletes_on_primary(self):
+        tweet = self.create_tweet("ワンピース")
+        self.bucket(tweet, 61, 3)
+        # リクエストの中で読み込みがレプリカに向いていても、消すのはdefault
+        with routing():
+            self.assertEquals(trending.compact(self.now), 1)
+        self.assertFalse(LikeBucket.objects.exists())
+
+    def test_cached_until_refresh(self):
+        tweet = self.create_tweet("ワンピース")
+        self.assertEquals(trending.get_trending()["tweets"], [])
+        likes.add_like(self.users[1].pk, tweet.pk)
+        self.assertEquals(trending.get_trending()["tweets"], [])
+
+        call_command("compact_like_buckets")
+        self.assertEquals(
+            [pk for pk, _ in trending.get_trending()["tweets"]], [tweet.pk]
+        )
+
+    def test_rebuild(self):
+        tweet = self.create_tweet("ワンピース")
+        Like.objects.bulk_create(
+            [Like(user=user, tweet=tweet) for user in self.users[1:]]
+        )
+        self.bucket(tweet, 0, 10)
+        call_command("compact_like_buckets", rebuild=True)
+        self.assertEquals(sum(LikeBucket.objects.values_list("count", flat=True)), 2)
+
+    @override_settings(WRITE_BEHIND={"queue": "memory", "flush_interval": 0})
+    def test_write_behind_rebuilds_buckets(self):
+        tweet = self.create_tweet("ワンピース")
+        writebehind.like(self.users[1].pk, tweet.pk)
+        writebehind.flush()
+        self.assertEquals(LikeBucket.objects.get(tweet=tweet).count, 1)
+
+    def test_view(self):
+        tweets = [self.create_tweet(f"#映画 {i}") for i in range(3)]
+        for i, tweet in enumerate(tweets):
+            self.bucket(tweet, 0, i + 1)
+        response = self.client.get(reverse("tweets:trending"))
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, "tweets/trending.html")
+        self.assertEquals(list(response.context["tweets_list"]), list(reversed(tweets)))
+        self.assertEquals(response.context["hashtags"], ["映画"])
+        self.assertContains(response, reverse("tweets:hashtag", args=["映画"]))
+
+        # キャッシュしたあとに消えたツイートは出さない
+        tweets[2].delete()
+        response = self.client.get(reverse("tweets:trending"))
+        self.assertEquals(list(response.context["tweets_list"]), [tweets[1], tweets[0]])
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = self.settings(ARCHIVE_ROOT=self.directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user_1 = User.objects.create_user(
+            username="yamada", email="asaka@test.com", password="wasurenaide1108"
+        )
+        self.user_2 = User.objects.create_user(
+            username="satou", email="wakou@test.com", password="wasuretene1108"
+        )
+        self.client.login(username="satou", password="wasuretene1108")
+        self.old = [
+            Tweet.objects.create(user=self.user_1, contents=f"#昔 {i}")
+            for i in range(3)
+        ]
+        self.new = Tweet.objects.create(user=self.user_1, contents="最近")
+        tags.save_tags(self.old)
+        likes.add_like(self.user_2.pk, self.old[0].pk)
+        # 2か月にまたがるようにする
+        Tweet.objects.filter(pk__in=[self.old[0].pk, self.old[1].pk]).update(
+            created_at=datetime(2020, 1, 31, 12, tzinfo=dt_timezone.utc)
+        )
+        Tweet.objects.filter(pk=self.old[2].pk).update(
+            created_at=datetime(2020, 2, 1, 12, tzinfo=dt_timezone.utc)
+        )
+
+    def test_archive_old_tweets(self):
+        call_command("archive_tweets", days=30, batch_size=1)
+
+        self.assertEquals(list(Tweet.objects.all()), [self.new])
+        self.assertFalse(Like.objects.exists())
+        self.assertFalse(TweetHashtag.objects.exists())
+        self.assertEquals(Profile.objects.get(user=self.user_1).tweet_count, 1)
+        self.assertEquals(
+            sorted(os.listdir(self.directory.name)),
+            ["2020-01.jsonl.gz", "2020-02.jsonl.gz"],
+        )
+        # 書き足したメンバーをつなげたまま1つのgzipとして読める
+        with gzip.open(os.path.join(self.directory.name, "2020-01.jsonl.gz")) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEquals(
+            [record["id"] for record in records], [self.old[0].pk, self.old[1].pk]
+        )
+        self.assertEquals(records[0]["likes"][0][0], self.user_2.pk)
+
+        stubs = ArchivedTweet.objects.order_by("pk")
+        self.assertEquals([stub.pk for stub in stubs], [tweet.pk for tweet in self.old])
+        # batch-size=1なので、1月の2件は別々のメンバーに入る
+        self.assertNotEqual(stubs[0].offset, stubs[1].offset)
+        for stub, tweet in zip(stubs, self.old):
+            self.assertEquals(archive.read_record(stub)["contents"], tweet.contents)
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_read_batch_from_primary(self):
+        # 読み込みがレプリカに向いていても、書き出す行はdefaultから読む
+        with routing():
+            stats = archive.archive_batch([self.old[0].pk])
+        self.assertEquals((stats["tweets"], stats["likes"]), (1, 1))
+        record = archive.read_record(ArchivedTweet.objects.get(pk=self.old[0].pk))
+        self.assertEquals([user_id for user_id, _ in record["likes"]], [self.user_2.pk])
+
+    def test_keep_recent_tweets(self):
+        call_command("archive_tweets", days=365 * 100)
+        self.assertEquals(Tweet.objects.count(), 4)
+        self.assertFalse(ArchivedTweet.objects.exists())
+
+    def test_detail_rehydrates_archived_tweet(self):
+        call_command("archive_tweets", days=30)
+        url = reverse("tweets:detail", kwargs={"pk": self.old[0].pk})
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, "#昔 0")
+        self.assertTrue(response.context["archived"])
+        self.assertTrue(response.context["is_user_liked_for_tweet"])
+        self.assertEquals(response.context["like_for_tweet_count"], 1)
+        self.assertNotContains(
+            response, reverse("tweets:delete", args=[self.old[0].pk])
+        )
+
+        # 2回目はキャッシュから読むのでファイルを開かない
+        with mock.patch("builtins.open", side_effect=AssertionError):
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+
+        response = self.client.get(reverse("tweets:detail", kwargs={"pk": 9999}))
+        self.assertEquals(response.status_code, 404)
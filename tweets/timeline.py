@@ -0,0 +1,171 @@
+"""
+フォローしているユーザーのツイートだけを表示するホームタイムライン。
+
+普通のユーザーのツイートはツイート時にフォロワー全員のTimelineEntryへ書き込む(fan-out-on-write)。
+フォロワーがsettings.TIMELINE_FANOUT_LIMIT人以上いるユーザーは1ツイートで大量の書き込みが
+発生してしまうので配らず、読み込み時にそのユーザーのツイートを直接取ってきて混ぜる(fan-out-on-read)。
+"""
+
+from itertools import groupby, islice
+from operator import attrgetter
+
+from django.conf import settings
+
+from accounts.models import FriendShip, Profile
+
+from .models import TimelineEntry, Tweet
+from .pagination import encode_cursor, filter_by_cursor
+
+FANOUT_BATCH_SIZE = 1000
+
+
+def is_celebrity(user):
+    follower_count = (
+        Profile.objects.filter(pk=user.pk)
+        .values_list("follower_count", flat=True)
+        .first()
+    )
+    return (follower_count or 0) >= settings.TIMELINE_FANOUT_LIMIT
+
+
+def celebrity_ids_followed_by(user):
+    """userがフォローしているユーザーのうち、fan-outしない(フォロワーが多すぎる)ユーザーのid"""
+    return list(
+        FriendShip.objects.filter(
+            follower=user,
+            following__profile__follower_count__gte=settings.TIMELINE_FANOUT_LIMIT,
+        ).values_list("following_id", flat=True)
+    )
+
+
+def _entries(owner_ids, tweets):
+    return [
+        TimelineEntry(
+            owner_id=owner_id,
+            tweet_id=tweet.pk,
+            author_id=tweet.user_id,
+            created_at=tweet.created_at,
+        )
+        for owner_id in owner_ids
+        for tweet in tweets
+    ]
+
+
+def fan_out(tweet):
+    """新しいツイートを本人とフォロワーのタイムラインに配る"""
+    TimelineEntry.objects.bulk_create(
+        _entries([tweet.user_id], [tweet]), ignore_conflicts=True
+    )
+    if is_celebrity(tweet.user):
+        return
+
+    follower_ids = (
+        FriendShip.objects.filter(following_id=tweet.user_id)
+        .values_list("follower_id", flat=True)
+        .iterator(chunk_size=FANOUT_BATCH_SIZE)
+    )
+    batch = []
+    for follower_id in follower_ids:
+        batch.append(follower_id)
+        if len(batch) >= FANOUT_BATCH_SIZE:
+            TimelineEntry.objects.bulk_create(
+                _entries(batch, [tweet]), ignore_conflicts=True
+            )
+            batch = []
+    if batch:
+        TimelineEntry.objects.bulk_create(
+            _entries(batch, [tweet]), ignore_conflicts=True
+        )
+
+
+def backfill(follower, following):
+    """フォローした直後に、相手の最近のツイートを自分のタイムラインに入れる"""
+    if is_celebrity(following):
+        # 読み込み時に混ぜるので書き込まなくてよい
+        return
+    tweets = Tweet.objects.filter(user=following).order_by("-created_at", "-id")[
+        : settings.TIMELINE_BACKFILL_SIZE
+    ]
+    TimelineEntry.objects.bulk_create(
+        _entries([follower.pk], tweets), ignore_conflicts=True
+    )
+
+
+def prune(follower, following):
+    """フォローを外したら相手のツイートを自分のタイムラインから消す"""
+    TimelineEntry.objects.filter(owner=follower, author=following).delete()
+
+
+def rebuild(user):
+    """userのタイムラインを作り直す。既存データの移行やbulk_createで作ったツイート用"""
+    TimelineEntry.objects.filter(owner=user).delete()
+    author_ids = [user.pk] + list(
+        FriendShip.objects.filter(follower=user).values_list("following_id", flat=True)
+    )
+    celebrity_ids = set(celebrity_ids_followed_by(user))
+    # 全員分を1回で新しい順に読み、1人あたりTIMELINE_BACKFILL_SIZE件までにする
+    tweets = (
+        Tweet.objects.filter(
+            user_id__in=[pk for pk in author_ids if pk not in celebrity_ids]
+        )
+        .order_by("user_id", "-created_at", "-id")
+        .only("pk", "user_id", "created_at")
+        .iterator(chunk_size=FANOUT_BATCH_SIZE)
+    )
+    recent = [
+        tweet
+        for _, by_author in groupby(tweets, key=attrgetter("user_id"))
+        for tweet in islice(by_author, settings.TIMELINE_BACKFILL_SIZE)
+    ]
+    TimelineEntry.objects.bulk_create(
+        _entries([user.pk], recent),
+        ignore_conflicts=True,
+        batch_size=FANOUT_BATCH_SIZE,
+    )
+
+
+def home_timeline_rows(user, cursor=None, page_size=20):
+    """
+    userのホームタイムラインの1ページ分を(created_at, ツイートのid, 投稿者のid)のリストで返す。
+    Tweetテーブルは有名人のツイートを混ぜるときしか読まない。
+    返り値は(行のリスト, 次のページのカーソル or None)
+    """
+    entries = filter_by_cursor(
+        TimelineEntry.objects.filter(owner=user).values_list(
+            "created_at", "tweet_id", "author_id"
+        ),
+        cursor,
+        keys=("created_at", "tweet_id"),
+    )
+    candidates = list(entries[: page_size + 1])
+
+    celebrity_ids = celebrity_ids_followed_by(user)
+    if celebrity_ids:
+        pulled = filter_by_cursor(
+            Tweet.objects.filter(user_id__in=celebrity_ids).values_list(
+                "created_at", "id", "user_id"
+            ),
+            cursor,
+        )
+        # fan-outしていた頃のエントリと重複することがあるのでsetでまとめる
+        candidates = sorted(
+            set(candidates) | set(pulled[: page_size + 1]), reverse=True
+        )
+
+    page = candidates[:page_size]
+    next_cursor = encode_cursor(*page[-1][:2]) if len(candidates) > page_size else None
+    return page, next_cursor
+
+
+def home_timeline(user, cursor=None, page_size=20):
+    """
+    userのホームタイムラインの1ページ分を返す。
+    返り値は(ツイートのqueryset, 次のページのカーソル or None)
+    """
+    rows, next_cursor = home_timeline_rows(user, cursor, page_size)
+    tweets = (
+        Tweet.objects.filter(pk__in=[pk for _, pk, _ in rows])
+        .select_related("user")
+        .order_by("-created_at", "-id")
+    )
+    return tweets, next_cursor
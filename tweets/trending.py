@@ -0,0 +1,139 @@
+"""
+トレンド(いいねの勢いでツイートとハッシュタグを並べる)。
+
+いいね/いいね解除のたびにLikeBucket(ツイートごと・1分ごとのいいね数)を増減させておき、
+トレンドは直近TRENDING_WINDOW_MINUTES分のバケツだけを読んで計算する。
+古いバケツほど効きが小さくなるように、TRENDING_HALF_LIFE_MINUTESごとに重みを半分にする。
+
+計算した上位TRENDING_TOP_K件はキャッシュに入れておき、ページはそれを読むだけにする。
+compact_like_bucketsコマンドが窓より古いバケツを消して、キャッシュを作り直す
+"""
+
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+from heapq import nlargest
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+from django.db.models import Count, Q
+from django.db.models.functions import TruncMinute
+from django.utils import timezone
+
+from .models import Like, LikeBucket, TweetHashtag
+
+CACHE_KEY = "trending"
+
+
+def minute_of(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def _quote(connection, field=None):
+    if field is None:
+        return connection.ops.quote_name(LikeBucket._meta.db_table)
+    return connection.ops.quote_name(LikeBucket._meta.get_field(field).column)
+
+
+def record(cursor, connection, tweet_id, liked_at, delta):
+    """
+    liked_atの1分のバケツをdeltaだけ増減させる。likes.pyのトランザクションの中から呼ぶ。
+    いいねのときはバケツがなければ作り、いいね解除のときはバケツがなければ何もしない
+    """
+    table = _quote(connection)
+    tweet, minute, count = (_quote(connection, f) for f in ("tweet", "minute", "count"))
+    minute_value = LikeBucket._meta.get_field("minute").get_db_prep_save(
+        minute_of(liked_at), connection
+    )
+    if delta > 0:
+        # SQLiteとPostgreSQLのどちらも使えるUPSERT
+        cursor.execute(
+            f"INSERT INTO {table} ({tweet}, {minute}, {count}) VALUES (%s, %s, %s) "
+            f"ON CONFLICT ({tweet}, {minute}) "
+            f"DO UPDATE SET {count} = {table}.{count} + excluded.{count}",
+            [tweet_id, minute_value, delta],
+        )
+    else:
+        cursor.execute(
+            f"UPDATE {table} SET {count} = {count} + %s "
+            f"WHERE {tweet} = %s AND {minute} = %s",
+            [delta, tweet_id, minute_value],
+        )
+
+
+def window_start(now=None):
+    now = now or timezone.now()
+    return minute_of(now) - timedelta(minutes=settings.TRENDING_WINDOW_MINUTES)
+
+
+def rebuild_buckets(tweet_ids=None, since=None):
+    """
+    Likeテーブルからバケツを作り直す。tweet_idsを渡せばそのツイートだけ。
+    シグナルを飛ばさずにいいねを書き込んだとき(write-behind)や、ずれを直すときに使う
+    """
+    since = since or window_start()
+    buckets = LikeBucket.objects.filter(minute__gte=since)
+    likes = Like.objects.filter(created_at__gte=since)
+    if tweet_ids is not None:
+        buckets = buckets.filter(tweet_id__in=tweet_ids)
+        likes = likes.filter(tweet_id__in=tweet_ids)
+    buckets.delete()
+    LikeBucket.objects.bulk_create(
+        LikeBucket(tweet_id=row["tweet_id"], minute=row["minute"], count=row["count"])
+        for row in likes.annotate(
+            minute=TruncMinute("created_at", tzinfo=dt_timezone.utc)
+        )
+        .values("tweet_id", "minute")
+        .annotate(count=Count("*"))
+        .order_by()
+    )
+
+
+def tweet_scores(now=None):
+    """{ツイートのid: 直近の窓の減衰付きいいね数}"""
+    now = now or timezone.now()
+    half_life = settings.TRENDING_HALF_LIFE_MINUTES * 60
+    scores = {}
+    rows = LikeBucket.objects.filter(minute__gte=window_start(now), count__gt=0)
+    for tweet_id, minute, count in rows.values_list("tweet_id", "minute", "count"):
+        age = max((now - minute).total_seconds(), 0)
+        scores[tweet_id] = scores.get(tweet_id, 0) + count * 0.5 ** (age / half_life)
+    return scores
+
+
+def compute(now=None):
+    """上位のツイートとハッシュタグを[(id or タグ名, スコア)]でスコアの高い順に返す"""
+    top_k = settings.TRENDING_TOP_K
+    scores = tweet_scores(now)
+    hashtag_scores = {}
+    if scores:
+        rows = TweetHashtag.objects.filter(tweet_id__in=list(scores)).values_list(
+            "tweet_id", "hashtag__name"
+        )
+        for tweet_id, name in rows:
+            hashtag_scores[name] = hashtag_scores.get(name, 0) + scores[tweet_id]
+    return {
+        "tweets": nlargest(top_k, scores.items(), key=lambda item: item[1]),
+        "hashtags": nlargest(top_k, hashtag_scores.items(), key=lambda item: item[1]),
+    }
+
+
+def refresh(now=None):
+    trending = compute(now)
+    cache.set(CACHE_KEY, trending, settings.TRENDING_CACHE_SECONDS)
+    return trending
+
+
+def get_trending():
+    """キャッシュしてある上位K件。切れていれば計算し直す"""
+    trending = cache.get(CACHE_KEY)
+    if trending is None:
+        trending = refresh()
+    return trending
+
+
+def compact(now=None):
+    """窓より古いバケツと空になったバケツを消して、消した数を返す"""
+    stale = LikeBucket.objects.filter(Q(minute__lt=window_start(now)) | Q(count__lte=0))
+    # stale.dbは読み込み用(レプリカ)の振り分けなので、消すのは書き込み用のDBで
+    return stale._raw_delete(router.db_for_write(LikeBucket))
@@ -1,13 +1,24 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 app_name = "tweets"
 urlpatterns = [
     path("create/", views.TweetCreateView.as_view(), name="create"),
-    path("chat/", views.ChatView.as_view(), name="chat"),
+    path("search/", views.TweetSearchView.as_view(), name="search"),
+    path("tags/<str:name>/", views.HashtagView.as_view(), name="hashtag"),
+    path("mentions/", views.MentionsView.as_view(), name="mentions"),
+    path("trending/", views.TrendingView.as_view(), name="trending"),
+    path("chat/", views.ChatView, name="chat"),
+    path("chat/stream/", views.ChatStreamView, name="chat_stream"),
     path("<int:pk>/", views.TweetDetailView.as_view(), name="detail"),
     path("<int:pk>/delete/", views.TweetDeleteView.as_view(), name="delete"),
     path("<int:pk>/like/", views.LikeView, name="like"),
     path("<int:pk>/unlike/", views.UnlikeView, name="unlike"),
+    path("api/home/", api.HomeTimelineApiView, name="api_home"),
+    path("api/users/<int:pk>/", api.UserTimelineApiView, name="api_user_timeline"),
+    path("api/search/", api.SearchApiView, name="api_search"),
+    path("api/tags/<str:name>/", api.HashtagApiView, name="api_hashtag"),
+    path("api/mentions/", api.MentionsApiView, name="api_mentions"),
+    path("api/<int:pk>/", api.TweetApiView, name="api_detail"),
 ]
@@ -1,17 +1,31 @@
-import os
+import json
 
-import openai
+from asgiref.sync import sync_to_async
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import Http404, HttpResponse, JsonResponse
-from django.shortcuts import get_object_or_404
-from django.template import loader
+from django.db import transaction
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
-from django.views.generic import CreateView, DeleteView, DetailView, View
-from dotenv import load_dotenv
+from django.views.decorators.http import require_POST
+from django.views.generic import CreateView, DeleteView, DetailView, ListView
 
+from mysite.streaming import AsyncStreamingHttpResponse
+
+from . import (
+    archive,
+    fragments,
+    likes,
+    search,
+    tags,
+    timeline,
+    trending,
+    writebehind,
+)
+from .chat import ChatBackendError, build_messages, get_chat_backend
 from .forms import ChatForm, TweetForm
-from .models import Like, Tweet
+from .models import ArchivedTweet, Tweet
+from .pagination import CursorPaginationMixin
 
 # Create your views here.
 
@@ -26,24 +40,44 @@ class TweetCreateView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        with transaction.atomic():
+            response = super().form_valid(form)
+            timeline.fan_out(self.object)
+            tags.save_tags([self.object])
+        return response
 
 
 class TweetDetailView(LoginRequiredMixin, DetailView):
     model = Tweet
     template_name = "tweets/tweets_detail.html"
 
+    def get_queryset(self):
+        return (
+            super()
+            .get_queryset()
+            .select_related("user")
+            .with_viewer_state(self.request.user)
+        )
+
+    def get_object(self, queryset=None):
+        try:
+            return super().get_object(queryset)
+        except Http404:
+            # アーカイブしたツイートならファイルから読んで戻す
+            stub = (
+                ArchivedTweet.objects.select_related("user")
+                .filter(pk=self.kwargs["pk"])
+                .first()
+            )
+            if stub is None:
+                raise
+            return archive.rehydrate(stub, self.request.user)
+
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
-        user = self.request.user
-        like_for_tweet_count = self.object.like_set.count()
-        context["like_for_tweet_count"] = like_for_tweet_count
-        context["liked_list"] = Like.objects.filter(user=user).values_list(
-            "tweet", flat=True
-        )
-        context["is_user_liked_for_tweet"] = self.object.like_set.filter(
-            user=user
-        ).exists()
+        context["like_for_tweet_count"] = self.object.like_count
+        context["is_user_liked_for_tweet"] = self.object.is_liked_by_viewer
+        context["archived"] = getattr(self.object, "archived", False)
         return context
 
 
@@ -61,67 +95,191 @@ class TweetDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
             return Http404
 
 
+@require_POST
 @login_required
 def LikeView(request, pk, *args, **kwargs):
-
-    tweet = get_object_or_404(Tweet, pk=pk)
-    Like.objects.get_or_create(user=request.user, tweet=tweet)
-    context = {
-        "like_for_tweet_count": tweet.like_set.count(),
-        "tweet_pk": tweet.pk,
-    }
-    return JsonResponse(context)
+    """いいねする。何度呼んでも1回いいねしたのと同じ"""
+    try:
+        if writebehind.is_enabled():
+            like_count = writebehind.like(request.user.pk, pk)
+        else:
+            like_count = likes.add_like(request.user.pk, pk)
+    except Tweet.DoesNotExist:
+        raise Http404
+    return JsonResponse({"like_for_tweet_count": like_count, "tweet_pk": pk})
 
 
+@require_POST
 @login_required
 def UnlikeView(request, pk, *args, **kwargs):
+    """いいねを取り消す。いいねしていなければ何もしない"""
+    try:
+        if writebehind.is_enabled():
+            like_count = writebehind.unlike(request.user.pk, pk)
+        else:
+            like_count = likes.remove_like(request.user.pk, pk)
+    except Tweet.DoesNotExist:
+        raise Http404
+    return JsonResponse({"like_for_tweet_count": like_count, "tweet_pk": pk})
 
-    tweet = get_object_or_404(Tweet, pk=pk)
-    like = Like.objects.filter(user=request.user, tweet=tweet)
 
-    if like.exists():
-        like.delete()
-        context = {
-            "like_for_tweet_count": tweet.like_set.count(),
-            "tweet_pk": tweet.pk,
-        }
-        return JsonResponse(context)
-    else:
-        return JsonResponse(404, safe=False)
-
-
-class ChatView(View):
-    template_name = "tweets/chat.html"
-    load_dotenv()
-
-    def render_template(self, context):
-        template = loader.get_template(self.template_name)
-        return HttpResponse(template.render(context, self.request))
-
-    def get(self, request):
-        form = ChatForm()
-        context = {"form": form, "chat_results": ""}
-        return self.render_template(context)
-
-    def post(self, request):
-        form = ChatForm(request.POST)
-        if form.is_valid():
-            sentence = form.cleaned_data["sentence"]
-
-            # TODO: API\KEYを直接書きこむ事は絶対に避ける！！
-            openai.api_key = os.getenv("API_KEY")
-
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "日本語で応答してください"},
-                    {"role": "user", "content": sentence},
-                ],
+class TaggedTweetListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    """
+    サブクラスのtimeline_ids(tags.pyの関数)にget_subject()とカーソルを渡して、
+    返ってきたidのツイートを新しい順に表示する。get_subject()は既定でログインしているユーザー
+    """
+
+    model = Tweet
+    template_name = "tweets/tweet_list.html"
+    context_object_name = "tweets_list"
+
+    def get_queryset(self):
+        return Tweet.objects.none()
+
+    def get_subject(self):
+        return self.request.user
+
+    def get_cursor_page(self, queryset, cursor, page_size):
+        ids, next_cursor = self.timeline_ids(self.get_subject(), cursor, page_size)
+        tweets = fragments.attach_tweet_versions(
+            tags.tweets_by_ids(ids).with_viewer_state(self.request.user)
+        )
+        return tweets, next_cursor
+
+
+class HashtagView(TaggedTweetListView):
+    timeline_ids = staticmethod(tags.hashtag_timeline_ids)
+
+    def get_subject(self):
+        return self.kwargs["name"]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["heading"] = f"#{tags.normalise_hashtag(self.kwargs['name'])}"
+        return context
+
+
+class MentionsView(TaggedTweetListView):
+    """ログインしているユーザーへの@メンション"""
+
+    timeline_ids = staticmethod(tags.mentions_timeline_ids)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["heading"] = f"@{self.request.user.username}へのメンション"
+        return context
+
+
+class TrendingView(LoginRequiredMixin, ListView):
+    """直近のいいねの勢いで並べたツイートとハッシュタグ(キャッシュしてある上位K件)"""
+
+    model = Tweet
+    template_name = "tweets/trending.html"
+    context_object_name = "tweets_list"
+
+    def get_queryset(self):
+        self.trending = trending.get_trending()
+        rank = {pk: i for i, (pk, _) in enumerate(self.trending["tweets"])}
+        tweets = fragments.attach_tweet_versions(
+            Tweet.objects.filter(pk__in=rank)
+            .select_related("user")
+            .with_viewer_state(self.request.user)
+        )
+        # キャッシュしたあとに消えたツイートは出さない
+        return sorted(tweets, key=lambda tweet: rank[tweet.pk])
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["hashtags"] = [name for name, _ in self.trending["hashtags"]]
+        return context
+
+
+class TweetSearchView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    """?q=...を含むツイート。?order=relevanceで一致度順、それ以外は新しい順"""
+
+    model = Tweet
+    template_name = "tweets/search.html"
+    context_object_name = "tweets_list"
+
+    def get_queryset(self):
+        return Tweet.objects.none()
+
+    def get_order(self):
+        order = self.request.GET.get("order")
+        return order if order == search.RELEVANCE else search.RECENT
+
+    def get_cursor_page(self, queryset, cursor, page_size):
+        ids, next_cursor = search.search(
+            self.request.GET.get("q", ""), cursor, page_size, self.get_order()
+        )
+        tweets = Tweet.objects.filter(pk__in=ids).select_related("user")
+        by_id = {
+            tweet.pk: tweet
+            for tweet in fragments.attach_tweet_versions(
+                tweets.with_viewer_state(self.request.user)
             )
+        }
+        return [by_id[pk] for pk in ids if pk in by_id], next_cursor
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.request.GET.get("q", "")
+        context["order"] = self.get_order()
+        return context
+
+
+async def render_chat(request, context):
+    # テンプレートはrequest.userを読むのでDBアクセスが起きる。同期のスレッドで描画する
+    return await sync_to_async(render)(request, "tweets/chat.html", context)
+
+
+async def ChatView(request):
+    """
+    非同期ビュー。ASGIで動かせば、応答を待っている間もワーカーが他のリクエストを処理できる。
+    JavaScriptが有効なときはChatStreamViewから逐次受け取り、こちらのPOSTはその代わりに使う
+    """
+    if request.method != "POST":
+        return await render_chat(request, {"form": ChatForm(), "chat_results": ""})
+
+    form = ChatForm(request.POST)
+    chat_results = ""
+    if form.is_valid():
+        messages = build_messages(form.cleaned_data["sentence"])
+        try:
+            chat_results = await get_chat_backend().complete(messages)
+        except ChatBackendError:
+            chat_results = "ChatGPTから応答がありませんでした"
+    return await render_chat(request, {"form": form, "chat_results": chat_results})
+
+
+def server_sent_event(data, event=None):
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_chat(messages):
+    try:
+        async for token in get_chat_backend().stream(messages):
+            yield server_sent_event(token)
+    except ChatBackendError:
+        yield server_sent_event("ChatGPTから応答がありませんでした", event="error")
+    yield server_sent_event("", event="done")
 
-            chat_results = response["choices"][0]["message"]["content"]
-        else:
-            chat_results = ""
 
-        context = {"form": form, "chat_results": chat_results}
-        return self.render_template(context)
+async def ChatStreamView(request):
+    """応答をトークンごとにtext/event-streamで流す"""
+    # Django 4.0のrequire_POSTは非同期ビューに使えないので自分で見る
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    form = ChatForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    messages = build_messages(form.cleaned_data["sentence"])
+    response = AsyncStreamingHttpResponse(
+        stream_chat(messages), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # nginxなどのプロキシにバッファリングさせない
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,347 @@
+"""
+いいね/フォローの書き込みをキューに溜めて、まとめて反映する(write-behind)。
+
+settings.WRITE_BEHINDがあるとき、いいね・フォローのビューはDBに書かずに
+「いいねする/外す」「フォローする/外す」という意図をキューに積み、楽観的な件数をすぐ返す。
+flush_write_behindコマンド(メモリのキューならタイマー)がまとめて取り出し、
+(ユーザー, 相手)ごとに最後の意図だけを残してbulk_create(ignore_conflicts=True)とまとめたDELETEで反映する。
+意図は「あり/なし」の状態を指定するだけなので、最後の意図を反映した結果は
+1件ずつ順番に実行した結果と同じになる
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from functools import lru_cache, reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.dispatch import receiver
+
+from accounts import graph, suggestions
+from accounts.models import FriendShip, Profile, User
+
+from . import fragments, timeline, trending
+from .models import Like, Tweet
+
+LIKE = "like"
+UNLIKE = "unlike"
+FOLLOW = "follow"
+UNFOLLOW = "unfollow"
+
+# 意図 -> (種類, あり/なし)
+INTENTS = {
+    LIKE: (Like, True),
+    UNLIKE: (Like, False),
+    FOLLOW: (FriendShip, True),
+    UNFOLLOW: (FriendShip, False),
+}
+
+# 1回のDELETEで消す組の数の上限
+DELETE_BATCH_SIZE = 400
+
+
+class MemoryQueue:
+    """
+    プロセス内のキュー。積んでからflush_interval秒後に別スレッドで反映する。
+    反映に失敗したバッチはキューの先頭に戻して次のタイマーでやり直す。
+    プロセスが落ちると反映前の意図は消える
+    """
+
+    def __init__(self, flush_interval=1.0, batch_size=1000, **options):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def put(self, intent):
+        with self._lock:
+            self._items.append(intent)
+            self._schedule()
+
+    def batches(self, batch_size):
+        while True:
+            with self._lock:
+                batch = [
+                    self._items.popleft()
+                    for _ in range(min(batch_size, len(self._items)))
+                ]
+            if not batch:
+                return
+            yield batch
+
+    def requeue(self, batch):
+        """反映できなかったbatchを、順番を変えずにキューの先頭へ戻す"""
+        with self._lock:
+            self._items.extendleft(reversed(batch))
+            self._schedule()
+
+    def _schedule(self):
+        if self.flush_interval and self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self._flush_later)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_later(self):
+        with self._lock:
+            self._timer = None
+        try:
+            flush(self, self.batch_size)
+        finally:
+            # タイマーのスレッドの接続はこのあと誰も使わない
+            connection.close()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class FileQueue:
+    """
+    ディレクトリの中のJSON Linesファイルに追記するキュー。複数のプロセスから積める。
+    ワーカーはファイルの名前を変えてから読むので、読んでいる間も書き込みは止まらない。
+    反映し終わるまで名前を変えたファイルは消さないので、途中で落ちても次の実行でやり直せる
+    """
+
+    def __init__(self, location, **options):
+        self.location = str(location)
+        self.path = os.path.join(self.location, "queue.jsonl")
+        os.makedirs(self.location, exist_ok=True)
+
+    def put(self, intent):
+        line = json.dumps(intent) + "\n"
+        while True:
+            with open(self.path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # ロックを待っている間にワーカーが名前を変えていたら、新しいファイルを開き直す
+                try:
+                    current = os.stat(self.path)
+                except FileNotFoundError:
+                    continue
+                if os.path.samestat(os.fstat(f.fileno()), current):
+                    f.write(line)
+                    return
+
+    def _claim(self):
+        """今のファイルを処理中の名前に変える。積まれていなければNone"""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            claimed = os.path.join(self.location, f"processing-{time.time_ns()}.jsonl")
+            os.replace(self.path, claimed)
+        return claimed
+
+    def _processing(self):
+        # 前回の実行が途中で落ちて残ったファイルから順に処理する
+        names = sorted(
+            name for name in os.listdir(self.location) if name.startswith("processing-")
+        )
+        return [os.path.join(self.location, name) for name in names]
+
+    def batches(self, batch_size):
+        paths = self._processing()
+        claimed = self._claim()
+        if claimed:
+            paths.append(claimed)
+        for path in paths:
+            with open(path) as f:
+                batch = []
+                for line in f:
+                    if line.strip():
+                        batch.append(json.loads(line))
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+            os.remove(path)
+
+    def requeue(self, batch):
+        # 反映し終わるまでファイルを消さないので、次の実行でそのファイルからやり直す
+        pass
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return sum(1 for _ in f)
+
+
+QUEUES = {"memory": MemoryQueue, "file": FileQueue}
+
+
+def is_enabled():
+    return bool(settings.WRITE_BEHIND)
+
+
+@lru_cache(maxsize=None)
+def get_queue():
+    options = dict(settings.WRITE_BEHIND)
+    return QUEUES[options.pop("queue")](**options)
+
+
+@receiver(setting_changed)
+def write_behind_setting_changed(setting, **kwargs):
+    if setting == "WRITE_BEHIND":
+        get_queue.cache_clear()
+
+
+def enqueue(op, user_id, target_id):
+    get_queue().put({"op": op, "user": user_id, "target": target_id})
+
+
+def _like_state(user_id, tweet_id):
+    """(今のいいね数, user_idがいいねしているか)。ツイートがなければTweet.DoesNotExist"""
+    row = (
+        Tweet.objects.filter(pk=tweet_id)
+        .annotate(
+            liked=Exists(Like.objects.filter(tweet=OuterRef("pk"), user_id=user_id))
+        )
+        .values_list("like_count", "liked")
+        .first()
+    )
+    if row is None:
+        raise Tweet.DoesNotExist
+    return row
+
+
+def like(user_id, tweet_id):
+    """いいねを積んで、反映後に見えるはずのいいね数を返す"""
+    like_count, liked = _like_state(user_id, tweet_id)
+    enqueue(LIKE, user_id, tweet_id)
+    return like_count if liked else like_count + 1
+
+
+def unlike(user_id, tweet_id):
+    """いいね解除を積んで、反映後に見えるはずのいいね数を返す"""
+    like_count, liked = _like_state(user_id, tweet_id)
+    enqueue(UNLIKE, user_id, tweet_id)
+    return like_count - 1 if liked else like_count
+
+
+def _delete_pairs(model, pairs, user_field, target_field):
+    """
+    (ユーザー, 相手)の組を消す。相手ごとにIN句にまとめ、組が多いときは分けて消す
+    (ORをつなげすぎるとSQLiteの式の深さの上限(1000)を超える)
+    """
+    pairs = sorted(pairs, key=lambda pair: pair[1])
+    for start in range(0, len(pairs), DELETE_BATCH_SIZE):
+        users_by_target = defaultdict(list)
+        for user, target in pairs[start : start + DELETE_BATCH_SIZE]:
+            users_by_target[target].append(user)
+        model.objects.filter(
+            reduce(
+                or_,
+                (
+                    Q(**{target_field: target, f"{user_field}__in": users})
+                    for target, users in users_by_target.items()
+                ),
+            )
+        )._raw_delete(DEFAULT_DB_ALIAS)
+
+
+def _count_of(model, field):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef("pk")})
+            .values(field)
+            .annotate(count=Count("*"))
+            .values("count")
+        ),
+        0,
+    )
+
+
+def _apply_likes(states):
+    added = [pair for pair, present in states.items() if present]
+    removed = [pair for pair, present in states.items() if not present]
+    # 積んでから反映するまでに消えたツイートへのいいねは捨てる
+    tweet_ids = set(
+        Tweet.objects.filter(pk__in={t for _, t in added}).values_list("pk", flat=True)
+    )
+    Like.objects.bulk_create(
+        [Like(user_id=u, tweet_id=t) for u, t in added if t in tweet_ids],
+        ignore_conflicts=True,
+    )
+    _delete_pairs(Like, removed, "user_id", "tweet_id")
+
+    # bulk_createと_raw_deleteはシグナルを飛ばさないので、件数とキャッシュはここで直す
+    affected = {t for _, t in states}
+    Tweet.objects.filter(pk__in=affected).update(like_count=_count_of(Like, "tweet_id"))
+    trending.rebuild_buckets(affected)
+    for tweet_id in affected:
+        fragments.invalidate(fragments.TWEET, tweet_id)
+
+
+def _apply_follows(states):
+    user_ids = set(
+        User.objects.filter(pk__in={u for pair in states for u in pair}).values_list(
+            "pk", flat=True
+        )
+    )
+    added = [
+        (follower, following)
+        for (follower, following), present in states.items()
+        if present and follower != following and {follower, following} <= user_ids
+    ]
+    removed = [pair for pair, present in states.items() if not present]
+    FriendShip.objects.bulk_create(
+        [FriendShip(follower_id=f, following_id=g) for f, g in added],
+        ignore_conflicts=True,
+    )
+    _delete_pairs(FriendShip, removed, "follower_id", "following_id")
+
+    affected = {u for pair in states for u in pair}
+    Profile.objects.filter(pk__in=affected).update(
+        follower_count=_count_of(FriendShip, "following_id"),
+        following_count=_count_of(FriendShip, "follower_id"),
+    )
+    for follower, following in added:
+        timeline.backfill(User(pk=follower), User(pk=following))
+    for follower, following in removed:
+        timeline.prune(User(pk=follower), User(pk=following))
+    for user_id in affected:
+        fragments.invalidate(fragments.PROFILE, user_id)
+    # シグナルが飛ばないので、おすすめユーザーとフォローグラフもここで更新する
+    suggestions.mark_stale({follower for follower, _ in states})
+    for follower, following in added:
+        graph.on_commit(follower, following, True)
+    for follower, following in removed:
+        graph.on_commit(follower, following, False)
+
+
+def apply(intents):
+    """意図を(種類, ユーザー, 相手)ごとに最後のものだけにまとめて、1つのトランザクションで反映する"""
+    states = {Like: {}, FriendShip: {}}
+    for intent in intents:
+        model, present = INTENTS[intent["op"]]
+        states[model][(intent["user"], intent["target"])] = present
+    with transaction.atomic():
+        if states[Like]:
+            _apply_likes(states[Like])
+        if states[FriendShip]:
+            _apply_follows(states[FriendShip])
+
+
+def flush(queue=None, batch_size=1000):
+    """キューが空になるまでbatch_size件ずつ反映して、反映した意図の数を返す"""
+    queue = queue or get_queue()
+    flushed = 0
+    for batch in queue.batches(batch_size):
+        try:
+            apply(batch)
+        except Exception:
+            queue.requeue(batch)
+            raise
+        flushed += len(batch)
+    return flushed